@@ -23,6 +23,19 @@ STEP=0
 MIN_CON=0.5
 SHOW_INFO=0
 RM_FILE=0
+THREADS=1
+MMSEQS_TMP=$CURRENT_DIR/working_dir
+CLUSTER_STORE=0
+FROM_TSV=0
+BOOTSTRAP=0
+DIRECT=0
+STREAM=0
+CONVERGE=0
+STREAMED=0
+FORCE=0
+# performance records of steps and tasks (see scripts/telemetry.py)
+export ECT_TELEMETRY=${ECT_TELEMETRY:-$CURRENT_DIR/telemetry.jsonl}
+export ECT_RUN=$(date '+%Y%m%d-%H%M%S')-$$
 
 function display_help() {
     echo "ECT"
@@ -43,7 +56,11 @@ function display_help() {
                      > 3: start with filtering step
                      > 4: Start with making MSA
                      > 5: start with construction NJ trees
-                     > 6: start with preparing consensus (final) tree"
+                     > 6: start with preparing consensus (final) tree
+                     Steps (and single clusters in MSA and NJ trees steps) recorded in [name]_manifest.jsonl 
+                     as done with the same parameters and unchanged files are skipped anyway"
+    echo "  -f, --force        Forget [name]_manifest.jsonl and redo all not-skipped steps for all clusters; doesn't 
+                     have positional argument (default: False)"
     echo "  -s, --msi          MMseq2 option: list matches above this sequence identity (range 0.0-1.0); 
                      (default: 0.3)"
     echo "  -l, --clusterMode  MMseq2 option: select clustering mode:
@@ -59,10 +76,30 @@ function display_help() {
                      > 5: short seq. needs to be at least x percent of the other seq. length"
     echo "  -c, --cov          MMseq2 option: list matches above this fraction of aligned (covered) residues;
                      (default: 0.800)"
+    echo "  -w, --tmpDir       Directory in which every run creates its own workspace for temporary files of MMseq2 
+                     and other steps, e.g. on tmpfs or local NVMe (default: working_dir)"
     echo "  -m, --msa          Algorithm used to MSA: 
                      > 0 - ClustalW (default)
                      > 1 - Muscle
                      > 2 - Mafft"
+    echo "  -b, --bootstrap    Number of bootstrap replicates of NJ gene trees; clade support is saved in .nwk files
+                     (default: 0 - no bootstrap)"
+    echo "  -a, --direct       Build NJ trees in the MSA step directly from aligner output, without alignment 
+                     files (NJ trees step is skipped); doesn't have positional argument (default: False)"
+    echo "  -x, --stream       Run MSA, NJ trees and consensus steps as one streaming pipeline: every cluster goes
+                     to tree building and split counting as soon as it is aligned, provisional consensus 
+                     is written to CONSENSUS.partial.tree (NJ trees and consensus steps are skipped); 
+                     doesn't have positional argument (default: False)"
+    echo "  -g, --converge     Stop aligning clusters, when consensus converged: topology didn't change and its every
+                     split stayed at least this margin above minCons over 1000 trees (clusters are processed in 
+                     random order); implies -x (default: 0 - align all clusters)"
+    echo "  -t, --threads      Number of parallel jobs used by the fetching, merging, clustering, filtering, MSA, NJ trees 
+                     and consensus steps; 0 - all available cores (default: 1)"
+    echo "  -k, --store        Keep clusters, alignments and NJ trees in indexed cluster store [name]/store 
+                     instead of separate files in [name]/nonpara and [name]/para; doesn't have positional 
+                     argument (default: False)"
+    echo "  -u, --fromTsv      Filter clusters using only MMseq2 _cluster.tsv and indexed copy of merged proteomes, 
+                     without writing _all_seqs.fasta; doesn't have positional argument (default: False)"
     echo "  -d, --description  Show help information of not-skipped subscripts; doesn't have positional 
                      argument (default: Fasle)"
     echo "  -r, --remove       Text file with species names or taxonomy id in lines to remove from local database
@@ -82,6 +119,15 @@ while [[ "$#" -gt 0 ]]; do
         -c|--cov) COV_VALUE="$2"; shift ;;
         -e|--step) STEP="$2"; shift ;;
         -p|--minCons) MIN_CON="$2"; shift ;;
+        -t|--threads) THREADS="$2"; shift ;;
+        -b|--bootstrap) BOOTSTRAP="$2"; shift ;;
+        -w|--tmpDir) MMSEQS_TMP="$2"; shift ;;
+        -k|--store) CLUSTER_STORE=1 ;;
+        -a|--direct) DIRECT=1 ;;
+        -x|--stream) STREAM=1 ;;
+        -g|--converge) CONVERGE="$2"; STREAM=1; shift ;;
+        -u|--fromTsv) FROM_TSV=1 ;;
+        -f|--force) FORCE=1 ;;
         -d|--description) SHOW_INFO=1 ;;
         -r|--remove) RM_FILE="$2"; shift ;;
         *) echo "Unknown parameter passed: $1"; display_help ;;
@@ -89,10 +135,30 @@ while [[ "$#" -gt 0 ]]; do
     shift
 done
 
+# -t 0: all available cores in every step
+if [ "$THREADS" -eq 0 ]; then
+    THREADS=$(nproc)
+fi
+
+# Files of the run are named after the species list ([name].txt), so runs with different lists
+# can share the directory; runs with the same list wait for each other
+RUN_NAME=$(basename $SPECIES_LIST .txt)
+MANIFEST=$CURRENT_DIR/${RUN_NAME}_manifest.jsonl
+exec 9>"$CURRENT_DIR/.${RUN_NAME}.lock"
+if ! flock -n 9; then
+    echo "Another run with $SPECIES_LIST is in progress, waiting for it..."
+    flock 9
+fi
 
+# Scratch workspace of the run: temporary files of all steps (TMPDIR is used also by python scripts),
+# removed at exit
+mkdir -p "$MMSEQS_TMP"
+WORKSPACE=$(mktemp -d "$MMSEQS_TMP/run_XXXXXX")
+export TMPDIR=$WORKSPACE
+trap 'rm -rf "$WORKSPACE"' EXIT
 
 # Initialize log file
-log_file=$CURRENT_DIR/log.txt
+log_file=$CURRENT_DIR/${RUN_NAME}_log.txt
 echo "Welcome to Easy Consensus Tree" > $log_file
 echo "#################################################################" >> $log_file
 echo "Provided parameters:"  >> $log_file
@@ -104,6 +170,15 @@ echo "-l       $CLUST_MODE                (clusterMode parameter for MMseq)" >>
 echo "-v       $COV_MODE                (covMode parameter for MMseq)" >> $log_file
 echo "-c       $COV_VALUE              (cov parameter for MMseq)" >> $log_file
 echo "-m       $MSA_MODE                (MSA mode)" >> $log_file
+echo "-b       $BOOTSTRAP                (number of bootstrap replicates of NJ trees)" >> $log_file
+echo "-t       $THREADS                (number of parallel jobs)" >> $log_file
+echo "-w       $WORKSPACE      (workspace of the run for temporary files)" >> $log_file
+echo "-a       $DIRECT                (if build NJ trees directly from aligner output)" >> $log_file
+echo "-x       $STREAM                (if run MSA, NJ trees and consensus as streaming pipeline)" >> $log_file
+echo "-g       $CONVERGE                (margin of early stopping of streaming pipeline)" >> $log_file
+echo "-k       $CLUSTER_STORE                (if use cluster store)" >> $log_file
+echo "-u       $FROM_TSV                (if filter clusters from _cluster.tsv)" >> $log_file
+echo "-f       $FORCE                (if forget manifest of done steps)" >> $log_file
 echo "-d       $SHOW_INFO                (if show help from subscripts)" >> $log_file
 echo "-r       $RM_FILE                 (file with proteomes names to remove)" >> $log_file
 echo "#################################################################" >> $log_file
@@ -119,11 +194,12 @@ function log_message() {
 }
 
 # Function to run a command and save output to log
+# (wall time, CPU time, peak memory and exit code of the command are recorded in $ECT_TELEMETRY)
 function run_and_log() {
     local cmd="$1"
     local action="$2"
 
-    output=$($cmd 2>&1)
+    output=$(python3 $PROJECT_DIR/scripts/telemetry.py -stage "$action" $cmd 2>&1)
     status=$?
 
     echo "$output" | tee -a "$log_file"
@@ -136,6 +212,16 @@ function run_and_log() {
     fi
 }
 
+# Functions to check and record steps in manifest (inputs, outputs and parameters of done steps)
+# usage: up_to_date [step name] [parameters] [files]
+function up_to_date() {
+    python3 $PROJECT_DIR/scripts/manifest.py $MANIFEST "$1" -params "$2" -files $3 -check >> "$log_file" 2>&1
+}
+
+function record_step() {
+    python3 $PROJECT_DIR/scripts/manifest.py $MANIFEST "$1" -params "$2" -files $3 -record >> "$log_file" 2>&1
+}
+
 log_message "Starting Easy Consensus Tree"
 
 if [ ! -f $SPECIES_LIST ]; then
@@ -150,6 +236,11 @@ log_message "Activating conda environment: $CONDA_ENV"
 source $(conda info --base)/etc/profile.d/conda.sh
 conda activate $CONDA_ENV
 
+if [ $FORCE -gt 0 ] && [ $SHOW_INFO -lt 1 ]; then
+    log_message "Removing manifest $MANIFEST..."
+    rm -f $MANIFEST
+fi
+
 #######################################
 # Remove proteomes
 #######################################
@@ -171,7 +262,7 @@ else
 
             log_message "Fetching proteomes from $SPECIES_LIST..."
 
-            run_and_log "python3 $PROJECT_DIR/scripts/fetch_proteomes.py $SPECIES_LIST" "Fetching"
+            run_and_log "python3 $PROJECT_DIR/scripts/fetch_proteomes.py $SPECIES_LIST -threads $THREADS" "Fetching"
         else
             run_and_log "python3 $PROJECT_DIR/scripts/update_taxon_lib.py -h" "Showing updating taxonom library help"
             run_and_log "python3 $PROJECT_DIR/scripts/fetch_proteomes.py -h" "Showing fetching help"
@@ -183,11 +274,21 @@ else
     #######################################
     # Merge proteomes
     #######################################
+    #   # problem: ambiguous name - this keeps being a problem down the line)
+    #   # assumption for now: filename prefix is always [name_of_species_txt]_merged[nr_of_proteoms]
+    MERGED_PREFIX="$(basename $SPECIES_LIST .txt)_merged$(grep -c '.' $SPECIES_LIST.paths)" # e.g. names_merged5
+    # .paths file is checked together with all proteomes listed in it
+    MERGE_FILES="$SPECIES_LIST.paths $CURRENT_DIR/$MERGED_PREFIX.fasta.gz"
     if [ $STEP -lt 2 ]; then
         if [ $SHOW_INFO -lt 1 ]; then
-            log_message "Merging proteomes from $SPECIES_LIST.paths..."
-
-            run_and_log "python3 $PROJECT_DIR/scripts/merge_proteomes.py $SPECIES_LIST.paths" "Merging"
+            if up_to_date merging "" "$MERGE_FILES"; then
+                log_message "Skipping merging step, $MERGED_PREFIX.fasta.gz is up to date..."
+            else
+                log_message "Merging proteomes from $SPECIES_LIST.paths..."
+
+                run_and_log "python3 $PROJECT_DIR/scripts/merge_proteomes.py $SPECIES_LIST.paths -threads $THREADS" "Merging"
+                record_step merging "" "$MERGE_FILES"
+            fi
         else
             run_and_log "python3 $PROJECT_DIR/scripts/merge_proteomes.py -h" "Showing merging help"
         fi
@@ -199,16 +300,37 @@ else
     #######################################
 
     # in: path to merged fasta.gz
-    #   # problem: ambiguous name - this keeps being a problem down the line)
-    #   # assumption for now: filename prefix is always [name_of_species_txt]_merged[nr_of_proteoms]
-    MERGED_PREFIX="$(basename $SPECIES_LIST .txt)_merged$(grep -c '.' $SPECIES_LIST.paths)" # e.g. names_merged5
+    # directory with clusters used by MSA, NJ trees and consensus steps
+    if [ $CLUSTER_STORE -gt 0 ]; then
+        STORE_OPTION="-store"
+        MSA_INPUT=$CURRENT_DIR/$MERGED_PREFIX/store
+        TREE_DIR=$CURRENT_DIR/$MERGED_PREFIX/store
+    else
+        STORE_OPTION=""
+        MSA_INPUT=$CURRENT_DIR/$MERGED_PREFIX/np.txt
+        TREE_DIR=$CURRENT_DIR/$MERGED_PREFIX/nonpara
+    fi
+    # clusters from _cluster.tsv (sequences from merged proteomes) or from _all_seqs.fasta
+    if [ $FROM_TSV -gt 0 ]; then
+        TSV_OPTION="-tsv_only"
+        CLUSTERS_FILE=$CURRENT_DIR/${MERGED_PREFIX}_cluster.tsv
+    else
+        TSV_OPTION=""
+        CLUSTERS_FILE=$CURRENT_DIR/${MERGED_PREFIX}_all_seqs.fasta
+    fi
     # options: msi (--min_seq_id), clustermode, covmode, c
     # out: ...all_seqs.fasta, ...cluster.csv in $CURRENT_DIR
+    CLUSTER_PARAMS="msi=$MSI_MODE clusterMode=$CLUST_MODE covMode=$COV_MODE c=$COV_VALUE fromTsv=$FROM_TSV"
+    CLUSTER_FILES="$CURRENT_DIR/$MERGED_PREFIX.fasta.gz $CLUSTERS_FILE"
     if [ $STEP -lt 3 ]; then
-        if [ $SHOW_INFO -lt 1 ]; then
+        if [ $SHOW_INFO -lt 1 ] && up_to_date clustering "$CLUSTER_PARAMS" "$CLUSTER_FILES"; then
+            log_message "Skipping MMseq2 clustering step, $(basename $CLUSTERS_FILE) is up to date..."
+        elif [ $SHOW_INFO -lt 1 ]; then
             log_message "Clustering sequences from $MERGED_PREFIX.fasta.gz..."
 
-            run_and_log "python3 $PROJECT_DIR/scripts/run_mmseqs.py $CURRENT_DIR/$MERGED_PREFIX.fasta.gz -msi $MSI_MODE -clusterMode $CLUST_MODE -covMode $COV_MODE -c $COV_VALUE" "Clustering"
+            # mmseqs uses -t threads (as the other steps) and 80% of available memory
+            run_and_log "python3 $PROJECT_DIR/scripts/run_mmseqs.py $CURRENT_DIR/$MERGED_PREFIX.fasta.gz -msi $MSI_MODE -clusterMode $CLUST_MODE -covMode $COV_MODE -c $COV_VALUE -tmp $WORKSPACE -threads $THREADS $TSV_OPTION" "Clustering"
+            record_step clustering "$CLUSTER_PARAMS" "$CLUSTER_FILES"
         else
             run_and_log "python3 $PROJECT_DIR/scripts/run_mmseqs.py -h" "Showing run_mmseqs.py help"
         fi
@@ -218,19 +340,30 @@ else
     #######################################
     # Filter clusters
     #######################################
+    FILTER_PARAMS="store=$CLUSTER_STORE fromTsv=$FROM_TSV"
+    FILTER_FILES="$CLUSTERS_FILE $CURRENT_DIR/$MERGED_PREFIX/np.txt $CURRENT_DIR/$MERGED_PREFIX/p.txt"
+    if [ $CLUSTER_STORE -gt 0 ]; then
+        FILTER_FILES="$FILTER_FILES $MSA_INPUT/np.idx $MSA_INPUT/pa.idx"
+    fi
+    if [ $FROM_TSV -gt 0 ]; then
+        FILTER_FILES="$FILTER_FILES $CURRENT_DIR/$MERGED_PREFIX.fasta.gz"
+    fi
     if [ $STEP -lt 4 ]; then
-        if [ $SHOW_INFO -lt 1 ]; then
-            log_message "Filtering clusters from ${MERGED_PREFIX}_all_seqs.fasta..."
+        if [ $SHOW_INFO -lt 1 ] && up_to_date filtering "$FILTER_PARAMS" "$FILTER_FILES"; then
+            log_message "Skipping filtering step, clusters in $MERGED_PREFIX are up to date..."
+        elif [ $SHOW_INFO -lt 1 ]; then
+            log_message "Filtering clusters from $(basename $CLUSTERS_FILE)..."
             # in:  ...all_seqs.fasta
             # option: -c (cutoff for min number of species in a nonpara cluster)
             # out: folders para and nonpara and files np.txt and p.txt in $CURRENT_DIR/merged-prefix
 
-            run_and_log "python3 $PROJECT_DIR/scripts/split_clusters.py $CURRENT_DIR/${MERGED_PREFIX}_all_seqs.fasta" "Filtering"
+            run_and_log "python3 $PROJECT_DIR/scripts/split_clusters.py $CLUSTERS_FILE -threads $THREADS $STORE_OPTION" "Filtering"
+            record_step filtering "$FILTER_PARAMS" "$FILTER_FILES"
         else
             run_and_log "python3 $PROJECT_DIR/scripts/split_clusters.py -h" "Showing filtering help"
         fi
     else
-        log_message "Skipping filering step from ${MERGED_PREFIX}_all_seqs.fasta..."
+        log_message "Skipping filering step from $(basename $CLUSTERS_FILE)..."
     fi
     #######################################
     # Run MSA
@@ -242,9 +375,24 @@ else
             # out: aln files in merged-prefix/nonpara folder
 
             # error while using clustalw: for some reason it thinks np.txt is an "unknown option"
-            run_and_log "python3 $PROJECT_DIR/scripts/run_MSA.py $CURRENT_DIR/$MERGED_PREFIX/np.txt -mode $MSA_MODE" "MSA"
+            # clusters aligned before (recorded in manifest) are skipped
+            if [ $STREAM -gt 0 ]; then
+                # align -> NJ tree -> split counting per cluster, consensus at the end (see scripts/stream_pipeline.py)
+                CONVERGE_OPTION=""
+                if [ "$CONVERGE" != "0" ]; then
+                    CONVERGE_OPTION="-converge $CONVERGE"
+                fi
+                run_and_log "python3 $PROJECT_DIR/scripts/stream_pipeline.py $MSA_INPUT $SPECIES_LIST $MIN_CON -mode $MSA_MODE -threads $THREADS -bootstrap $BOOTSTRAP -manifest $MANIFEST $CONVERGE_OPTION" "Streaming MSA, NJ trees and consensus"
+                STREAMED=1
+            elif [ $DIRECT -gt 0 ]; then
+                # aligner output goes straight to distance matrix and NJ tree, no .aln files
+                run_and_log "python3 $PROJECT_DIR/scripts/run_MSA.py $MSA_INPUT -mode $MSA_MODE -threads $THREADS -manifest $MANIFEST -tree -bootstrap $BOOTSTRAP" "MSA"
+            else
+                run_and_log "python3 $PROJECT_DIR/scripts/run_MSA.py $MSA_INPUT -mode $MSA_MODE -threads $THREADS -manifest $MANIFEST" "MSA"
+            fi
         else
             run_and_log "python3 $PROJECT_DIR/scripts/run_MSA.py -h" "Showing run_MSA.py help"
+            run_and_log "python3 $PROJECT_DIR/scripts/stream_pipeline.py -h" "Showing streaming pipeline help"
         fi
     else
         log_message "Skipping MSA step from $MERGED_PREFIX/np.txt..."
@@ -253,18 +401,17 @@ else
     # Construction of gene family trees
     #######################################
     if [ $STEP -lt 6 ]; then
-        if [ $SHOW_INFO -lt 1 ]; then
+        if [ $SHOW_INFO -lt 1 ] && [ $STREAMED -gt 0 ]; then
+            log_message "Skipping NJ trees construction step, trees were built by streaming pipeline..."
+        elif [ $SHOW_INFO -lt 1 ] && [ $DIRECT -gt 0 ]; then
+            log_message "Skipping NJ trees construction step, trees were built in MSA step..."
+        elif [ $SHOW_INFO -lt 1 ]; then
             log_message "Constructing trees for gene families in folder $MERGED_PREFIX/nonpara/*.aln..."
             # in: aln files (see below)
             # out: nwk files in nonpara folder
 
-            # the script processes only one file at a time with no wrapper
-            # shopt -s nullglob
-            for file in $CURRENT_DIR/$MERGED_PREFIX/nonpara/*aln; do
-                run_and_log "python3 $PROJECT_DIR/scripts/run_NJ_on_alignment.py $file" "Tree construction"
-            done
-
-            log_message "Gene family tree construction completed successfully."
+            # all alignments are processed by one python process (with -threads worker processes)
+            run_and_log "python3 $PROJECT_DIR/scripts/run_NJ_on_alignment.py $TREE_DIR -threads $THREADS -bootstrap $BOOTSTRAP -manifest $MANIFEST" "Tree construction"
         else
             run_and_log "python3 $PROJECT_DIR/scripts/run_NJ_on_alignment.py -h" "Showing tree construction help"
         fi
@@ -276,14 +423,16 @@ else
     # Construction of consensus tree
     #######################################
     if [ $STEP -lt 7 ]; then
-        if [ $SHOW_INFO -lt 1 ]; then
+        if [ $SHOW_INFO -lt 1 ] && [ $STREAMED -gt 0 ]; then
+            log_message "Skipping consensus tree construction step, final tree saved by streaming pipeline to $TREE_DIR/CONSENSUS.tree"
+        elif [ $SHOW_INFO -lt 1 ]; then
             log_message "Constructing consensus tree for trees in $MERGED_PREFIX/nonpara/*.nwk..."
             # in: folder with nwk (nonpara folder), file with taxa list ($SPECIES_LIST), min_freq (from user, this is not optional, for now)
             # out: CONSENSUS.tree file in nonpara folder
 
-            run_and_log "python3 $PROJECT_DIR/scripts/run_consensus.py $CURRENT_DIR/$MERGED_PREFIX/nonpara $SPECIES_LIST $MIN_CON" "Consensus tree construction"
+            run_and_log "python3 $PROJECT_DIR/scripts/run_consensus.py $TREE_DIR $SPECIES_LIST $MIN_CON -threads $THREADS" "Consensus tree construction"
 
-            log_message "Final tree saved to $CURRENT_DIR/$MERGED_PREFIX/nonpara/CONSENSUS.tree"
+            log_message "Final tree saved to $TREE_DIR/CONSENSUS.tree"
         else
             run_and_log "python3 $PROJECT_DIR/scripts/run_consensus.py -h" "Showing consensus tree construction help"
         fi
@@ -298,11 +447,16 @@ else
     log_message "Show tree from $MERGED_PREFIX/nonpara/CONSENSUS.tree..."
     # in: CONSENSUS.tree file in nonpara folder
     if [ $SHOW_INFO -lt 1 ]; then
-        run_and_log "python3 $PROJECT_DIR/scripts/plot_tree.py $CURRENT_DIR/$MERGED_PREFIX/nonpara/CONSENSUS.tree" "Tree visualisation"
+        run_and_log "python3 $PROJECT_DIR/scripts/plot_tree.py $TREE_DIR/CONSENSUS.tree" "Tree visualisation"
     else
         run_and_log "python3 $PROJECT_DIR/scripts/plot_tree.py -h" "Showing tree visualisation help"
     fi
 
 
+    if [ $SHOW_INFO -lt 1 ] && [ -f $ECT_TELEMETRY ]; then
+        log_message "Performance summary of the run (from $ECT_TELEMETRY)..."
+        python3 $PROJECT_DIR/scripts/telemetry.py -summary $ECT_TELEMETRY -run $ECT_RUN 2>&1 | tee -a "$log_file"
+    fi
+
     log_message "All finished"
 fi
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+"""
+Script Name: benchmark_nj.py
+
+Description:
+Compare NJ engines from fast_nj.py with Biopython DistanceTreeConstructor().nj:
+1) on trees from test/ directory - patristic distances of each tree (with random branch
+   lengths) are used as input; all engines should recover the original topology and the
+   numpy 'nj' engine should write exactly the same newick as Biopython,
+2) on random alignments of growing size - time of distance matrix + tree construction.
+
+Usage:
+    python benchmark_nj.py [-tests test_dir] [-sizes 50 100 200] [-length 300]
+"""
+
+import os
+import io
+import time
+import random
+import argparse
+import numpy as np
+from Bio import Phylo
+from Bio.Phylo.TreeConstruction import DistanceCalculator
+from identity_distance import encode_alignment, identity_distances, distance_matrix
+from fast_nj import build_tree, full_matrix, engines
+
+script_dir = os.path.dirname(os.path.realpath(__file__))
+default_test_dir = os.path.join(os.path.dirname(script_dir), 'test')
+amino_acids = "ACDEFGHIKLMNPQRSTVWY"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+    description="""Benchmark NJ engines (biopython, numpy nj, numpy bionj) on test/ trees
+    and random alignments.""")
+    parser.add_argument('-tests', metavar='DIR', nargs=1, help=f"""Directory with .tree files;
+        default: {default_test_dir}""", default=[default_test_dir])
+    parser.add_argument('-sizes', metavar='INT', type=int, nargs='+', help="""Numbers of sequences
+        in random alignments; default: 50 100 200""", default=[50, 100, 200])
+    parser.add_argument('-length', metavar='INT', type=int, nargs=1, help="""Length of random
+        alignments; default: 300""", default=[300])
+    parser.add_argument('-seed', metavar='INT', type=int, nargs=1, help="default: 1", default=[1])
+    return parser.parse_args()
+
+
+def splits(tree):
+    # set of bipartitions (as frozensets of leaf names on the side without the first leaf);
+    # internal branches of ~zero length are skipped (NJ resolves polytomies with them)
+    leaves = sorted(t.name for t in tree.get_terminals())
+    result = set()
+    for clade in tree.get_nonterminals():
+        if clade.branch_length is not None and abs(clade.branch_length) < 1e-9:
+            continue
+        side = {t.name for t in clade.get_terminals()}
+        if leaves[0] in side:
+            side = set(leaves) - side
+        if 1 < len(side) < len(leaves) - 1:
+            result.add(frozenset(side))
+    return result
+
+
+def newick(tree):
+    for internal in tree.get_nonterminals():
+        internal.name = ""
+    out = io.StringIO()
+    Phylo.write(tree, out, "newick")
+    return out.getvalue()
+
+
+def patristic_matrix(tree, rnd):
+    for clade in tree.find_clades():
+        clade.branch_length = rnd.uniform(0.05, 1.0)
+    leaves = tree.get_terminals()
+    n = len(leaves)
+    dist = np.zeros((n, n))
+    for i in range(n):
+        for j in range(i):
+            dist[i, j] = dist[j, i] = tree.distance(leaves[i], leaves[j])
+    return [t.name for t in leaves], dist
+
+
+def random_alignment(n, length, rnd):
+    # sequences evolved along a random caterpillar-like history, so the trees are not trivial
+    from Bio.Align import MultipleSeqAlignment
+    from Bio.SeqRecord import SeqRecord
+    from Bio.Seq import Seq
+    seqs = [[rnd.choice(amino_acids) for _ in range(length)]]
+    while len(seqs) < n:
+        parent = rnd.choice(seqs)
+        seqs.append([c if rnd.random() > 0.15 else rnd.choice(amino_acids + "-") for c in parent])
+    return MultipleSeqAlignment([SeqRecord(Seq("".join(s)), id=str(i)) for i, s in enumerate(seqs)])
+
+
+def compare_on_tests(test_dir, seed):
+    print(f"\n{'tree file':<32}{'taxa':>6}  " + "  ".join(f"{e:>10}" for e in engines) + "  same newick")
+    rnd = random.Random(seed)
+    for filename in sorted(os.listdir(test_dir)):
+        if not filename.endswith('.tree'):
+            continue
+        reference = Phylo.read(os.path.join(test_dir, filename), "newick")
+        names, dist = patristic_matrix(reference, rnd)
+        expected = splits(reference)
+        trees = {e: build_tree(names, dist, e) for e in engines}
+        same = [("ok" if splits(trees[e]) == expected else "DIFFERENT") for e in engines]
+        same_newick = newick(trees["biopython"]) == newick(trees["nj"])
+        print(f"{filename:<32}{len(names):>6}  " + "  ".join(f"{s:>10}" for s in same) + f"  {same_newick}")
+
+
+def compare_timings(sizes, length, seed):
+    print(f"\n{'sequences':>10}{'biopython':>12}{'numpy dist':>12}{'nj':>10}{'bionj':>10}  same newick")
+    rnd = random.Random(seed)
+    for n in sizes:
+        align = random_alignment(n, length, rnd)
+        start = time.perf_counter()
+        dm = DistanceCalculator('identity').get_distance(align)
+        bio_names, bio_dist = full_matrix(dm)
+        bio_tree = build_tree(bio_names, bio_dist, "biopython")
+        t_bio = time.perf_counter() - start
+
+        start = time.perf_counter()
+        names, codes = encode_alignment(align)
+        dist = identity_distances(codes)
+        t_dist = time.perf_counter() - start
+        start = time.perf_counter()
+        nj = build_tree(names, dist, "nj")
+        t_nj = time.perf_counter() - start
+        start = time.perf_counter()
+        build_tree(names, dist, "bionj")
+        t_bionj = time.perf_counter() - start
+        same = newick(bio_tree) == newick(nj) and distance_matrix(align).matrix == dm.matrix
+        print(f"{n:>10}{t_bio:>11.3f}s{t_dist:>11.3f}s{t_nj:>9.3f}s{t_bionj:>9.3f}s  {same}")
+
+
+def main():
+    args = parse_args()
+    print(f"{' '*14}> Benchmark NJ engines < \n\n{'#'*20}START{'#'*20}")
+    compare_on_tests(args.tests[0], args.seed[0])
+    compare_timings(args.sizes, args.length[0], args.seed[0])
+
+
+if __name__ == "__main__":
+    main()
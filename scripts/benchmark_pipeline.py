@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+
+"""
+Script Name: benchmark_pipeline.py
+
+Description:
+Offline benchmark of pipeline steps on synthetic data (no network, no mmseqs; aligner can be
+replaced by a stub). For every scale (number of species x number of gene families):
+1) synthetic proteomes are generated: every family has a random ancestral sequence, which
+   evolves along a random species tree (substitutions only, so sequences of a family are
+   aligned by construction); a species has a family with probability -presence, an extra
+   copy (paralog) with probability -paralogs, and -extra fraction of singleton proteins;
+   proteomes are written as [dir]/species_[i].fasta.gz with NCBI-like headers, the clustering
+   result is written directly as [name]_all_seqs.fasta (one cluster per family/singleton),
+2) steps are timed: merge_proteomes.process_paths, split_clusters.process_clusters,
+   run_MSA.process_fasta2MSA (MSA dispatch), run_NJ_on_alignment.process_alignments (nj_tree)
+   and run_consensus.main,
+3) scaling of every step is reported as exponents of: time ~ species^a * families^b
+   (least squares fit on log scale, when there are at least 2 values of the variable).
+
+With -msa stub (default) 'clustalw' is replaced by a small script writing the (already aligned)
+sequences in clustal format, so the MSA step measures dispatch, file handling and parsing only.
+
+Usage:
+    python benchmark_pipeline.py [-species 10 50] [-families 1000 5000] [-threads 4] [-o results.jsonl]
+"""
+
+import os
+import io
+import gzip
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import contextlib
+import numpy as np
+from merge_proteomes import process_paths
+from split_clusters import process_clusters
+from run_MSA import process_fasta2MSA
+from run_NJ_on_alignment import process_alignments, alignment_list
+import run_consensus
+
+amino_acids = np.frombuffer(b"ACDEFGHIKLMNPQRSTVWY", dtype=np.uint8)
+steps = ["merge", "split", "msa", "nj", "consensus"]
+
+stub_clustalw = r'''#!/bin/sh
+# stub of clustalw for benchmark_pipeline.py: "clustalw [file].fasta -align" writes [file].aln,
+# with "-output=fasta -outfile=[name]" aligned FASTA is written to [name]
+out="${1%.*}.aln"; format=clustal
+for arg in "$@"; do
+    case $arg in
+        -output=fasta) format=fasta ;;
+        -outfile=*) out="${arg#-outfile=}" ;;
+    esac
+done
+exec awk -v out="$out" -v format="$format" '
+/^>/ { n++; split(substr($0, 2), f, " "); name[n] = f[1]; next }
+{ gsub(/[ \t\r]/, ""); seq[n] = seq[n] $0 }
+END {
+    for (i = 1; i <= n; i++) if (length(seq[i]) > len) len = length(seq[i])
+    for (i = 1; i <= n; i++) while (length(seq[i]) < len) seq[i] = seq[i] "-"
+    if (format == "fasta") {
+        for (i = 1; i <= n; i++) printf ">%s\n%s\n", name[i], seq[i] > out
+        exit
+    }
+    printf "CLUSTAL W (1.83) multiple sequence alignment\n\n\n" > out
+    for (s = 1; s <= len; s += 60) {
+        for (i = 1; i <= n; i++) printf "%-16s%s\n", name[i], substr(seq[i], s, 60) > out
+        c = substr(seq[1], s, 60); gsub(/./, " ", c)
+        printf "%16s%s\n\n", "", c > out
+    }
+}' "$1"
+'''
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+    description="""Benchmark pipeline steps (merging, filtering, MSA, NJ trees, consensus)
+    on synthetic proteomes of growing size, without network and external aligners.""")
+    parser.add_argument('-species', metavar='INT', type=int, nargs='+', help="""Numbers of species;
+        default: 10 50""", default=[10, 50])
+    parser.add_argument('-families', metavar='INT', type=int, nargs='+', help="""Numbers of gene families
+        (clusters); default: 1000 5000""", default=[1000, 5000])
+    parser.add_argument('-length', metavar='INT', type=int, nargs=1, help="""Mean length of proteins;
+        default: 150""", default=[150])
+    parser.add_argument('-presence', metavar='FLOAT', type=float, nargs=1, help="""Probability that
+        a species has a member of a family; default: 0.9""", default=[0.9])
+    parser.add_argument('-paralogs', metavar='FLOAT', type=float, nargs=1, help="""Probability of an extra
+        copy of a family member in a species; default: 0.05""", default=[0.05])
+    parser.add_argument('-extra', metavar='FLOAT', type=float, nargs=1, help="""Singleton proteins in every
+        proteome, as fraction of number of families; default: 0.1""", default=[0.1])
+    parser.add_argument('-mutation', metavar='FLOAT', type=float, nargs=1, help="""Substitution rate
+        on a branch of species tree; default: 0.1""", default=[0.1])
+    parser.add_argument('-msa', type=str, nargs=1, choices=["stub", "clustalw", "muscle", "mafft"],
+        help="""Aligner: stub (default) or real one, which must be installed""", default=["stub"])
+    parser.add_argument('-direct', action='store_true', help="""Build NJ trees in MSA step from aligner output
+        (run_MSA.py -tree, no alignment files); nj step is then empty""")
+    parser.add_argument('-threads', metavar='INT', type=int, nargs=1, help="default: 1", default=[1])
+    parser.add_argument('-seed', metavar='INT', type=int, nargs=1, help="default: 1", default=[1])
+    parser.add_argument('-dir', metavar='DIR', type=str, nargs=1, help="""Working directory, kept after
+        the benchmark (default: temporary directory, removed)""", default=None)
+    parser.add_argument('-o', metavar='PATH', type=str, nargs=1, help="""Append results (one JSON line
+        per scale) to this file""", default=None)
+    return parser.parse_args()
+
+
+def species_tree(species, rng):
+    # parent of every species (random earlier one) and species grouped by depth in the tree
+    parents = np.full(species, -1)
+    depth = np.zeros(species, dtype=int)
+    for i in range(1, species):
+        parents[i] = rng.integers(0, i)
+        depth[i] = depth[parents[i]] + 1
+    levels = [np.flatnonzero(depth == d) for d in range(1, depth.max() + 1)] if species > 1 else []
+    return parents, levels
+
+
+def family_sequences(length, parents, levels, mutation, rng):
+    # (species x length) codes of one family, evolved level by level from the root species
+    seqs = np.empty((len(parents), length), dtype=np.uint8)
+    seqs[0] = rng.integers(0, 20, length)
+    for nodes in levels:
+        changed = rng.random((len(nodes), length)) < mutation
+        seqs[nodes] = np.where(changed, rng.integers(0, 20, (len(nodes), length)), seqs[parents[nodes]])
+    return seqs
+
+
+def synthetic_proteomes(directory, species, families, length=150, presence=0.9, paralogs=0.05,
+                        extra=0.1, mutation=0.1, seed=1):
+    """Write proteomes, [directory]/species.txt (+ .paths) and clustering result
+    [directory]/species_merged[species]_all_seqs.fasta; returns path of the .paths file."""
+    rng = np.random.default_rng(seed)
+    parents, levels = species_tree(species, rng)
+    paths = [os.path.join(directory, f"species_{i}.fasta.gz") for i in range(species)]
+    proteomes = [gzip.open(path, "wb", compresslevel=1) for path in paths]
+    accession = [0] * species
+    clusters = open(os.path.join(directory, f"species_merged{species}_all_seqs.fasta"), "wb")
+
+    def add_protein(i, seq, description):
+        # header as in NCBI proteome; merge_proteomes.py gives it unified id [i]g[accession]
+        accession[i] += 1
+        header = f"XP_{accession[i]}.1 {description} [species {i}]"
+        proteomes[i].write(f">{header}\n".encode())
+        for start in range(0, len(seq), 80):
+            proteomes[i].write(seq[start:start + 80] + b"\n")
+        return f"{i}g{accession[i]} {header}".encode()
+
+    def write_cluster(members):
+        clusters.write(b">" + members[0][0].split(b" ", 1)[0] + b"\n")
+        for header, seq in members:
+            clusters.write(b">" + header + b"\n" + seq + b"\n")
+
+    for family in range(families):
+        family_length = max(30, int(rng.normal(length, length / 4)))
+        seqs = amino_acids[family_sequences(family_length, parents, levels, mutation, rng)]
+        members = []
+        for i in np.flatnonzero(rng.random(species) < presence):
+            seq = seqs[i].tobytes()
+            members.append((add_protein(i, seq, f"family {family}"), seq))
+            if rng.random() < paralogs:
+                copy = seqs[i].copy()
+                changed = rng.random(family_length) < mutation
+                copy[changed] = amino_acids[rng.integers(0, 20, changed.sum())]
+                members.append((add_protein(i, copy.tobytes(), f"family {family} paralog"), copy.tobytes()))
+        if members:
+            write_cluster(members)
+    for i in range(species):
+        for _ in range(int(extra * families)):
+            seq = amino_acids[rng.integers(0, 20, max(30, int(rng.normal(length, length / 4))))].tobytes()
+            write_cluster([(add_protein(i, seq, "singleton"), seq)])
+    # the last cluster of all_seqs file is closed by a header (as in split_clusters.read_clusters)
+    clusters.write(b">end\n")
+    clusters.close()
+    for proteome in proteomes:
+        proteome.close()
+    species_list = os.path.join(directory, "species.txt")
+    with open(species_list, "w") as f:
+        f.writelines(f"species_{i}\n" for i in range(species))
+    with open(f"{species_list}.paths", "w") as f:
+        f.writelines(f"{path}\n" for path in paths)
+    return f"{species_list}.paths"
+
+
+def stub_aligner(directory):
+    # 'clustalw' found first in PATH is the stub
+    bin_dir = os.path.join(directory, "bin")
+    os.makedirs(bin_dir, exist_ok=True)
+    path = os.path.join(bin_dir, "clustalw")
+    with open(path, "w") as f:
+        f.write(stub_clustalw)
+    os.chmod(path, 0o755)
+    os.environ["PATH"] = f"{bin_dir}{os.pathsep}{os.environ['PATH']}"
+
+
+@contextlib.contextmanager
+def timed(results, step):
+    # output of the step is hidden
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+    results[step] = round(time.perf_counter() - start, 4)
+
+
+def run_scale(directory, species, families, args):
+    result = {"species": species, "families": families}
+    start = time.perf_counter()
+    paths = synthetic_proteomes(directory, species, families, args.length[0], args.presence[0],
+                                args.paralogs[0], args.extra[0], args.mutation[0], args.seed[0])
+    result["generate"] = round(time.perf_counter() - start, 4)
+    threads = args.threads[0]
+    output = os.path.join(directory, f"species_merged{species}")
+    with timed(result, "merge"):
+        merged = process_paths(paths, threads, 6, None, None)
+    result["merged_bytes"] = os.path.getsize(merged)
+    os.makedirs(os.path.join(output, "nonpara"), exist_ok=True)
+    os.makedirs(os.path.join(output, "para"), exist_ok=True)
+    with timed(result, "split"):
+        process_clusters(f"{output}_all_seqs.fasta", output, max(3, int(0.3 * species)), threads)
+    np_txt = os.path.join(output, "np.txt")
+    with open(np_txt) as f:
+        result["clusters"] = sum(1 for line in f if line.strip())
+    mode = {"stub": 0, "clustalw": 0, "muscle": 1, "mafft": 2}[args.msa[0]]
+    if args.direct:
+        with timed(result, "msa"):
+            process_fasta2MSA(np_txt, False, mode, threads, None, "none", ("identity", "nj", 0, 1))
+        result["nj"] = 0.0
+    else:
+        with timed(result, "msa"):
+            process_fasta2MSA(np_txt, False, mode, threads)
+        with timed(result, "nj"):
+            process_alignments(alignment_list(np_txt), threads)
+    with timed(result, "consensus"):
+        run_consensus.main(os.path.join(output, "nonpara"), paths[:-len(".paths")], 0.5, "splits", threads)
+    return result
+
+
+def scaling(results, step):
+    # exponents of species and families in time ~ species^a * families^b
+    columns = [name for name in ("species", "families") if len({r[name] for r in results}) > 1]
+    if not columns:
+        return {}
+    x = np.array([[1.0] + [np.log(r[name]) for name in columns] for r in results])
+    y = np.log([max(r[step], 1e-6) for r in results])
+    fit = np.linalg.lstsq(x, y, rcond=None)[0]
+    return dict(zip(columns, fit[1:]))
+
+
+def report(results):
+    print(f"\n{'species':>8}{'families':>9}{'clusters':>9}{'generate':>10}" + "".join(f"{s:>11}" for s in steps))
+    for r in results:
+        print(f"{r['species']:>8}{r['families']:>9}{r['clusters']:>9}{r['generate']:>9.2f}s"
+              + "".join(f"{r[s]:>10.3f}s" for s in steps))
+    print(f"\nScaling exponents (time ~ species^a * families^b):\n{'step':>10}{'a':>8}{'b':>8}")
+    for s in steps:
+        fit = scaling(results, s)
+        print(f"{s:>10}" + "".join(f"{fit[name]:>8.2f}" if name in fit else f"{'-':>8}" for name in ("species", "families")))
+
+
+def main():
+    args = parse_args()
+    print(f"{' '*12}> Benchmark pipeline steps < \n\n{'#'*20}START{'#'*20}")
+    print(f"\nMSA:\t\t{args.msa[0]}\ndirect:\t\t{args.direct}\nthreads:\t{args.threads[0]}")
+    work_dir = args.dir[0] if args.dir else tempfile.mkdtemp(prefix="ect_bench_")
+    if args.msa[0] == "stub":
+        stub_aligner(work_dir)
+    results = []
+    try:
+        for species in args.species:
+            for families in args.families:
+                directory = os.path.join(work_dir, f"s{species}_f{families}")
+                shutil.rmtree(directory, ignore_errors=True)
+                os.makedirs(directory)
+                result = run_scale(directory, species, families, args)
+                result.update(msa_mode=args.msa[0], direct=args.direct, threads=args.threads[0])
+                results.append(result)
+                print(f"species {species}, families {families}: " + ", ".join(f"{s} {result[s]:.3f}s" for s in steps), flush=True)
+                if args.o:
+                    with open(args.o[0], "a") as f:
+                        f.write(json.dumps(result) + "\n")
+                if not args.dir:
+                    shutil.rmtree(directory, ignore_errors=True)
+    finally:
+        if not args.dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    report(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+"""
+Bootstrap support of NJ gene trees.
+
+Replicates are drawn as NumPy index arrays of alignment columns and turned into column
+weights (how many times each column was drawn), so the encoded alignment is never copied;
+distance matrices of a batch of replicates are computed at once (identity_distances_batch)
+and a tree is built for every replicate with the fast NJ engine. Support of a clade is the
+fraction of replicate trees containing its bipartition (trees are compared as unrooted,
+bipartitions are integer bitmasks of leaves).
+"""
+
+import zlib
+import numpy as np
+from identity_distance import identity_distances_batch
+from fast_nj import build_tree
+
+
+def alignment_rng(seed, name):
+    # the same replicates for the same alignment, regardless of order of processing
+    return np.random.default_rng([seed, zlib.crc32(str(name).encode())])
+
+
+def resample_weights(length, replicates, rng):
+    """Return (replicates x length) matrix of column counts of bootstrap samples."""
+    columns = rng.integers(0, length, size=(replicates, length))
+    columns += (np.arange(replicates) * length)[:, None]
+    return np.bincount(columns.ravel(), minlength=replicates * length).reshape(replicates, length)
+
+
+def clade_splits(tree, index):
+    """Return list of (clade, bipartition) for internal clades of the tree (root excluded)."""
+    full = (1 << len(index)) - 1
+    leafsets = {}
+    splits = []
+    for clade in tree.find_clades(order="postorder"):
+        if clade.is_terminal():
+            leafsets[id(clade)] = 1 << index[clade.name]
+            continue
+        leafset = 0
+        for child in clade.clades:
+            leafset |= leafsets[id(child)]
+        leafsets[id(clade)] = leafset
+        if clade is not tree.root:
+            # side without the first leaf
+            splits.append((clade, full & ~leafset if leafset & 1 else leafset))
+    return splits
+
+
+def bootstrap_support(tree, names, codes, replicates=100, gaps="identity", engine="nj", rng=None, batch=16):
+    """Set clade.confidence (0-1) of internal clades of NJ tree built from encoded alignment."""
+    if rng is None:
+        rng = np.random.default_rng()
+    index = {name: i for i, name in enumerate(names)}
+    targets = clade_splits(tree, index)
+    counts = {split: 0 for _, split in targets}
+    length = codes.shape[1]
+    for start in range(0, replicates, batch):
+        weights = resample_weights(length, min(batch, replicates - start), rng)
+        for dist in identity_distances_batch(codes, weights, gaps):
+            found = {split for _, split in clade_splits(build_tree(names, dist, engine), index)}
+            for split in found.intersection(counts):
+                counts[split] += 1
+    for clade, split in targets:
+        clade.confidence = counts[split] / replicates
+    return tree
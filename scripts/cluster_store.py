@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+
+"""
+Script Name: cluster_store.py
+
+Description:
+Indexed single-file storage of clusters, used instead of thousands of small files in
+[name]/nonpara and [name]/para directories. Every kind of data is kept in two files
+in the store directory ([name]/store):
+
+> [kind].pack  - texts of all entries written one after another
+> [kind].idx   - TSV index: cluster ID \t offset \t length (in bytes)
+
+Kinds used by the pipeline:
+> np   - nonparalogous clusters (fasta), key: np_[p]_[n]   (split_clusters.py)
+> pa   - clusters with paralogs (fasta), key: pa_[p]_[n]   (split_clusters.py)
+> aln  - alignments (clustal), key: np_[p]_[n]             (run_MSA.py)
+> nwk  - NJ trees (newick), key: np_[p]_[n]                (run_NJ_on_alignment.py)
+> seq  - sequences of merged proteomes (one line, without header), key: unified id
+         (index_sequences(), used by split_clusters.py with _cluster.tsv input)
+
+Entries are only appended (under lock of the index file); when the same ID is written
+again, the last entry wins. Pack files are read by memory mapping.
+
+Usage (export to the file-per-cluster layout):
+    python cluster_store.py [name]/store -export [name]
+"""
+
+import os
+import mmap
+import gzip
+import fcntl
+import argparse
+import threading
+
+kinds={"np":("nonpara",".fasta"),"pa":("para",".fasta"),"aln":("nonpara",".aln"),"nwk":("nonpara","_njtree.nwk")}
+
+
+def is_store(path):
+    return os.path.isdir(path) and os.path.isfile(os.path.join(path,"np.idx"))
+
+
+class ClusterStore:
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.indexes = {}
+        self.maps = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, kind, suffix):
+        return os.path.join(self.directory, f"{kind}.{suffix}")
+
+    def index(self, kind):
+        # cluster ID -> (offset, length); read once, updated by put()
+        if kind not in self.indexes:
+            index = {}
+            if os.path.isfile(self._path(kind, "idx")):
+                with open(self._path(kind, "idx"), "r") as f:
+                    for line in f:
+                        line = line.rstrip("\n").split("\t")
+                        if len(line) == 3:
+                            index[line[0]] = (int(line[1]), int(line[2]))
+            self.indexes[kind] = index
+        return self.indexes[kind]
+
+    def keys(self, kind):
+        return list(self.index(kind))
+
+    def __contains__(self, item):
+        kind, key = item
+        return key in self.index(kind)
+
+    def _map(self, kind, end):
+        # mapping is made again when the pack file grew since the last read
+        pack = self.maps.get(kind)
+        if pack is None or len(pack) < end:
+            if pack is not None:
+                pack.close()
+            with open(self._path(kind, "pack"), "rb") as f:
+                pack = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[kind] = pack
+        return pack
+
+    def get(self, kind, key):
+        offset, length = self.index(kind)[key]
+        return self.read(kind, offset, length)
+
+    def read(self, kind, offset, length):
+        if length == 0:
+            return ""
+        with self.lock:
+            return self._map(kind, offset + length)[offset:offset + length].decode("utf-8")
+
+    def lookup(self, kind, keys):
+        # (offset, length) of selected keys only, without keeping the whole index in memory
+        found = {}
+        if os.path.isfile(self._path(kind, "idx")):
+            with open(self._path(kind, "idx"), "r") as f:
+                for line in f:
+                    line = line.rstrip("\n").split("\t")
+                    if len(line) == 3 and line[0] in keys:
+                        found[line[0]] = (int(line[1]), int(line[2]))
+        return found
+
+    def put_many(self, kind, items):
+        # the same as put() for every (key, text), but files are opened and locked once;
+        # index in memory is not updated (use lookup() or reload with index())
+        count = 0
+        with self.lock:
+            with open(self._path(kind, "idx"), "a", buffering=1024*1024) as idx, \
+                    open(self._path(kind, "pack"), "ab", buffering=1024*1024) as pack:
+                fcntl.flock(idx, fcntl.LOCK_EX)
+                try:
+                    offset = pack.seek(0, os.SEEK_END)
+                    for key, text in items:
+                        data = text.encode("utf-8")
+                        pack.write(data)
+                        idx.write(f"{key}\t{offset}\t{len(data)}\n")
+                        offset += len(data)
+                        count += 1
+                    pack.flush()
+                    idx.flush()
+                finally:
+                    fcntl.flock(idx, fcntl.LOCK_UN)
+            self.indexes.pop(kind, None)
+        return count
+
+    def put(self, kind, key, text):
+        data = text.encode("utf-8")
+        index = self.index(kind)
+        with self.lock:
+            with open(self._path(kind, "idx"), "a") as idx, open(self._path(kind, "pack"), "ab") as pack:
+                # the lock of index file keeps offsets right also with many writing processes
+                fcntl.flock(idx, fcntl.LOCK_EX)
+                try:
+                    offset = pack.seek(0, os.SEEK_END)
+                    pack.write(data)
+                    pack.flush()
+                    idx.write(f"{key}\t{offset}\t{len(data)}\n")
+                    idx.flush()
+                finally:
+                    fcntl.flock(idx, fcntl.LOCK_UN)
+            index[key] = (offset, len(data))
+
+    def clear(self, kind):
+        with self.lock:
+            for suffix in ("pack", "idx"):
+                if os.path.isfile(self._path(kind, suffix)):
+                    os.remove(self._path(kind, suffix))
+            self.indexes[kind] = {}
+            pack = self.maps.pop(kind, None)
+            if pack is not None:
+                pack.close()
+
+    def close(self):
+        for pack in self.maps.values():
+            pack.close()
+        self.maps = {}
+
+    def export(self, output_dir, kind_list=None):
+        """Write entries as separate files ([output_dir]/nonpara/np_[p]_[n].fasta, ...)."""
+        written = {}
+        for kind in kind_list or kinds:
+            subdir, suffix = kinds[kind]
+            os.makedirs(os.path.join(output_dir, subdir), exist_ok=True)
+            for key in self.keys(kind):
+                with open(os.path.join(output_dir, subdir, key + suffix), "w") as f:
+                    f.write(self.get(kind, key))
+            written[kind] = len(self.index(kind))
+        return written
+
+
+def fasta_records(path):
+    # (first word of header, sequence joined to one line) for .fasta or .fasta.gz file
+    opener = gzip.open if path.endswith(".gz") else open
+    name = None
+    seq = []
+    with opener(path, "rt") as f:
+        for line in f:
+            if line[:1] == ">":
+                if name is not None:
+                    yield name, "".join(seq)
+                fields = line[1:].split(None, 1)
+                name = fields[0] if fields else ""
+                seq = []
+            elif name is not None:
+                seq.append(line.strip())
+    if name is not None:
+        yield name, "".join(seq)
+
+
+def index_sequences(fasta_path, store):
+    """Copy sequences of merged proteomes to store (kind 'seq'), unless it's newer than fasta_path."""
+    idx = store._path("seq", "idx")
+    if os.path.isfile(idx) and os.path.getmtime(idx) >= os.path.getmtime(fasta_path):
+        return False
+    store.clear("seq")
+    store.put_many("seq", fasta_records(fasta_path))
+    return True
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+    description="""Show content of cluster store ([name]/store made by split_clusters.py -store)
+    or export it to the file-per-cluster layout: [name]/nonpara (np_*.fasta, .aln, _njtree.nwk)
+    and [name]/para (pa_*.fasta)""")
+    parser.add_argument('input', type=str, nargs=1, help="Path to the cluster store directory")
+    parser.add_argument('-export', metavar='DIR', type=str, nargs=1, help="""Output directory
+        for exported files (default: don't export)""", default=None)
+    parser.add_argument('-kinds', type=str, nargs='+', choices=list(kinds), help="""Kinds of entries
+        to export (default: all)""", default=None)
+    args = parser.parse_args()
+    if not is_store(args.input[0]):
+        print(f"Provide cluster store: {args.input[0]} doesn't contain np.idx file")
+        return None
+    return [args.input[0], args.export[0] if args.export else None, args.kinds]
+
+
+def main():
+    inputs = parse_args()
+    if not inputs is None:
+        print(f"{' '*14}> Cluster store < \n\n{'#'*20}START{'#'*20}")
+        store = ClusterStore(inputs[0])
+        print(f"\nStore directory:\t{inputs[0]}")
+        for kind in kinds:
+            print(f"{kind}:\t\t\t{len(store.index(kind))} entries")
+        if inputs[1]:
+            written = store.export(inputs[1], inputs[2])
+            print(f"\nExported to:\t\t{inputs[1]}")
+            for kind, count in written.items():
+                print(f"{kind}:\t\t\t{count} files")
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
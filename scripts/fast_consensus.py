@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+"""
+Streaming majority-rule consensus of gene trees.
+
+Trees are not kept in memory: every newick is tokenized once, each branch is turned into
+an integer bitmask of taxa (bit = position of taxon in the shared taxon namespace) and
+the split counts are accumulated in a dictionary. Counters of separate worker processes
+are merged by adding counts, as long as they use the same taxon namespace order.
+
+The result is the same as of dendropy.TreeList.consensus() used before:
+> taxon namespace order - taxa in order of first appearance (leaves read left to right,
+                          trees in the given order),
+> splits                - all branches, also terminal ones and the root branch; in unrooted
+                          trees the basal bifurcation is collapsed and the bitmask is normalized
+                          to the side without the first taxon of the tree (trees can have
+                          incomplete leaf sets), nodes with one child are suppressed,
+> consensus tree        - built by dendropy.SplitDistribution from the same counts.
+"""
+
+import re
+import dendropy
+
+tokens=re.compile(r"\[[^\]]*\]|'(?:[^']|'')*'|[(),:;]|[^\s(),:;\[\]']+")
+
+
+def newick_label(token):
+    if token[0]=="'":
+        return token[1:-1].replace("''","'")
+    return token
+
+
+def parse_newick(text, leaf_bit=None):
+    """Return (leaf labels in order of appearance, leaf set of every branch, root children, is_rooted);
+    bits of leaves are given by leaf_bit(label), by default i-th leaf has i-th bit."""
+    is_rooted=False
+    leaves=[]
+    branches=[]
+    # stack of open nodes - list of (leaf set, is internal) of their children
+    stack=[[]]
+    root_children=[]
+    previous="("
+    for token in tokens.findall(text):
+        if token[0]=="[":
+            if token.upper()=="[&R]":
+                is_rooted=True
+            continue
+        if token=="(":
+            stack.append([])
+        elif token==")":
+            children=stack.pop()
+            if len(stack)==1:
+                root_children=children
+            if len(children)==1:
+                # node with one child is suppressed (but it's still not internal node
+                # for collapsing of basal bifurcation, which is done before)
+                stack[-1].append((children[0][0],False))
+            else:
+                leafset=0
+                for child,_ in children:
+                    leafset|=child
+                branches.append(leafset)
+                stack[-1].append((leafset,True))
+        elif token==";":
+            break
+        elif token in (",",":"):
+            pass
+        elif previous in ("(",","):
+            # label after ")" is internal node label, after ":" branch length
+            label=newick_label(token)
+            bit=leaf_bit(label) if leaf_bit else 1<<len(leaves)
+            leaves.append(label)
+            branches.append(bit)
+            stack[-1].append((bit,False))
+            if len(stack)==1:
+                root_children=[(bit,False)]
+        previous=token
+    if not leaves:
+        raise ValueError("Empty newick tree")
+    return leaves,branches,root_children,is_rooted
+
+
+class SplitCounter:
+    def __init__(self, taxa_list, order=None):
+        self.taxa_list=taxa_list
+        self.labels=[]
+        self.bits={}
+        self.counts={}
+        self.trees=0
+        self.rootings=set()
+        for name in order or []:
+            self.taxon_bit(name)
+
+    def taxon_bit(self, name):
+        # taxa are unified by label regardless of case (as in dendropy.TaxonNamespace)
+        key=name.lower()
+        if key not in self.bits:
+            self.bits[key]=len(self.labels)
+            self.labels.append(name)
+        return self.bits[key]
+
+    def taxon_name(self, label):
+        # gene trees have indices of taxa_list as leaf names
+        return self.taxa_list[int(label)]
+
+    def add_newick(self, text):
+        # new taxa are added to the namespace while reading leaves from left to right
+        leaf_bit=lambda label: 1<<self.taxon_bit(self.taxon_name(label))
+        leaves,splits,root_children,is_rooted=parse_newick(text,leaf_bit)
+        if not is_rooted and len(root_children)==2 and any(internal for _,internal in root_children):
+            # collapse of basal bifurcation: both root branches give the same split, one is counted
+            splits.remove(root_children[0][0])
+        tree_leafset=0
+        for split in splits:
+            tree_leafset|=split
+        lowest=tree_leafset&-tree_leafset
+        counts=self.counts
+        for split in splits:
+            if not is_rooted and split&lowest:
+                split=~split&tree_leafset
+            counts[split]=counts.get(split,0)+1
+        self.trees+=1
+        self.rootings.add(is_rooted)
+
+    def update(self, other):
+        if self.labels!=other.labels[:len(self.labels)]:
+            raise ValueError("Split counters with different taxon namespace order can't be merged")
+        for name in other.labels[len(self.labels):]:
+            self.taxon_bit(name)
+        counts=self.counts
+        for split,count in other.counts.items():
+            counts[split]=counts.get(split,0)+count
+        self.trees+=other.trees
+        self.rootings|=other.rootings
+
+    def split_distribution(self):
+        taxon_namespace=dendropy.TaxonNamespace(self.labels)
+        distribution=dendropy.SplitDistribution(taxon_namespace=taxon_namespace)
+        for split,count in self.counts.items():
+            distribution.split_counts[split]=float(count)
+        distribution.total_trees_counted=self.trees
+        distribution.sum_of_tree_weights=float(self.trees)
+        distribution.tree_rooting_types_counted=set(self.rootings)
+        return distribution
+
+    def consensus_tree(self, min_freq):
+        return self.split_distribution().consensus_tree(min_freq=min_freq)
+
+
+def taxon_order(texts, taxa_list):
+    """Taxon namespace order for the trees (stops when all taxa from taxa_list were seen)."""
+    counter=SplitCounter(taxa_list)
+    all_taxa=len({name.lower() for name in taxa_list})
+    for text in texts:
+        for label in parse_newick(text)[0]:
+            counter.taxon_bit(counter.taxon_name(label))
+        if len(counter.labels)>=all_taxa:
+            break
+    return counter.labels
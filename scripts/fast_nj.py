@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+"""
+NumPy neighbor-joining engines.
+
+> nj     - the same algorithm as Bio.Phylo.TreeConstruction.DistanceTreeConstructor().nj,
+           including order of summation, pair scan order, tie breaking and the way the
+           last two nodes are joined, so it returns identical trees (also branch lengths);
+           every iteration is done with whole-matrix operations instead of python loops
+> bionj  - BIONJ variant (Gascuel 1997): the same pair selection and branch lengths, but
+           distances to the new node are weighted by a variance matrix
+
+The working matrix is kept in place (joined node replaces one of the pair, the other one
+is marked as removed) and it is compacted when more than half of it is removed.
+"""
+
+import numpy as np
+from Bio.Phylo import BaseTree
+from Bio.Phylo.TreeConstruction import DistanceMatrix, DistanceTreeConstructor
+
+engines=["biopython","nj","bionj"]
+
+
+def full_matrix(distance_matrix):
+    """Return names and symmetric (n x n) numpy matrix of Bio.Phylo DistanceMatrix."""
+    n=len(distance_matrix)
+    dist=np.zeros((n,n))
+    for i,row in enumerate(distance_matrix.matrix):
+        dist[i,:i+1]=row
+    dist=np.tril(dist,-1)
+    return list(distance_matrix.names),dist+dist.T
+
+
+def _compact(dist,var,alive,clades):
+    keep=np.flatnonzero(alive)
+    dist=dist[np.ix_(keep,keep)]
+    if var is not None:
+        var=var[np.ix_(keep,keep)]
+    clades=[clades[k] for k in keep]
+    alive=np.ones(len(keep),dtype=bool)
+    return dist,var,alive,clades
+
+
+def neighbor_joining(names,dist,variant="nj"):
+    """Build NJ (or BIONJ) tree from names and full symmetric distance matrix."""
+    if variant not in ("nj","bionj"):
+        raise ValueError(f"Unknown NJ variant: {variant}")
+    dist=np.array(dist,dtype=np.float64)
+    clades=[BaseTree.Clade(None,name) for name in names]
+    n=len(clades)
+    if n==1:
+        return BaseTree.Tree(clades[0],rooted=False)
+    elif n==2:
+        clade1=clades[1]
+        clade2=clades[0]
+        clade1.branch_length=float(dist[1,0]/2.0)
+        clade2.branch_length=float(dist[1,0]-clade1.branch_length)
+        inner_clade=BaseTree.Clade(None,"Inner")
+        inner_clade.clades.append(clade1)
+        inner_clade.clades.append(clade2)
+        return BaseTree.Tree(inner_clade,rooted=False)
+
+    var=dist.copy() if variant=="bionj" else None
+    alive=np.ones(n,dtype=bool)
+    m=n
+    inner_count=0
+    inner_clade=None
+    while m>2:
+        if m*2<len(alive):
+            dist,var,alive,clades=_compact(dist,var,alive,clades)
+        # removed rows/columns are zero, so sequential sums (cumsum) give the same
+        # floating point values as summing row by row over the remaining nodes
+        node_dist=np.cumsum(dist,axis=1)[:,-1]/(m-2)
+        q=(dist-node_dist[:,None])-node_dist[None,:]
+        invalid=np.triu(np.ones(q.shape,dtype=bool))
+        invalid[~alive,:]=True
+        invalid[:,~alive]=True
+        q[invalid]=np.inf
+        # the first minimum in row-major order of lower triangle, as in biopython scan
+        min_i,min_j=np.unravel_index(np.argmin(q),q.shape)
+        active=np.flatnonzero(alive[:2+min_i])
+        if min_i==active[1] and min_j==active[0]:
+            # biopython starts the scan from pair (0,1), which is kept unless a strictly smaller value is found
+            min_i,min_j=active[0],active[1]
+
+        clade1=clades[min_i]
+        clade2=clades[min_j]
+        inner_count+=1
+        inner_clade=BaseTree.Clade(None,"Inner"+str(inner_count))
+        inner_clade.clades.append(clade1)
+        inner_clade.clades.append(clade2)
+        d_ij=dist[min_i,min_j]
+        clade1.branch_length=float((d_ij+node_dist[min_i]-node_dist[min_j])/2.0)
+        clade2.branch_length=float(d_ij-clade1.branch_length)
+
+        others=alive.copy()
+        others[[min_i,min_j]]=False
+        if var is None:
+            new_row=(dist[min_i]+dist[min_j]-d_ij)/2.0
+        else:
+            v_ij=var[min_i,min_j]
+            if v_ij==0:
+                lam=0.5
+            else:
+                lam=0.5+np.sum(var[min_j,others]-var[min_i,others])/(2*(m-2)*v_ij)
+                lam=min(1.0,max(0.0,lam))
+            new_row=lam*(dist[min_i]-clade1.branch_length)+(1-lam)*(dist[min_j]-clade2.branch_length)
+            new_var=lam*var[min_i]+(1-lam)*var[min_j]-lam*(1-lam)*v_ij
+            new_var[~others]=0
+            var[min_j,:]=new_var
+            var[:,min_j]=new_var
+            var[min_i,:]=0
+            var[:,min_i]=0
+        new_row[~others]=0
+        dist[min_j,:]=new_row
+        dist[:,min_j]=new_row
+        dist[min_i,:]=0
+        dist[:,min_i]=0
+        clades[min_j]=inner_clade
+        alive[min_i]=False
+        m-=1
+
+    first,second=np.flatnonzero(alive)
+    if clades[first] is inner_clade:
+        clades[first].branch_length=0
+        clades[second].branch_length=float(dist[second,first])
+        clades[first].clades.append(clades[second])
+        root=clades[first]
+    else:
+        clades[first].branch_length=float(dist[second,first])
+        clades[second].branch_length=0
+        clades[second].clades.append(clades[first])
+        root=clades[second]
+    return BaseTree.Tree(root,rooted=False)
+
+
+def build_tree(names,dist,engine="nj"):
+    """Build tree from names and full distance matrix with selected engine."""
+    if engine=="biopython":
+        return DistanceTreeConstructor().nj(DistanceMatrix(names,[list(map(float,dist[i,:i+1])) for i in range(len(names))]))
+    elif engine not in engines:
+        raise ValueError(f"Unknown NJ engine: {engine}; available engines: {', '.join(engines)}")
+    return neighbor_joining(names,dist,engine)
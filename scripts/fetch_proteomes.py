@@ -19,6 +19,22 @@ import requests
 import subprocess
 import json
 import re
+import gzip
+import zlib
+import time
+import fcntl
+import shutil
+import zipfile
+import tempfile
+import threading
+import contextlib
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from taxon_library import TaxonLibrary
+from metadata_cache import MetadataCache, day
+import telemetry
 
 # Define default output dir - project_dir/proteome_database
 script_dir = os.path.dirname(os.path.realpath(__file__))
@@ -28,6 +44,12 @@ default_output_dir = os.path.join(project_dir, 'proteome_database')
 
 taxon_library=os.path.join("taxon_library.csv")
 
+# Base URLs of UniProt services; can be redirected (e.g. to a local stand-in server) with environment variables
+uniprot_rest=os.environ.get("ECT_UNIPROT_REST","https://rest.uniprot.org")
+uniprot_ftp=os.environ.get("ECT_UNIPROT_FTP","https://ftp.uniprot.org/pub/databases/uniprot/current_release/knowledgebase/reference_proteomes")
+# NCBI datasets command; can be replaced (e.g. by a stand-in script) with environment variable
+datasets_command=os.environ.get("ECT_DATASETS","datasets")
+
 
 def parse_args():
     parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, 
@@ -37,6 +59,14 @@ def parse_args():
         species names or organism IDs""")
     parser.add_argument('-o',metavar= 'o',nargs=1, help=f"""Directory where the proteome files will be saved;
          if not provided, save to {default_output_dir}""", default=default_output_dir)
+    parser.add_argument('-threads',metavar='INT',type=int,nargs=1,help="""Number of species resolved 
+        and downloaded concurrently (default: 1)""",default=1)
+    parser.add_argument('-rate',metavar='FLOAT',type=float,nargs=1,help="""Maximum number of HTTP requests 
+        per second sent to a single host (default: 5)""",default=5.0)
+    parser.add_argument('-ttl',metavar='DAYS',type=float,nargs=1,help=f"""Results of UniProt/NCBI searches are
+        cached in [output directory]/{cache_name} for DAYS days; 0 - don't use cache (default: 30)""",default=[30.0])
+    parser.add_argument('-negative_ttl',metavar='DAYS',type=float,nargs=1,help="""Species not found in UniProt/NCBI
+        are cached for DAYS days (default: 1)""",default=[1.0])
 
     args = parser.parse_args()
     in_file=""
@@ -58,8 +88,14 @@ def parse_args():
             out_dir=default_output_dir
     else:
         out_dir=args.o
+    if isinstance(args.threads,list):
+        args.threads=args.threads[0]
+    if isinstance(args.rate,list):
+        args.rate=args.rate[0]
+    if args.rate>0:
+        host_limiter.interval=1/args.rate
     if in_file:    
-        return[in_file,out_dir]
+        return[in_file,out_dir,max(1,args.threads),args.ttl[0],args.negative_ttl[0]]
     else:
         return None
 """
@@ -70,19 +106,112 @@ file taxon_library.csv contains data in format:
 
 scientificName/commonName/synonymName \t taxonID \t [Uniprot/NCBI]_proteome_ID \t fasta.gz name
 Homo sapiens                          \t 9606   \t UP000005640                \t ./proteome_datasets/UP000005640_9606.fasta.gz
+
+Library file is read only once per run (see taxon_library.py) - load_library() returns the same
+indexed library for every call with the same path.
 """
 
-def check_taxon(name):
-    with open(os.path.join(default_output_dir, taxon_library), "r") as f:
-        for line in f:
-            line=line.strip().split("\t")
-            if line[0].lower() ==str(name).lower() or line[0].lower().split("(")[0].strip() ==str(name).lower():
-                return line[3]
-            elif line[1]==str(name):
-                return line[3]
-            elif line[2]==name:
-                return line[3] 
-    return None
+libraries={}
+libraries_lock=threading.Lock()
+
+def load_library(library=None):
+    if library is None:
+        library=os.path.join(default_output_dir, taxon_library)
+    library=os.path.abspath(library)
+    with libraries_lock:
+        if library not in libraries:
+            libraries[library]=TaxonLibrary(library)
+    return libraries[library]
+
+def check_taxon(name,library=None):
+    return load_library(library).find(name)
+
+
+"""
+HTTP requests are sent through http_get(): every thread keeps its own requests.Session (connection reuse),
+failed requests (connection errors, 429 and 5xx responses) are retried with exponential backoff and 
+requests to a single host are spaced by HostRateLimiter.
+"""
+
+class HostRateLimiter:
+    def __init__(self, interval):
+        self.interval=interval
+        self.lock=threading.Lock()
+        self.next_time={}
+
+    def wait(self, host):
+        with self.lock:
+            now=time.monotonic()
+            start=max(now, self.next_time.get(host, now))
+            self.next_time[host]=start+self.interval
+        if start>now:
+            time.sleep(start-now)
+
+host_limiter=HostRateLimiter(0.2)
+sessions=threading.local()
+
+def http_session():
+    if not hasattr(sessions, "session"):
+        retry=Retry(total=5, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=["GET", "HEAD"], respect_retry_after_header=True, raise_on_status=False)
+        session=requests.Session()
+        session.mount("https://", HTTPAdapter(max_retries=retry))
+        session.mount("http://", HTTPAdapter(max_retries=retry))
+        sessions.session=session
+    return sessions.session
+
+def http_get(url, **kwargs):
+    host_limiter.wait(urlsplit(url).netloc)
+    return http_session().get(url, **kwargs)
+
+def http_head(url, **kwargs):
+    host_limiter.wait(urlsplit(url).netloc)
+    return http_session().head(url, allow_redirects=True, **kwargs)
+
+
+"""
+Results of UniProt and NCBI searches (also "not found") are kept in persistent cache (metadata_cache.py),
+when it's enabled by use_cache(); cached_lookup() returns cached result of the query or runs the search 
+and caches its result. Failed requests (search sets lookups.failed) are not cached.
+"""
+
+cache_name="metadata_cache.sqlite"
+metadata_cache=None
+lookups=threading.local()
+
+def use_cache(directory, ttl=30, negative_ttl=1):
+    # ttl, negative_ttl in days
+    global metadata_cache
+    os.makedirs(directory, exist_ok=True)
+    metadata_cache=MetadataCache(os.path.join(directory, cache_name), ttl*day, negative_ttl*day)
+    return metadata_cache
+
+def cache_get(source, query, id_type):
+    if metadata_cache is None:
+        return False, None
+    hit, value = metadata_cache.get(source, query, id_type)
+    if hit:
+        result=value["result"]
+        if value.get("domain"):
+            uniprot_domains[result[0]]=value["domain"]
+        print(f"{query}: {source} result from cache: {result}")
+        return True, result
+    return False, None
+
+def cache_put(source, query, id_type, result):
+    if metadata_cache is not None:
+        domain=uniprot_domains.get(result[0]) if result else None
+        metadata_cache.put(source, query, id_type, {"result":result, "domain":domain})
+
+def cached_lookup(source, query, id_type, search):
+    hit, result = cache_get(source, query, id_type)
+    if hit:
+        return result
+    lookups.failed=False
+    result=search(query, id_type)
+    if not lookups.failed:
+        cache_put(source, query, id_type, result)
+    return result
 
 
 def get_data_from_json_NCBI(results):
@@ -99,67 +228,208 @@ def get_data_from_json_NCBI(results):
     print(f"NCBI ID: {NCBIid}\ntaxonomy ID: {taxon}\nnames: {names}")
     return [NCBIid,taxon,names]
 
+"""
+Failed datasets call is a search without result ("not found", cached) only when datasets reports that
+nothing matches the query (or returns empty result); other failures (network, authentication, ...) are 
+failed lookups (datasets_missing() sets lookups.failed), which are not cached.
+"""
+
+datasets_failure=re.compile("api[ _-]?key|auth|connect|timeout|timed out|dial|network|proxy|tls|certificate|http|temporar",re.I)
+datasets_no_match=re.compile("not found|no (genome|assembl|record|match|data)|not (a )?(valid|recogni[sz]ed)|unrecogni[sz]ed",re.I)
+
+def datasets_missing(result):
+    if result.returncode==0:
+        return True
+    message=(result.stderr or b"").decode("utf-8",errors="replace").strip()
+    if datasets_no_match.search(message) and not datasets_failure.search(message):
+        return True
+    print(f"datasets failed (exit code {result.returncode}): {message}")
+    lookups.failed=True
+    return False
+
+def datasets_summary(kind,query,limit=True):
+    search_requests["datasets"]+=1
+    return subprocess.run([datasets_command, "summary", "genome", kind, *query]+(["--limit", "1"] if limit else [])+["--as-json-lines"],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
 def search_proteome_ncbi(species_name,id_type):
+    return cached_lookup("ncbi",species_name,id_type,query_proteome_ncbi)
+
+def query_proteome_ncbi(species_name,id_type):
     output=None
     if id_type==3: 
-        result = subprocess.run([f"datasets", "summary" , "genome" , "accession",f"{species_name}", "--limit", "1", "--as-json-lines" ], # 
-            stdout=subprocess.PIPE)
-        if result.returncode==0:
+        result = datasets_summary("accession",[species_name])
+        if result.returncode==0 and result.stdout.strip():
             output = get_data_from_json_NCBI(result.stdout)
         else:
+            datasets_missing(result)
             print(f"NCBI accession {species_name} not found in NCBI database")
     elif id_type==0 or id_type==1:
-        result = subprocess.run([f"datasets", "summary" , "genome" , "taxon",f"{species_name}", "--limit", "1", "--as-json-lines" ], # 
-            stdout=subprocess.PIPE)
-        if result.returncode==0:
+        result = datasets_summary("taxon",[species_name])
+        if result.returncode==0 and result.stdout.strip():
             output = get_data_from_json_NCBI(result.stdout)
         else:
+            datasets_missing(result)
             if id_type==0:
                 print(f"name: {species_name} not found in NCBI database")
             else:
                 print(f"Taxom id: {species_name} not found in NCBI database")
     else:
-        result = subprocess.run([f"datasets", "summary" , "genome" , "accession",f"{species_name}", "--limit", "1", "--as-json-lines" ], # 
-            stdout=subprocess.PIPE)
-        if result.returncode==0:
+        result = datasets_summary("accession",[species_name])
+        if result.returncode==0 and result.stdout.strip():
             output = get_data_from_json_NCBI(result.stdout)
         else:
-            result = subprocess.run([f"datasets", "summary" , "genome" , "taxon",f"{species_name}", "--limit", "1", "--as-json-lines" ], # 
-                stdout=subprocess.PIPE)
-            if result.returncode==0:
+            datasets_missing(result)
+            result = datasets_summary("taxon",[species_name])
+            if result.returncode==0 and result.stdout.strip():
                 output = get_data_from_json_NCBI(result.stdout)
             else:
+                datasets_missing(result)
                 print(f"name {species_name} not found in NCBI database")
     return output
 
+"""
+Function search_ncbi_batch() resolves many queries (name, id_type) of search_proteome_ncbi() at once:
+accessions (id_type 3, and ambiguous names - id_type 4 - which are tried as accession first) are passed
+to one `datasets summary genome accession` call per ncbi_batch accessions and records are mapped back
+by accession (current, paired or without version); when the whole call fails, the batch is split in
+halves to find the wrong accession. Taxa are searched one by one (datasets takes one taxon per call).
+Queries of calls which failed for other reason than no match (see datasets_missing()) are not cached.
+"""
+
+ncbi_batch=100
+search_requests={"uniprot":0,"datasets":0}
+
+def accession_keys(accession):
+    return {accession, accession.split(".")[0]}
+
+def ncbi_accessions(accessions, failed):
+    # {accession: result}; accessions of failed calls are added to failed
+    result = datasets_summary("accession", accessions, limit=False)
+    lines=[line for line in result.stdout.splitlines() if line.strip()]
+    if result.returncode!=0 and not lines:
+        if not datasets_missing(result):
+            failed.update(accessions)
+            return {}
+        if len(accessions)>1:
+            half=len(accessions)//2
+            return {**ncbi_accessions(accessions[:half], failed), **ncbi_accessions(accessions[half:], failed)}
+    records={}
+    for line in lines:
+        record=json.loads(line)
+        for field in ("accession","current_accession","paired_accession"):
+            if record.get(field):
+                for key in accession_keys(record[field]):
+                    records.setdefault(key,line)
+    found={}
+    for accession in accessions:
+        line=records.get(accession, records.get(accession.split(".")[0]))
+        if line is not None:
+            found[accession]=get_data_from_json_NCBI(line)
+    return found
+
+def search_ncbi_batch(queries):
+    found={}
+    searched=[]
+    for name,id_type in queries:
+        hit,result=cache_get("ncbi",name,id_type)
+        if not hit:
+            searched.append((name,id_type))
+        elif result is not None:
+            found[(name,id_type)]=result
+    queries=searched
+    accessions=list(dict.fromkeys(name for name,id_type in queries if id_type in (3,4)))
+    failed=set()
+    for start in range(0,len(accessions),ncbi_batch):
+        records=ncbi_accessions(accessions[start:start+ncbi_batch], failed)
+        for name,id_type in queries:
+            if id_type in (3,4) and name in records:
+                found[(name,id_type)]=records[name]
+    for name,id_type in queries:
+        if (name,id_type) in found:
+            continue
+        if id_type==3:
+            print(f"NCBI accession {name} not found in NCBI database")
+            continue
+        result = datasets_summary("taxon", [name])
+        if result.returncode==0 and result.stdout.strip():
+            found[(name,id_type)]=get_data_from_json_NCBI(result.stdout)
+            continue
+        if not datasets_missing(result):
+            failed.add(name)
+        if id_type==2:
+            print(f"Taxom id: {name} not found in NCBI database")
+        else:
+            print(f"name {name} not found in NCBI database")
+    for name,id_type in queries:
+        if (name,id_type) in found or name not in failed:
+            cache_put("ncbi",name,id_type,found.get((name,id_type)))
+    return found
+
+"""
+Function fetch_proteome_ncbi() downloads the archive to scratch directory of the run (TMPDIR, see ect.sh),
+protein.faa from it is compressed to a temporary file in output_directory and renamed, so other runs
+using the same database never see a partial proteome.
+"""
+
 def fetch_proteome_ncbi(proteome_id, taxon, names, output_directory):
-    tmp_zip = os.path.join(output_directory, "tmp.zip")
-    tmp = os.path.join(output_directory, "tmp")
-    protein_faa = os.path.join(output_directory, "tmp", "ncbi_dataset", "data", proteome_id, "protein.faa")
+    tmp = tempfile.mkdtemp(prefix="ect_ncbi_")
+    tmp_zip = os.path.join(tmp, f"{proteome_id}.zip")
+    protein_faa = f"ncbi_dataset/data/{proteome_id}/protein.faa"
     proteome_id_fasta = os.path.join(output_directory, f"{proteome_id.replace('.','_')}.fasta")
-    taxon_lib = os.path.join(output_directory, taxon_library)
-
-    result = subprocess.run([f"datasets", "download" , "genome" , "accession", f"{proteome_id}", "--filename", tmp_zip, "--include", "protein"], stdout=subprocess.PIPE)
-    if result.returncode == 0:
-        os.system(f"unzip {tmp_zip} -d {tmp}")
-        os.system(f"mv {protein_faa} {proteome_id_fasta}")
-        os.system(f"gzip {proteome_id_fasta}")
-        os.system(f"rm -r {tmp}")
-        os.system(f"rm {tmp_zip}")
-        for name in names:
-            print(f"Updating library file with name '{name}'")
-            os.system(f"""echo "{name}\t{taxon}\t{proteome_id}\t{proteome_id_fasta}.gz" >> {taxon_lib}""")
-        return proteome_id.replace('.','_')
-    else:
-        print(f"NCBI accession {proteome_id} not found in NCBI database")
-    return None
+    library = load_library(os.path.join(output_directory, taxon_library))
+
+    try:
+        with telemetry.task("download", proteome_id) as t:
+            result = telemetry.run([datasets_command, "download" , "genome" , "accession", f"{proteome_id}", "--filename", tmp_zip, "--include", "protein"], stdout=subprocess.PIPE)
+            if result.returncode == 0:
+                t.add(bytes=os.path.getsize(tmp_zip))
+            else:
+                t.add(status=f"exit code {result.returncode}")
+        if result.returncode != 0:
+            print(f"NCBI accession {proteome_id} not found in NCBI database")
+            return None
+        part = f"{proteome_id_fasta}.gz.{os.getpid()}.part"
+        try:
+            with zipfile.ZipFile(tmp_zip) as archive, archive.open(protein_faa) as src, gzip.open(part, "wb", compresslevel=6) as out:
+                shutil.copyfileobj(src, out, 1024 * 1024)
+        except (KeyError, zipfile.BadZipFile) as e:
+            print(f"No proteins of NCBI accession {proteome_id} in downloaded archive: {e}")
+            if os.path.isfile(part):
+                os.remove(part)
+            return None
+        os.replace(part, f"{proteome_id_fasta}.gz")
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    for name in names:
+        print(f"Updating library file with name '{name}'")
+        library.add(name, taxon, proteome_id, f"{proteome_id_fasta}.gz")
+    return proteome_id.replace('.','_')
 
 
 """
 Searches for the proteome of a species in UniProt and returns the ID.
 """
+uniprot_domains={}
+domain_names={"archaea":"Archaea","bacteria":"Bacteria","eukaryota":"Eukaryota","viruses":"Viruses"}
+
+def get_domain_UniProt(response):
+    # directory of reference proteome on UniProt FTP, taken from search metadata (if present)
+    domain=response.get("superkingdom")
+    if not domain:
+        for taxon in response.get("taxonLineage",[]):
+            if taxon.get("scientificName","").lower() in domain_names:
+                domain=taxon["scientificName"]
+                break
+    if domain:
+        return domain_names.get(domain.lower())
+    return None
+
 def get_data_from_json_UniProt(response):
     UPid=response["id"]
+    domain=get_domain_UniProt(response)
+    if domain:
+        uniprot_domains[UPid]=domain
     taxon=response["taxonomy"]["taxonId"]
     names=[response["taxonomy"]["scientificName"]]
     if "commonName" in response["taxonomy"].keys():
@@ -171,69 +441,176 @@ def get_data_from_json_UniProt(response):
 
 
 def search_proteome_uniprot(species_name,id_type):
+    return cached_lookup("uniprot",species_name,id_type,query_proteome_uniprot)
+
+def uniprot_first(lines,species_name,id_type):
+    # the most relevant record; a virus is taken for a name without 'virus' only, when the name is its mnemonic
+    if not lines:
+        return None
+    if id_type or "virus" in species_name or not "virus" in lines[0]["taxonomy"]["scientificName"]:
+        return lines[0]
+    if species_name==lines[0]["taxonomy"]["mnemonic"]:
+        return lines[0]
+    print(f"the most similar record in UniProt: {lines[0]['taxonomy']}")
+    return None
+
+def uniprot_result(line,reference):
+    r=get_data_from_json_UniProt(line)
+    r.append(reference)
+    if not reference:
+        r.append(line.get('genomeAssembly',{}).get('assemblyId'))
+    return r
+
+def query_uniprot_reference(species_name,id_type):
+    # (result, if any reference proteome was found); failed request sets lookups.failed
     if id_type==2 or id_type==1:
-        url=f"https://rest.uniprot.org/proteomes/stream?format=json&query=%28{species_name}%29+AND+%28proteome_type%3A1%29"
+        url=f"{uniprot_rest}/proteomes/stream?format=json&query=%28{species_name}%29+AND+%28proteome_type%3A1%29"
     else:
-        url = f"https://rest.uniprot.org/proteomes/stream?format=json&query=%28{species_name.replace(' ','+')}%29+AND+%28proteome_type%3A1%29"
-    response = requests.get(url)
-    check_whole=True
-    if response.status_code == 200:
-        lines = response.json()['results']
-        if len(lines):
-            check_whole=False
-            if id_type:
-                r=get_data_from_json_UniProt(lines[0])
-                r.append(1)
-                return r
-            else:
-                if not "virus" in species_name and "virus" in lines[0]["taxonomy"]["scientificName"]:
-                    if species_name==lines[0]["taxonomy"]["mnemonic"]:
-                        r=get_data_from_json_UniProt(lines[0])
-                        r.append(1)
-                        return r
-                    else:
-                        print(f"{lines[0]['taxonomy']}")
-                else:
+        url = f"{uniprot_rest}/proteomes/stream?format=json&query=%28{species_name.replace(' ','+')}%29+AND+%28proteome_type%3A1%29"
+    search_requests["uniprot"]+=1
+    response = http_get(url)
+    if response.status_code != 200:
+        lookups.failed=True
+        return None, False
+    lines = response.json()['results']
+    line = uniprot_first(lines,species_name,id_type)
+    return (uniprot_result(line,1) if line else None), bool(lines)
+
+def query_uniprot_whole(species_name,id_type):
+    if id_type==1:
+        url = f"{uniprot_rest}/proteomes/stream?format=json&query=upid%3A{species_name}"
+    elif id_type==2:
+        url=f"{uniprot_rest}/proteomes/stream?format=json&query=%28{species_name}%29"
+    else:
+        url = f"{uniprot_rest}/proteomes/stream?format=json&query=%28{species_name.replace(' ','+')}%29"
+    search_requests["uniprot"]+=1
+    response = http_get(url)
+    if response.status_code != 200:
+        lookups.failed=True
+        return None
+    line = uniprot_first(response.json()['results'],species_name,id_type)
+    return uniprot_result(line,0) if line else None
 
-                    r=get_data_from_json_UniProt(lines[0])
-                    r.append(1)
-                    return r
-                    
-    if check_whole:
-        print(f"\n! Species {species_name} not found in UniProt - Refererence proteomes;\nChecking in whole UniProt Proteome...")
-        if id_type==1:
-            url = f"https://rest.uniprot.org/proteomes/stream?format=json&query=upid%3A{species_name}"
-        elif id_type==2:
-            url=f"https://rest.uniprot.org/proteomes/stream?format=json&query=%28{species_name}%29"
-        else:
-            url = f"https://rest.uniprot.org/proteomes/stream?format=json&query=%28{species_name.replace(' ','+')}%29"
-        response = requests.get(url)
-        if response.status_code == 200:
-            lines = response.json()['results']
-            if len(lines):
-                if id_type:
-                    r=get_data_from_json_UniProt(lines[0])
-                    r.append(0)
-                    r.append(lines[0]['genomeAssembly']['assemblyId'])
-                    return r
-                else:
-                    if not "virus" in species_name and "virus" in lines[0]["taxonomy"]["scientificName"]:
-                        if species_name==lines[0]["taxonomy"]["mnemonic"]:
-                            print(f"type= {id_type}\tmnemonic\n{lines}")
-                            r=get_data_from_json_UniProt(lines[0])
-                            r.append(0)
-                            r.append(lines[0]['genomeAssembly']['assemblyId'])
-                            return r
-                        else:
-                            print(f"the most similar record in UniProt: {lines[0]['taxonomy']}")
-                    else:
-                        print(f"type= {id_type}\n{lines[0].keys()}")
-                        r=get_data_from_json_UniProt(lines[0])
-                        r.append(0)
-                        r.append(lines[0]['genomeAssembly']['assemblyId'])
-                        return r
+def query_proteome_uniprot(species_name,id_type):
+    # reference proteomes first, whole UniProt Proteome only when no reference proteome was found
+    r, any_reference = query_uniprot_reference(species_name,id_type)
+    if r is not None or any_reference:
+        return r
+    print(f"\n! Species {species_name} not found in UniProt - Refererence proteomes;\nChecking in whole UniProt Proteome...")
+    return query_uniprot_whole(species_name,id_type)
+
+"""
+Function search_uniprot_batch() resolves many species at once, with the same preference of reference 
+proteomes as search_proteome_uniprot():
+1) species are joined by OR into one UniProt query of reference proteomes per uniprot_batch species 
+   (UniProt ID - upid:, taxon ID - organism_id:, name - phrase), results are mapped back to the species
+   by uniprot_match(),
+2) species not matched are searched one by one in reference proteomes (the most relevant record),
+3) the rest is searched by OR queries in the whole UniProt Proteome; results are read in pages of 
+   uniprot_page records, at most uniprot_pages pages per query (reading stops, when all species matched),
+4) species still not matched are searched one by one in the whole UniProt Proteome.
+uniprot_match(): a species name matches scientific, common or mnemonic name or synonym, or it's the 
+beginning of scientific name of a strain (e.g. Escherichia coli (strain K12)); a virus is taken for 
+a name without 'virus' only, when the name is its mnemonic.
+Returns {species: result as of search_proteome_uniprot()} for species found (cached as "uniprot-batch",
+apart from results of search_proteome_uniprot(), which uses other rules).
+"""
+
+uniprot_batch=50
+uniprot_page=500
+uniprot_pages=4
+
+def uniprot_term(species,id_type):
+    if id_type==1:
+        return f"upid:{species}"
+    elif id_type==2:
+        return f"organism_id:{species}"
+    return '"{}"'.format(species.replace('"',''))
+
+def uniprot_match(species,id_type,line):
+    # 0 - the species, 1 - its strain or subspecies, None - other
+    taxonomy=line["taxonomy"]
+    if id_type==1:
+        return 0 if line["id"]==species else None
+    elif id_type==2:
+        return 0 if str(taxonomy["taxonId"])==species else None
+    if id_type==0 and not "virus" in species and "virus" in taxonomy["scientificName"]:
+        return 0 if species==taxonomy.get("mnemonic") else None
+    names=[taxonomy["scientificName"],taxonomy.get("commonName",""),taxonomy.get("mnemonic","")]+taxonomy.get("synonyms",[])
+    if species.lower() in (name.lower() for name in names):
+        return 0
+    if taxonomy["scientificName"].lower().startswith(f"{species.lower()} "):
+        return 1
     return None
 
+def uniprot_batch_pass(chunk,species_types,reference,found):
+    # one OR query for the chunk; returns False, if a request failed
+    query=" OR ".join(f"({uniprot_term(species,species_types[species])})" for species in chunk)
+    if reference:
+        query=f"({query}) AND (proteome_type:1)"
+    best={}
+    url=f"{uniprot_rest}/proteomes/search"
+    params={"format":"json","query":query,"size":uniprot_page}
+    for page in range(uniprot_pages):
+        search_requests["uniprot"]+=1
+        response = http_get(url, params=params)
+        if response.status_code != 200:
+            print(f"UniProt search failed ({response.status_code}) for: {', '.join(chunk)}")
+            return False
+        for line in response.json()['results']:
+            for species in chunk:
+                rank=uniprot_match(species,species_types[species],line)
+                if rank is not None and (species not in best or rank<best[species][0]):
+                    best[species]=(rank,line)
+        # the next page (Link header), unless every species has its exact match
+        url=response.links.get("next",{}).get("url")
+        params=None
+        if url is None or all(best.get(species,(1,))[0]==0 for species in chunk):
+            break
+    for species,(rank,line) in best.items():
+        found[species]=uniprot_result(line,reference)
+    return True
+
+def search_uniprot_batch(species_types):
+    found={}
+    searched=[]
+    for species,id_type in species_types.items():
+        hit,result=cache_get("uniprot-batch",species,id_type)
+        if not hit:
+            searched.append(species)
+        elif result is not None:
+            found[species]=result
+    failed=set()
+    # species with reference proteomes, which are not the species (see uniprot_first()): not searched further
+    settled=set()
+    def todo():
+        return [species for species in searched if species not in found and species not in settled]
+    for reference in (1,0):
+        if not reference and todo():
+            print(f"\n! Species not found in UniProt - Refererence proteomes: {', '.join(todo())};\nChecking in whole UniProt Proteome...")
+        species_list=todo()
+        for start in range(0,len(species_list),uniprot_batch):
+            chunk=species_list[start:start+uniprot_batch]
+            if not uniprot_batch_pass(chunk,species_types,reference,found):
+                failed.update(chunk)
+        # species not matched by the batch are searched one by one (the most relevant record)
+        for species in todo():
+            lookups.failed=False
+            if reference:
+                r, any_reference = query_uniprot_reference(species,species_types[species])
+                if r is None and any_reference:
+                    settled.add(species)
+            else:
+                r = query_uniprot_whole(species,species_types[species])
+            if lookups.failed:
+                failed.add(species)
+            if r is not None:
+                found[species]=r
+    for species in searched:
+        if species in found or species not in failed:
+            cache_put("uniprot-batch",species,species_types[species],found.get(species))
+    return found
+
 def clasify_id(name):
     if re.match("^UP[0-9]+",name):
         return 1
@@ -246,106 +623,211 @@ def clasify_id(name):
     print(f"Ambiguous name (potentially mnemonic name or unsupported abbreviation from NCBI): {name}")
     return 4
 
-def DownloadFile(url,directory):
+"""
+Function DownloadFile() streams file from url to directory in chunks (file is downloaded only once and never
+kept in memory). Data goes to [name].part file first; interrupted download is resumed with HTTP Range request,
+also in the next run. Gzip files are checked for integrity (whole stream is decompressed, CRC is checked), 
+only correct file is renamed to its final name. Returns local file name or None.
+"""
+
+def gzip_is_valid(path):
+    try:
+        with gzip.open(path, "rb") as f:
+            while f.read(1024 * 1024):
+                pass
+        return True
+    except (OSError, EOFError, zlib.error):
+        return False
+
+def DownloadFile(url,directory,attempts=3):
     local_filename = url.split('/')[-1]
-    r = requests.get(url)
     download_path = os.path.join(directory, local_filename)
-    f = open(download_path, 'wb')
-    for chunk in r.iter_content(chunk_size=512 * 1024): 
-        if chunk:
-            f.write(chunk)
-    f.close()
-    return local_filename
+    part_path = f"{download_path}.part"
+    with telemetry.task("download", local_filename, url=url) as t:
+        for attempt in range(attempts):
+            done = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+            headers = {"Range": f"bytes={done}-"} if done else {}
+            try:
+                with http_get(url, headers=headers, stream=True, timeout=60) as r:
+                    if r.status_code == 416:
+                        pass # nothing left to download
+                    elif r.status_code not in (200, 206):
+                        print(f"Error downloading {url}: {r.status_code}")
+                        t.add(status=f"HTTP {r.status_code}")
+                        return None
+                    else:
+                        with open(part_path, "ab" if r.status_code == 206 else "wb") as f:
+                            for chunk in r.iter_content(chunk_size=1024 * 1024):
+                                if chunk:
+                                    f.write(chunk)
+            except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError,
+                    requests.exceptions.Timeout) as e:
+                print(f"Download of {local_filename} interrupted ({e}), resuming...")
+                continue
+            if not local_filename.endswith(".gz") or gzip_is_valid(part_path):
+                os.replace(part_path, download_path)
+                t.add(bytes=os.path.getsize(download_path), attempts=attempt+1)
+                return local_filename
+            print(f"Downloaded file {local_filename} is corrupted, downloading again...")
+            os.remove(part_path)
+        print(f"Error downloading {url}: giving up after {attempts} attempts")
+        t.add(status="failed", attempts=attempts)
+        return None
 
 
 """
 Function fetch_proteome_uniprot() fetches the proteome data from UniProt and saves it to a file in selected 
-directory.
+directory. UniProt FTP directory (domain) is taken from search metadata (or cache); if it's unknown, 
+or download from it failed (wrong domain, moved file), domains are checked with HEAD requests.
 """
 
-def fetch_proteome_uniprot(proteome_id, taxon, names, output_directory):
-    domens=["Archaea","Bacteria","Eukaryota","Viruses"]
-    for dom in domens:
-        url = f"https://ftp.uniprot.org/pub/databases/uniprot/current_release/knowledgebase/reference_proteomes/{dom}/{proteome_id}/{proteome_id}_{taxon}.fasta.gz"
-        response = requests.get(url)
+def probe_domain(proteome_id, taxon, skip=None):
+    for dom in ["Archaea","Bacteria","Eukaryota","Viruses"]:
+        if dom == skip:
+            continue
+        url = f"{uniprot_ftp}/{dom}/{proteome_id}/{proteome_id}_{taxon}.fasta.gz"
+        response = http_head(url)
         if response.status_code == 200:
-            ln = DownloadFile(url, output_directory)
-
-            for name in names:
-                print(f"Updating library file with name '{name}'")
-                ln_path = os.path.join(output_directory, ln)
-                taxon_lib = os.path.join(output_directory, taxon_library)
-                os.system(f"echo '{name}\t{taxon}\t{proteome_id}\t{ln_path}' >> {taxon_lib}")
-            return ln
+            uniprot_domains[proteome_id] = dom
+            return dom
+    print(f"Error fetching proteome {proteome_id} from UniProt: {response.status_code}")
+    return None
 
-        elif response.status_code != 200 and dom=="Viruses":
-            print(f"Error fetching proteome {proteome_id} from UniProt: {response.status_code}")
+def fetch_proteome_uniprot(proteome_id, taxon, names, output_directory, domain=None):
+    known = domain or uniprot_domains.get(proteome_id)
+    domain = known or probe_domain(proteome_id, taxon)
+    if domain is None:
+        return None
+    url = f"{uniprot_ftp}/{domain}/{proteome_id}/{proteome_id}_{taxon}.fasta.gz"
+    ln = DownloadFile(url, output_directory)
+    if not ln and known:
+        print(f"Proteome {proteome_id} not downloaded from {known} directory, checking other UniProt FTP directories...")
+        domain = probe_domain(proteome_id, taxon, skip=known)
+        if domain is not None:
+            url = f"{uniprot_ftp}/{domain}/{proteome_id}/{proteome_id}_{taxon}.fasta.gz"
+            ln = DownloadFile(url, output_directory)
+    if ln:
+        library = load_library(os.path.join(output_directory, taxon_library))
+        ln_path = os.path.join(output_directory, ln)
+        for name in names:
+            print(f"Updating library file with name '{name}'")
+            library.add(name, taxon, proteome_id, ln_path)
+        return ln
+    print(f"Error fetching proteome {proteome_id} from UniProt")
     return None
 
-def process_by_name(input_txt, output_directory):
-    names_list=[]
-    with open(input_txt, 'r') as txtfile:
-        for line in txtfile:
-            names_list.append(line.strip())
-    paths_to_proteomes=[]
-    for species in names_list:
-        print(f"\nProcessing {species}...")
-        check_tmp=check_taxon(species)
-        if check_tmp:
-            paths_to_proteomes.append(check_tmp)
-            print("Found in local database!")
-        else:
-            found=False
-            id_type=clasify_id(species)
-            proteome=None
-            if id_type!=3:
-                print("searching in UniProt ...")
-                proteome = search_proteome_uniprot(species,id_type)
-                if not proteome is None:
-                    check_tmp=check_taxon(proteome[1])
-                    if check_tmp is None:
-                        if proteome[3]:
-                            ln=fetch_proteome_uniprot(proteome[0],proteome[1],proteome[2], output_directory)
-                            if ln:
-                                ln_path = os.path.join(output_directory, ln)
-                                print(f"Proteome for {species} saved as {ln_path}")
-                                paths_to_proteomes.append(ln_path)
-                                found=True
-                            else:
-                                print(f"No matching proteome found for {species} in UniProt Proteomes")
-                    else:
-                        found=True
-                        print("Found in local database!")
-                        paths_to_proteomes.append(check_tmp)                        
-                else:
-                    print(f"No matching proteome found for {species} in UniProt Proteomes")          
-            if not found:
-                proteomeNCBI=None
-                if proteome is None:
-                    print("searching in NCBI ...")
-                    if id_type!=1:
-                        proteomeNCBI = search_proteome_ncbi(species,id_type)
-                elif not proteome[3]:
-                    proteomeNCBI = search_proteome_ncbi(proteome[4],3)
-                    proteomeNCBI[2]=list(set(proteome[2]+proteomeNCBI[2]))
-
-                print(f"\nproteome from NCBI: {proteomeNCBI}\n")
-                if not proteomeNCBI is None:
-                    check_tmp=check_taxon(proteomeNCBI[1])
-                    if check_tmp is None:
-                        ln=fetch_proteome_ncbi(proteomeNCBI[0],proteomeNCBI[1],proteomeNCBI[2], output_directory)
+"""
+Function process_species() finds proteome of a single species (local library -> UniProt -> NCBI), downloads
+it if needed and returns path to the proteome ("" if not found); results of UniProt and NCBI searches
+are taken from resolve_species(), which searches all species of the input list in batches. Check of 
+the library and download of a proteome are done under a lock of its taxon (held by a thread and by 
+file lock in [output_directory]/.locks, shared with other runs using the same database), and the library
+is refreshed under the lock, so the same proteome is downloaded only once, also by concurrent runs.
+"""
+
+download_locks={}
+
+def taxon_lock(taxon):
+    with libraries_lock:
+        return download_locks.setdefault(str(taxon), threading.Lock())
+
+@contextlib.contextmanager
+def proteome_lock(output_directory, taxon):
+    lock_dir=os.path.join(output_directory, ".locks")
+    os.makedirs(lock_dir, exist_ok=True)
+    lock_file=os.path.join(lock_dir, re.sub(r"[^\w.-]", "_", str(taxon)) + ".lock")
+    with taxon_lock(taxon), open(lock_file, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            # proteomes downloaded by other runs while waiting
+            load_library(os.path.join(output_directory, taxon_library)).refresh()
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def resolve_species(names_list, output_directory):
+    """Batch search of species, which are not in local library: {species: (id_type, UniProt result, NCBI result)}"""
+    library=os.path.join(output_directory, taxon_library)
+    todo=[species for species in dict.fromkeys(names_list) if species and not check_taxon(species,library)]
+    types={species:clasify_id(species) for species in todo}
+    uniprot=search_uniprot_batch({species:id_type for species,id_type in types.items() if id_type!=3})
+    queries={}
+    for species in todo:
+        proteome=uniprot.get(species)
+        if proteome is None:
+            if types[species]!=1:
+                queries[species]=(species,types[species])
+        elif not proteome[3] and proteome[4]:
+            queries[species]=(proteome[4],3)
+    ncbi=search_ncbi_batch(list(dict.fromkeys(queries.values())))
+    print(f"\nSpecies searched: {len(todo)} ({search_requests['uniprot']} UniProt requests, {search_requests['datasets']} datasets calls)")
+    return {species:(types[species],uniprot.get(species),ncbi.get(queries.get(species))) for species in todo}
+
+def process_species(species, output_directory, resolved=None):
+    # resolved: results of resolve_species(); species missing in it are searched one by one
+    library=os.path.join(output_directory, taxon_library)
+    print(f"\nProcessing {species}...")
+    check_tmp=check_taxon(species,library)
+    if check_tmp:
+        print(f"{species}: Found in local database!")
+        return check_tmp
+    found=(resolved or {}).get(species)
+    id_type=clasify_id(species) if found is None else found[0]
+    proteome=None
+    if id_type!=3:
+        print(f"{species}: searching in UniProt ...")
+        proteome = search_proteome_uniprot(species,id_type) if found is None else found[1]
+        if not proteome is None:
+            with proteome_lock(output_directory, proteome[1]):
+                check_tmp=check_taxon(proteome[1],library)
+                if check_tmp is None:
+                    if proteome[3]:
+                        ln=fetch_proteome_uniprot(proteome[0],proteome[1],proteome[2], output_directory)
                         if ln:
-                            ln_path = os.path.join(output_directory, f"{ln}.fasta.gz") # hotfix
+                            ln_path = os.path.join(output_directory, ln)
                             print(f"Proteome for {species} saved as {ln_path}")
-                            paths_to_proteomes.append(ln_path)
+                            return ln_path
                         else:
-                           paths_to_proteomes.append("")
-                    else:
-                        print("Found in local database!")
-                        paths_to_proteomes.append(check_tmp)
+                            print(f"No matching proteome found for {species} in UniProt Proteomes")
                 else:
-                    paths_to_proteomes.append("")
+                    print(f"{species}: Found in local database!")
+                    return check_tmp
+        else:
+            print(f"No matching proteome found for {species} in UniProt Proteomes")          
+    proteomeNCBI=None
+    if proteome is None:
+        print(f"{species}: searching in NCBI ...")
+        if id_type!=1:
+            proteomeNCBI = search_proteome_ncbi(species,id_type) if found is None else found[2]
+    elif not proteome[3]:
+        proteomeNCBI = search_proteome_ncbi(proteome[4],3) if found is None else found[2]
+        if not proteomeNCBI is None:
+            proteomeNCBI=proteomeNCBI[:2]+[list(set(proteome[2]+proteomeNCBI[2]))]
+
+    print(f"\nproteome from NCBI: {proteomeNCBI}\n")
+    if not proteomeNCBI is None:
+        with proteome_lock(output_directory, proteomeNCBI[1]):
+            check_tmp=check_taxon(proteomeNCBI[1],library)
+            if check_tmp is None:
+                ln=fetch_proteome_ncbi(proteomeNCBI[0],proteomeNCBI[1],proteomeNCBI[2], output_directory)
+                if ln:
+                    ln_path = os.path.join(output_directory, f"{ln}.fasta.gz") # hotfix
+                    print(f"Proteome for {species} saved as {ln_path}")
+                    return ln_path
+            else:
+                print(f"{species}: Found in local database!")
+                return check_tmp
+    return ""
 
+def process_by_name(input_txt, output_directory, threads=1):
+    names_list=[]
+    with open(input_txt, 'r') as txtfile:
+        for line in txtfile:
+            names_list.append(line.strip())
+    # species are searched in batches first, then downloaded; map() keeps order of the input list
+    resolved=resolve_species(names_list, output_directory)
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        paths_to_proteomes=list(executor.map(lambda species: process_species(species, output_directory, resolved), names_list))
     return paths_to_proteomes
 
 
@@ -366,9 +848,11 @@ def main():
         print(f"preparing library for species names/taxonomy IDs/Uniprot IDs/NCBI IDs: {taxon_lib}")
 
     if not inputs is None:
+        if inputs[3]>0:
+            use_cache(inputs[1],inputs[3],inputs[4])
         print(f"{' '*13}> Fetch proteomes < \n\n{'#'*20}START{'#'*20}")
-        print(f"\nInput file:\t\t\t{inputs[0]}\nOutput directory:\t\t{inputs[1]}\n")
-        paths=process_by_name(inputs[0], inputs[1])
+        print(f"\nInput file:\t\t\t{inputs[0]}\nOutput directory:\t\t{inputs[1]}\nThreads:\t\t\t{inputs[2]}\n")
+        paths=process_by_name(inputs[0], inputs[1], inputs[2])
         with open(f"{inputs[0]}.paths","w") as f:
             for p in paths:
                 print(p)
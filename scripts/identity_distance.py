@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+"""
+Vectorized identity distances for multiple sequence alignments.
+
+The alignment is encoded once as an (n x L) uint8 matrix; the number of identical
+columns for every pair of sequences is then the sum, over all symbols present in the
+alignment, of matrix products of the 0/1 symbol masks (computed in column blocks).
+
+Gap handling modes:
+> identity  - the same as Bio.Phylo.TreeConstruction.DistanceCalculator('identity'):
+              every column counts, gap against gap is an identity; d = 1 - matches/L
+> pairwise  - columns with a gap in either of the two sequences are skipped;
+              d = 1 - matches/compared_columns (1 if there is nothing to compare)
+> complete  - columns with a gap in any sequence are removed, then identity
+
+Column weights (e.g. number of times a column was drawn in a bootstrap replicate) can be
+given for one alignment or, in identity_distances_batch(), for many replicates at once.
+"""
+
+import numpy as np
+from Bio.Phylo.TreeConstruction import DistanceMatrix
+
+gap_modes=["identity","pairwise","complete"]
+GAP=ord("-")
+BLOCK=4096
+
+
+def encode_alignment(align):
+    names=[record.id for record in align]
+    seqs=[str(record.seq) for record in align]
+    length=len(seqs[0]) if seqs else 0
+    if any(len(seq)!=length for seq in seqs):
+        raise ValueError("Sequences in alignment have different lengths")
+    codes=np.frombuffer("".join(seqs).encode("ascii"),dtype=np.uint8).reshape(len(seqs),length)
+    return names,codes
+
+
+def fasta_alignment(text):
+    """Encode aligned FASTA text (e.g. aligner output) directly, without Bio.AlignIO;
+    names are the first words of headers, letters are upper-cased (aligners differ in case)."""
+    names=[]
+    seqs=[]
+    for record in text.split(">")[1:]:
+        header,_,seq=record.partition("\n")
+        fields=header.split(None,1)
+        names.append(fields[0] if fields else "")
+        seqs.append("".join(seq.split()).upper())
+    length=len(seqs[0]) if seqs else 0
+    if any(len(seq)!=length for seq in seqs):
+        raise ValueError("Sequences in alignment have different lengths")
+    codes=np.frombuffer("".join(seqs).encode("ascii"),dtype=np.uint8).reshape(len(seqs),length)
+    return names,codes
+
+
+def _count_pairs(codes,symbols,weights=None):
+    # counts[i,j] = sum over columns c (and symbols s) of w_c*[codes[i,c]==s]*[codes[j,c]==s]
+    # masks are float32 - sums of 0/1 products stay exact integers far beyond any alignment length
+    n,length=codes.shape
+    counts=np.zeros((n,n),dtype=np.float64)
+    for start in range(0,length,BLOCK):
+        block=codes[:,start:start+BLOCK]
+        w=None if weights is None else weights[start:start+BLOCK].astype(np.float32)
+        for s in symbols:
+            mask=(block==s).astype(np.float32)
+            if w is None:
+                counts+=mask@mask.T
+            else:
+                counts+=(mask*w)@mask.T
+    return np.rint(counts)
+
+
+def _count_pairs_batch(codes,symbols,weights):
+    # the same as _count_pairs() for every row of weights (replicates x columns) - batched matmul
+    n,length=codes.shape
+    counts=np.zeros((len(weights),n,n),dtype=np.float64)
+    for start in range(0,length,BLOCK):
+        block=codes[:,start:start+BLOCK]
+        w=weights[:,None,start:start+BLOCK].astype(np.float32)
+        for s in symbols:
+            mask=(block==s).astype(np.float32)
+            counts+=np.matmul(mask[None,:,:]*w,mask.T)
+    return np.rint(counts)
+
+def identity_distances(codes,gaps="identity",weights=None):
+    """Return (n x n) float64 matrix of identity distances for encoded alignment."""
+    if gaps not in gap_modes:
+        raise ValueError(f"Unknown gap mode: {gaps}; available modes: {', '.join(gap_modes)}")
+    if gaps=="complete":
+        keep=~(codes==GAP).any(axis=0)
+        codes=codes[:,keep]
+        if weights is not None:
+            weights=weights[keep]
+    n,length=codes.shape
+    symbols=np.unique(codes)
+    if gaps=="pairwise":
+        symbols=symbols[symbols!=GAP]
+        matches=_count_pairs(codes,symbols,weights)
+        compared=_count_pairs((codes!=GAP).view(np.uint8),[1],weights)
+        with np.errstate(divide="ignore",invalid="ignore"):
+            dist=np.where(compared>0,1-(matches/compared),1.0)
+    else:
+        total=length if weights is None else weights.sum()
+        if total==0:
+            dist=np.ones((n,n))
+        else:
+            matches=_count_pairs(codes,symbols,weights)
+            dist=1-(matches/total)
+    np.fill_diagonal(dist,0)
+    return dist
+
+
+def distance_matrix(align,gaps="identity"):
+    """Return Bio.Phylo DistanceMatrix for an alignment (drop-in for DistanceCalculator('identity'))."""
+    names,codes=encode_alignment(align)
+    dist=identity_distances(codes,gaps)
+    return DistanceMatrix(names,[dist[i,:i+1].tolist() for i in range(len(names))])
+
+
+def identity_distances_batch(codes,weights,gaps="identity"):
+    """Return (replicates x n x n) distance matrices for (replicates x L) matrix of column weights."""
+    if gaps not in gap_modes:
+        raise ValueError(f"Unknown gap mode: {gaps}; available modes: {', '.join(gap_modes)}")
+    weights=np.asarray(weights)
+    if gaps=="complete":
+        keep=~(codes==GAP).any(axis=0)
+        codes=codes[:,keep]
+        weights=weights[:,keep]
+    n,length=codes.shape
+    symbols=np.unique(codes)
+    if gaps=="pairwise":
+        symbols=symbols[symbols!=GAP]
+        matches=_count_pairs_batch(codes,symbols,weights)
+        compared=_count_pairs_batch((codes!=GAP).view(np.uint8),[1],weights)
+        with np.errstate(divide="ignore",invalid="ignore"):
+            dist=np.where(compared>0,1-(matches/compared),1.0)
+    else:
+        total=weights.sum(axis=1).astype(np.float64)[:,None,None]
+        matches=_count_pairs_batch(codes,symbols,weights)
+        with np.errstate(divide="ignore",invalid="ignore"):
+            dist=np.where(total>0,1-(matches/total),1.0)
+    dist[:,np.arange(n),np.arange(n)]=0
+    return dist
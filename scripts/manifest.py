@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+
+"""
+Script Name: manifest.py
+
+Description:
+Manifest of the pipeline run, used to skip work which is already up to date. For every
+step (and for every cluster in MSA and NJ trees steps) the manifest keeps parameters and
+fingerprints of input and output files (or texts from cluster store). The work is redone
+only when parameters changed, any input or output changed or is missing, or it was never
+finished (records are written only after success, so interrupted runs continue from the
+last finished cluster).
+
+Manifest is a JSON lines file (one record per line, the last record of step/item wins):
+> stage  - name of the step, e.g. merging, clustering, msa, nj
+> item   - cluster ID or file for per-cluster records, "" for the whole step
+> params - parameters of the step as one string
+> files  - path: [size, mtime_ns, sha1] (null for file, which doesn't exist)
+> texts  - name: sha1 of text (null for missing text)
+
+Files are compared by size and modification time first, sha1 of content is computed only
+when they differ (so a file rewritten with the same content is still up to date).
+
+Usage (in ect.sh):
+    python manifest.py manifest.jsonl clustering -params "..." -files in.fasta.gz out.fasta -check
+    python manifest.py manifest.jsonl clustering -params "..." -files in.fasta.gz out.fasta -record
+"""
+
+import os
+import sys
+import json
+import fcntl
+import hashlib
+import argparse
+import threading
+
+
+def file_sha1(path):
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024*1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def text_sha1(text):
+    if text is None:
+        return None
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def fingerprint(path, old=None):
+    """[size, mtime_ns, sha1] of file (None if it doesn't exist); sha1 is taken from old
+    fingerprint, when size and modification time are the same."""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    if old and old[0] == stat.st_size and old[1] == stat.st_mtime_ns:
+        return list(old)
+    return [stat.st_size, stat.st_mtime_ns, file_sha1(path)]
+
+
+class Manifest:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.records = {}
+        lines = 0
+        if os.path.isfile(path):
+            with open(path, "r") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                        self.records[(record["stage"], record["item"])] = record
+                    except (ValueError, KeyError):
+                        # the last line can be cut by interrupted run
+                        continue
+                    lines += 1
+        if lines > 2 * len(self.records) + 1000:
+            self.compact()
+
+    def compact(self):
+        # rewrite manifest with only the last record of every step/item
+        tmp = f"{self.path}.tmp"
+        with self.lock:
+            with open(tmp, "w") as f:
+                for record in self.records.values():
+                    f.write(json.dumps(record) + "\n")
+            os.replace(tmp, self.path)
+
+    def _files(self, paths, old):
+        return {path: fingerprint(path, old.get(path)) for path in paths}
+
+    def current(self, stage, item, params, files=(), texts=None):
+        """True, if the step/item was recorded with the same parameters, files and texts."""
+        record = self.records.get((stage, item))
+        if record is None or record["params"] != params:
+            return False
+        texts = {name: text_sha1(text) for name, text in (texts or {}).items()}
+        if record["texts"] != texts or set(record["files"]) != set(files):
+            return False
+        touched = False
+        for path, old in record["files"].items():
+            new = fingerprint(path, old)
+            if new is None or old is None:
+                if new != old:
+                    return False
+            elif new[2] != old[2]:
+                return False
+            else:
+                touched |= new != old
+        if touched:
+            # the same content in rewritten files: remember new size and time
+            self.record(stage, item, params, files, text_hashes=record["texts"])
+        return True
+
+    def record(self, stage, item, params, files=(), texts=None, text_hashes=None):
+        old = self.records.get((stage, item), {}).get("files", {})
+        record = {"stage": stage, "item": item, "params": params, "files": self._files(files, old),
+                  "texts": text_hashes if text_hashes is not None else {name: text_sha1(text) for name, text in (texts or {}).items()}}
+        with self.lock:
+            with open(self.path, "a") as f:
+                # appends of separate processes don't mix lines
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    f.write(json.dumps(record) + "\n")
+                    f.flush()
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+            self.records[(stage, item)] = record
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+    description="""Check if step of pipeline is up to date (exit code 0) or stale (exit code 1),
+    or record finished step in manifest file""")
+    parser.add_argument('manifest', type=str, nargs=1, help="Path to the manifest file (.jsonl)")
+    parser.add_argument('stage', type=str, nargs=1, help="Name of the step")
+    parser.add_argument('-params', type=str, nargs=1, help="Parameters of the step (default: '')", default=[""])
+    parser.add_argument('-files', type=str, nargs='*', help="""Input and output files of the step;
+        .paths file is followed by the files listed in it""", default=[])
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('-check', action='store_true', help="Check if step is up to date")
+    group.add_argument('-record', action='store_true', help="Record finished step")
+    args = parser.parse_args()
+    files = []
+    for path in args.files:
+        files.append(path)
+        if path.endswith(".paths") and os.path.isfile(path):
+            with open(path, "r") as f:
+                files.extend(line.strip() for line in f if line.strip())
+    return [args.manifest[0], args.stage[0], args.params[0], files, args.check]
+
+
+def main():
+    manifest_path, stage, params, files, check = parse_args()
+    manifest = Manifest(manifest_path)
+    if check:
+        if manifest.current(stage, "", params, files):
+            print(f"{stage}: outputs are up to date")
+            return 0
+        return 1
+    manifest.record(stage, "", params, files)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,11 +1,17 @@
 #!/usr/bin/env python3
 
-import Bio
-from Bio import SeqIO
 import os
+import io
 import argparse
 import re
 import gzip
+import shutil
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from taxon_library import TaxonLibrary
+
+script_dir=os.path.dirname(os.path.realpath(__file__))
+default_library=os.path.join(os.path.dirname(script_dir),"proteome_database","taxon_library.csv")
 
 def parse_args():
     parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, 
@@ -19,6 +25,16 @@ def parse_args():
 
     parser.add_argument('input',metavar= 'i',nargs=1, help="""Path to the input TXT file containing 
         paths to selected proteomes""")
+    parser.add_argument('-threads',metavar='INT',type=int,nargs=1,help="""Number of proteomes processed 
+        in parallel worker processes (default: 1)""",default=1)
+    parser.add_argument('-level',metavar='INT',type=int,nargs=1,choices=range(10),help="""Gzip compression 
+        level of output file, 0 - write uncompressed fasta (default: 6)""",default=6)
+    parser.add_argument('-o',metavar='PATH',nargs=1,help="""Output file (can be a named pipe, e.g. for direct 
+        handoff to mmseqs); default: [name]_merged[nr].fasta.gz next to the input file""",default=None)
+    parser.add_argument('-cache',metavar='DIR',nargs=1,help="""Directory for cache of proteomes with unified ids,
+        reused by next merges (default: no cache)""",default=[None])
+    parser.add_argument('-library',metavar='PATH',nargs=1,help=f"""Library of proteomes; cached proteomes, which are
+        not in it, are removed from cache (default: {default_library})""",default=[default_library])
 #    parser.add_argument('-o',metavar= 'o',nargs=1, help="""Directory where the proteome files will be saved;
  #        if not provided, save to ./proteome_database/""",default="./proteome_database/")
 
@@ -34,12 +50,166 @@ def parse_args():
             print(f"Input file {in_file} not recognized as correct .paths file.")
             in_file=""
 
+    if isinstance(args.threads,list):
+        args.threads=args.threads[0]
+    if isinstance(args.level,list):
+        args.level=args.level[0]
+    out_file=args.o[0] if isinstance(args.o,list) else None
     if in_file:    
-        return[in_file]
+        return[in_file,max(1,args.threads),args.level,out_file,args.cache[0],args.library[0]]
     else:
         return None
 
-def process_paths(paths):
+"""
+Ids are rewritten only in header lines (sequence lines are copied as they are):
+> [i]m[y] - record described as mitochondrial, y-th such record in proteome
+> [i]g[x] - x = number from NCBI accession (e.g. XP_[x]) or UniProt accession (sp|[x]|...)
+> [i]r[y] - other records
+new header is "[new id] [old header]", as written by Bio.SeqIO for record with changed id.
+With mark=True (index-free copy in cache, see below) header, which can start with the new id only
+after adding index prefix, is written as "\x01[new id] [old header]"; add_prefix() decides then.
+"""
+
+ncbi_id=re.compile("[A-Z][A-Z]_([0-9]+)")
+uniprot_id=re.compile(r"^[st][pr][|](\w+)")
+
+collapse_mark="\x01"
+
+def normalize_proteome(path,out,prefix="",mark=False):
+    m=1
+    r=1
+    in_record=False
+    with gzip.open(path,"rb") as handle:
+        for line in handle:
+            if line[:1]==b">":
+                in_record=True
+                name=line[1:].decode("utf-8",errors="surrogateescape").rstrip()
+                if "(mitochondrion)" in name or "mitochondrial" in name:
+                    new_id=f"m{m}"
+                    m+=1
+                else:
+                    found=ncbi_id.search(name) or uniprot_id.search(name)
+                    if found:
+                        new_id=f"g{found.group(1)}"
+                    else:
+                        new_id=f"r{r}"
+                        r+=1
+                if not name:
+                    title=f"{prefix}{new_id}"
+                elif mark:
+                    first=name.split(None,1)[0]
+                    title=f"{collapse_mark if first[:-len(new_id)].isdigit() and first.endswith(new_id) else ''}{new_id} {name}"
+                elif name.split(None,1)[0]==f"{prefix}{new_id}":
+                    title=name
+                else:
+                    title=f"{prefix}{new_id} {name}"
+                out.write(f">{title}\n".encode("utf-8",errors="surrogateescape"))
+            elif in_record and line.strip():
+                if line[-1:]!=b"\n" or line[-2:]==b"\r\n":
+                    line=line.rstrip(b"\r\n")+b"\n"
+                out.write(line)
+
+def open_output(path,level,mode="wb"):
+    if level:
+        return io.BufferedWriter(gzip.GzipFile(path,mode,compresslevel=level),buffer_size=1024*1024)
+    return open(path,mode,buffering=1024*1024)
+
+"""
+Cache of proteomes with unified ids (-cache DIR, off by default) keeps for every source proteome
+(key: path, size, mtime) [key].fa.gz - proteome with ids without the index prefix ("m1", "gP12345", ...).
+Index prefix is added to its headers while merging (plain bytes replacement, no parsing; only marked
+headers are checked), so the output is the same as without cache. Proteomes which are not in the library
+any more (or were replaced) are removed from cache. When cache can't be used (e.g. read-only directory),
+proteome is processed without it.
+"""
+
+cache_version="1"
+
+def cache_key(path):
+    st=os.stat(path)
+    return hashlib.sha1(f"{cache_version}|{os.path.abspath(path)}|{st.st_size}|{st.st_mtime_ns}".encode()).hexdigest()
+
+def add_prefix(src,out,prefix,chunk_size=4*1024*1024):
+    # every processed piece starts at the beginning of a line and ends with a newline
+    prefix=prefix.encode()
+    marked=re.compile(rb"^>"+re.escape(prefix)+re.escape(collapse_mark.encode())+rb"(\S+) (\s*)(\S+)",re.M)
+    def collapse(found):
+        # old header starting with the new id is kept as it is
+        if found.group(3)==prefix+found.group(1):
+            return b">"+found.group(2)+found.group(3)
+        return b">"+prefix+found.group(1)+b" "+found.group(2)+found.group(3)
+    def prefixed(piece):
+        piece=piece.replace(b"\n>",b"\n>"+prefix)
+        if piece[:1]==b">":
+            piece=b">"+prefix+piece[1:]
+        if collapse_mark.encode() in piece:
+            piece=marked.sub(collapse,piece)
+        return piece
+    rest=b""
+    while True:
+        chunk=src.read(chunk_size)
+        if not chunk:
+            break
+        chunk=rest+chunk
+        end=chunk.rfind(b"\n")+1
+        piece,rest=chunk[:end],chunk[end:]
+        if piece:
+            out.write(prefixed(piece))
+    if rest:
+        out.write(prefixed(rest))
+
+def cached_copy(path,cache_dir):
+    # index-free copy of the proteome in cache (made if missing), None if cache can't be used
+    cached=os.path.join(cache_dir,f"{cache_key(path)}.fa.gz")
+    if os.path.isfile(cached):
+        return cached
+    tmp=f"{cached}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(cache_dir,exist_ok=True)
+        with open_output(tmp,1) as out:
+            normalize_proteome(path,out,mark=True)
+        os.replace(tmp,cached)
+        return cached
+    except OSError as e:
+        print(f"! cache {cache_dir} not used for {path}: {e}")
+        if os.path.isfile(tmp):
+            os.remove(tmp)
+        return None
+
+def write_proteome(i,path,out,cache_dir=None):
+    cached=cached_copy(path,cache_dir) if cache_dir else None
+    if cached is None:
+        normalize_proteome(path,out,str(i))
+    else:
+        with gzip.open(cached,"rb") as src:
+            add_prefix(src,out,str(i))
+
+def evict_cache(cache_dir,library,paths_list):
+    # cached proteomes not matching any proteome of the library (or of the merged list) are removed
+    if not os.path.isdir(cache_dir) or not os.path.isfile(library):
+        return
+    keys=set()
+    for path in [entry[3] for entry in TaxonLibrary(library).entries]+paths_list:
+        if path and os.path.isfile(path):
+            keys.add(f"{cache_key(path)}.fa.gz")
+    removed=0
+    for name in os.listdir(cache_dir):
+        if re.fullmatch("[0-9a-f]{40}[.]fa[.]gz",name) and name not in keys:
+            try:
+                os.remove(os.path.join(cache_dir,name))
+                removed+=1
+            except OSError:
+                pass
+    if removed:
+        print(f"removed {removed} proteomes from cache {cache_dir}")
+
+def merge_part(i,path,part_file,level,cache_dir=None):
+    # one proteome as separate gzip member (or plain text), concatenated later with others
+    with open_output(part_file,level) as out:
+        write_proteome(i,path,out,cache_dir)
+    return part_file
+
+def process_paths(paths,threads=1,level=6,out_file=None,cache_dir=None,library=default_library):
     paths_list=[]
     nr=0
     with open(paths,"r") as f:
@@ -51,31 +221,32 @@ def process_paths(paths):
             else:
                 print(f"! proteome on path: {line} not found;\nomitting proteome\nuse update_database.py to remove all maualy relocated/deleted proteome files.")
                 paths_list.append("")
-    out_file=re.sub("[.]txt[.]", f"_merged{nr}.", re.sub("[.]paths$", ".fasta.gz", paths))
+    if out_file is None:
+        out_file=re.sub("[.]txt[.]", f"_merged{nr}.", re.sub("[.]paths$", ".fasta.gz", paths))
+        if not level:
+            out_file=re.sub("[.]gz$","",out_file)
     if os.path.isfile(out_file):
-        os.system(f"rm {out_file}")
-    with gzip.open(out_file,"wt") as f:
-        for i,p in enumerate(paths_list):
-            m=1
-            r=1
-            if p:
-                with gzip.open(p,"rt") as handle:
-                    for record in SeqIO.parse(handle, "fasta"):
-                        name, sequence = record.description, str(record.seq)
-                        if m and ("(mitochondrion)" in name or "mitochondrial" in name):
-                            record.id=f"{i}m{m}"
-                            m+=1
-                        elif re.search("[A-Z][A-Z]_[0-9]+",name):
-                            name=re.findall("[A-Z][A-Z]_[0-9]+",name)[0]
-                            name=name.split("_")[1]
-                            record.id=f"{i}g{name.replace(',','')}"
-                        elif re.search("^[st][pr][|][\w]+",name): ## problematic line '\w' an escpae character, consider using raw string r"..."
-                            name=re.findall("^[st][pr][|][\w]+",name)[0]
-                            record.id=f"{i}g{name.split('|')[1]}"
-                        else:
-                            record.id=f"{i}r{r}"
-                            r+=1
-                        SeqIO.write(record, f, "fasta")
+        os.remove(out_file)
+    if cache_dir:
+        evict_cache(cache_dir,library,paths_list)
+    if threads==1:
+        with open_output(out_file,level) as out:
+            for i,p in enumerate(paths_list):
+                if p:
+                    write_proteome(i,p,out,cache_dir)
+        return out_file
+    part_dir=os.path.dirname(os.path.abspath(out_file))
+    part_name=os.path.basename(out_file)
+    with ProcessPoolExecutor(max_workers=threads) as executor:
+        jobs=[executor.submit(merge_part,i,p,os.path.join(part_dir,f".{part_name}.part{i}"),level,cache_dir) 
+            for i,p in enumerate(paths_list) if p]
+        # parts are appended in input order as soon as they are ready (gzip members can be concatenated)
+        with open(out_file,"wb") as out:
+            for job in jobs:
+                part_file=job.result()
+                with open(part_file,"rb") as part:
+                    shutil.copyfileobj(part,out,1024*1024)
+                os.remove(part_file)
     return out_file
 
 
@@ -84,8 +255,10 @@ def main():
 
     if not inputs is None:
         print(f"{' '*7}> Merge proteomes & unify ids < \n\n{'#'*20}START{'#'*20}")
-        print(f"\nInput file:\t\t\t{inputs[0]}\n")
-        paths=process_paths(inputs[0])
+        print(f"\nInput file:\t\t\t{inputs[0]}\nThreads:\t\t\t{inputs[1]}\nCompression level:\t\t{inputs[2]}\n")
+        if inputs[4] is not None:
+            print(f"Cache directory:\t\t{inputs[4]}\n")
+        paths=process_paths(inputs[0],inputs[1],inputs[2],inputs[3],inputs[4],inputs[5])
         print(f"found proteomes merged to file:\n{paths}")
 
 
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+"""
+Script Name: metadata_cache.py
+
+Description:
+Persistent cache of UniProt and NCBI lookups of fetch_proteomes.py (and remove_proteomes.py),
+so repeated or overlapping species lists are resolved without network. The cache is a SQLite
+file (by default proteome_database/metadata_cache.sqlite), one row per lookup:
+
+> source   - uniprot, uniprot-batch (batch search, other matching rules) or ncbi
+> query    - species name, taxon ID or accession (single spaces; species names in lower case,
+             as their search is case-insensitive)
+> id_type  - type of the query, see fetch_proteomes.clasify_id()
+> value    - JSON of the parsed result: {"result": [id, taxon, names, ...], "domain": ...},
+             result is null, when the species was not found (negative result)
+> created  - time of the lookup, used - time of the last use
+
+Entries expire after ttl (negative results after negative_ttl, usually shorter: new proteomes
+appear); when there are more than max_entries entries, the least recently used are removed.
+
+Usage:
+    python metadata_cache.py proteome_database/metadata_cache.sqlite -stats
+    python metadata_cache.py proteome_database/metadata_cache.sqlite -clear
+"""
+
+import os
+import sys
+import json
+import time
+import sqlite3
+import argparse
+import threading
+
+day=24*60*60
+
+
+def query_key(query, id_type):
+    # only species names (id_type 0) are matched regardless of case, IDs and mnemonic names are kept
+    query = " ".join(str(query).split())
+    return query.lower() if id_type == 0 else query
+
+
+class MetadataCache:
+    def __init__(self, path, ttl=30*day, negative_ttl=day, max_entries=100000):
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.puts = 0
+        # one connection shared by threads of fetch_proteomes.py, other processes wait for the lock of the file
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS lookups (source TEXT, query TEXT, id_type INTEGER,
+            value TEXT, created REAL, used REAL, PRIMARY KEY (source, query, id_type))""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS lookups_used ON lookups (used)")
+
+    def get(self, source, query, id_type):
+        """(True, value) of fresh entry, (False, None) if there is none."""
+        key = (source, query_key(query, id_type), id_type)
+        now = time.time()
+        with self.lock:
+            row = self.db.execute("SELECT value, created FROM lookups WHERE source=? AND query=? AND id_type=?", key).fetchone()
+            if row is None:
+                return False, None
+            value = json.loads(row[0])
+            if now - row[1] > (self.ttl if value.get("result") is not None else self.negative_ttl):
+                self.db.execute("DELETE FROM lookups WHERE source=? AND query=? AND id_type=?", key)
+                return False, None
+            self.db.execute("UPDATE lookups SET used=? WHERE source=? AND query=? AND id_type=?", (now, *key))
+        return True, value
+
+    def put(self, source, query, id_type, value):
+        now = time.time()
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO lookups VALUES (?, ?, ?, ?, ?, ?)",
+                (source, query_key(query, id_type), id_type, json.dumps(value), now, now))
+            self.puts += 1
+            if self.puts % 100 == 1:
+                self._evict(now)
+
+    def _evict(self, now):
+        # expired entries, then the least recently used above max_entries
+        self.db.execute("DELETE FROM lookups WHERE created < ?", (now - max(self.ttl, self.negative_ttl),))
+        extra = self.db.execute("SELECT COUNT(*) FROM lookups").fetchone()[0] - self.max_entries
+        if extra > 0:
+            self.db.execute("DELETE FROM lookups WHERE rowid IN (SELECT rowid FROM lookups ORDER BY used LIMIT ?)", (extra,))
+
+    def stats(self):
+        with self.lock:
+            rows = self.db.execute("""SELECT source, COUNT(*), SUM(json_extract(value, '$.result') IS NULL),
+                MIN(created) FROM lookups GROUP BY source""").fetchall()
+        return rows
+
+    def clear(self):
+        with self.lock:
+            self.db.execute("DELETE FROM lookups")
+            self.db.execute("VACUUM")
+
+    def close(self):
+        self.db.close()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+    description="""Show statistics of cache of UniProt/NCBI lookups or clear it""")
+    parser.add_argument('cache', type=str, nargs=1, help="Path to the cache file (.sqlite)")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('-stats', action='store_true', help="Show number of cached lookups")
+    group.add_argument('-clear', action='store_true', help="Remove all cached lookups")
+    args = parser.parse_args()
+    return [args.cache[0], args.clear]
+
+
+def main():
+    path, clear = parse_args()
+    if not os.path.isfile(path):
+        print(f"Provide cache file: {path} doesn't exist")
+        return 1
+    cache = MetadataCache(path)
+    if clear:
+        cache.clear()
+        print(f"Cache {path} cleared")
+    else:
+        print(f"{'source':<14}{'lookups':>10}{'not found':>12}  oldest")
+        for source, count, negative, oldest in cache.stats():
+            print(f"{source:<14}{count:>10}{negative:>12}  {time.strftime('%Y-%m-%d %H:%M', time.localtime(oldest))}")
+    cache.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
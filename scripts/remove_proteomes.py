@@ -1,10 +1,9 @@
 import os
 import argparse
 import requests
-import subprocess
 import json
 import re
-from fetch_proteomes import clasify_id, search_proteome_uniprot, search_proteome_ncbi, check_taxon
+from fetch_proteomes import clasify_id, search_proteome_uniprot, search_proteome_ncbi, check_taxon, load_library, use_cache
 
 taxon_library="taxon_library.csv"
 
@@ -42,48 +41,50 @@ def parse_args():
     else:
         return None
 
-def delete_path(paths,library):
-    result = subprocess.run(['grep', f'{paths}' , library],
-        stdout=subprocess.PIPE)
-    if result.returncode==0:
-        result=result.stdout.decode("utf-8").strip()
-        os.system(f"echo '{result}' >> {library}")
-        os.system(f"sort {library} | uniq -u > {library}.tmp")
-        os.system(f"cat {library}.tmp > {library}")
-        os.system(f"rm {library}.tmp")
-        result=result.split()[-1].strip()
-        print(f">>> removing file {result}\nDONE!")
-        os.system(f"rm {paths}")
-        return False
-    return True
+"""
+Function delete_paths() removes all lines of the proteomes from library in one rewrite of the file
+(see TaxonLibrary.remove()) and then their fasta.gz files; returns set of removed paths.
+"""
+
+def delete_paths(paths,library):
+    removed=load_library(library).remove(paths)
+    removed_paths=list(dict.fromkeys(entry[3] for entry in removed))
+    for path in removed_paths:
+        print(f">>> removing file {path}")
+        if os.path.isfile(path):
+            os.remove(path)
+    if removed_paths:
+        print("DONE!")
+    return set(removed_paths)
+
+def find_path(species,library):
+    # path of proteome of the species in library (found by name, or by taxon from UniProt/NCBI)
+    check_tmp=check_taxon(species,library)
+    if check_tmp:
+        return check_tmp
+    id_type=clasify_id(species)
+    print(f"name: {species} not found in library, checking UniProt Proteomes")
+    proteome=search_proteome_uniprot(species,id_type)
+    if proteome is None and id_type!=1:
+        print(f"name: {species} not found in library and UniProt Proteomes, checking in NCBI")
+        proteome = search_proteome_ncbi(species,id_type)
+    if not proteome is None:
+        return check_taxon(proteome[1],library)
+    return None
 
 def delete_ids(input_txt,library):
     names_list=[]
     with open(input_txt, 'r') as txtfile:
         for line in txtfile:
             names_list.append(line.strip())
+    # proteomes to remove are collected first and removed from library at once
+    paths={}
     for species in names_list:
         print(f"\nRemoving {species}...")
-        id_type=clasify_id(species)
-        check_tmp=check_taxon(species)
-        res=True
-        if check_tmp:
-            res=delete_path(check_tmp,library)
-        else:
-            print(f"name: {species} not found in library, checking UniProt Proteomes")
-            proteome=search_proteome_uniprot(species,id_type)
-            if not proteome is None:
-                check_tmp=check_taxon(proteome[1])
-                if check_tmp:
-                    res=delete_path(check_tmp,library)
-            elif id_type!=1:
-                print(f"name: {species} not found in library and UniProt Proteomes, checking in NCBI")
-                proteome = search_proteome_ncbi(species,id_type)
-            if not proteome is None:
-                check_tmp=check_taxon(proteome[1])
-                if check_tmp:
-                    res=delete_path(check_tmp,library)
-        if res:
+        paths[species]=find_path(species,library)
+    removed=delete_paths({path for path in paths.values() if path},library)
+    for species,path in paths.items():
+        if path not in removed:
             print(f"FAILED: cannot found organism in {library}\n-> organism {species} has been probably already removed")
 
 
@@ -104,6 +105,8 @@ def main():
     if not inputs is None:
         print(f"{' '*13}> Remove proteomes < \n\n{'#'*20}START{'#'*20}")
         print(f"\nInput file:\t\t{inputs[0]}\nLibrary file:\t\t{inputs[1]}\n")
+        # UniProt/NCBI searches are cached next to the library, as by fetch_proteomes.py
+        use_cache(os.path.dirname(os.path.abspath(inputs[1])))
         delete_ids(inputs[0],inputs[1])
 
 if __name__ == "__main__":
@@ -4,21 +4,61 @@ import os
 import subprocess
 import argparse
 import re
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from Bio import AlignIO
+from cluster_store import ClusterStore, is_store
+from manifest import Manifest
+from identity_distance import fasta_alignment, gap_modes
+from fast_nj import engines
+from bootstrap import alignment_rng
+from run_NJ_on_alignment import codes_tree, newick_text, tree_path, tree_params
+import telemetry
+
+aligners=["ClustalW","Muscle","Mafft"]
+aln_formats=["clustal","fasta","none"]
+aln_suffix={"clustal":".aln","fasta":".afa"}
 
 def parse_args():
     parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, 
     description="""Make multiple sequence alignment of file/files in selected .txt file, 
     using one of following alghotitm: Muscle, ClustalW, Mafft;
-    Output format: .aln (clustal)""")
-    parser.add_argument('input', type=str, nargs=1, help="""Path to the input fasta file 
-        or .txt file containing paths to fasta files""", default=None)
+    Output format: .aln (clustal);
+    Input can be also cluster store directory ([name]/store from split_clusters.py -store),
+    then all clusters from the store are aligned and alignments are saved to the store.
+
+    With -tree aligned FASTA printed by the aligner is parsed once, straight to the distance
+    matrix, and NJ tree is saved ([name]_njtree.nwk, as by run_NJ_on_alignment.py); alignment
+    file is written only with -aln clustal (.aln) or -aln fasta (.afa, compact: one line
+    per sequence), so run_NJ_on_alignment.py is not needed.""")
+    parser.add_argument('input', type=str, nargs=1, help="""Path to the input fasta file, 
+        .txt file containing paths to fasta files or cluster store directory""", default=None)
     parser.add_argument('-mode',metavar='INT',type=int,nargs=1,choices=[0,1,2],help="""Algorithm used to MSA: 
         0 - ClustalW (default); 1 - Muscle; 2 - Mafft;""",default=0)
+    parser.add_argument('-threads',metavar='INT',type=int,nargs=1,help="""Number of aligner jobs run 
+        concurrently; with more than 1 job the largest clusters are aligned first (default: 1)""",default=1)
+    parser.add_argument('-tree',action='store_true',help="""Build NJ tree of every cluster directly from
+        aligner output (default: only alignment is saved)""")
+    parser.add_argument('-aln',type=str,nargs=1,choices=aln_formats,help="""Format of saved alignment:
+        clustal (.aln), fasta (.afa) or none (default: clustal, with -tree: none)""",default=None)
+    parser.add_argument('-gaps',type=str,nargs=1,choices=gap_modes,help="""Gap handling in distance computation
+        of -tree, see run_NJ_on_alignment.py (default: identity)""",default=["identity"])
+    parser.add_argument('-engine',type=str,nargs=1,choices=engines,help="""Tree construction engine of -tree,
+        see run_NJ_on_alignment.py (default: nj)""",default=["nj"])
+    parser.add_argument('-bootstrap',metavar='INT',type=int,nargs=1,help="""Number of bootstrap replicates
+        of -tree (default: 0 - no bootstrap)""",default=[0])
+    parser.add_argument('-seed',metavar='INT',type=int,nargs=1,help="""Seed of bootstrap resampling (default: 1)""",default=[1])
+    parser.add_argument('-manifest',metavar='PATH',type=str,nargs=1,help="""Manifest file (.jsonl, see manifest.py);
+        clusters aligned before with the same mode, whose fasta and alignment didn't change, are skipped
+        (default: align all clusters)""",default=None)
     args = parser.parse_args()
     in_file=""
     if args.input is None:
         print(f"Provide input file")
+    elif is_store(args.input[0]):
+        in_file=args.input[0]
+        is_file=False
     elif not os.path.isfile(args.input[0]):
         print(f"Provide input file: {args.input[0]} doesn't exist")
     else:
@@ -33,65 +73,305 @@ def parse_args():
             in_file=""
     if isinstance(args.mode,list):
         args.mode=args.mode[0]
+    if isinstance(args.threads,list):
+        args.threads=args.threads[0]
+    if args.threads<1:
+        print(f"parametr: threads = {args.threads} out of range, changing to 1")
+        args.threads=1
+    manifest=args.manifest[0] if args.manifest else None
+    aln_format=args.aln[0] if args.aln else ("none" if args.tree else "clustal")
+    tree=(args.gaps[0],args.engine[0],max(0,args.bootstrap[0]),args.seed[0]) if args.tree else None
     if in_file:    
-        return[in_file,is_file,args.mode]
+        return[in_file,is_file,args.mode,args.threads,manifest,aln_format,tree]
     else:
         return None
 
-def process_fasta2MSA(input_file,is_fasta,mode):
+"""
+Function cluster_cost() estimates the alignment cost of a cluster file np_<id>_<n>.fasta
+as number of sequences (n, taken from the name) times file size (~ n * sequence length);
+used only for ordering the jobs, so the largest clusters don't end up as stragglers.
+"""
+
+def cluster_cost(path):
+    found=re.findall("_([0-9]+)[.]fasta$",path)
+    n=int(found[0]) if found else 1
+    size=os.path.getsize(path) if os.path.isfile(path) else 0
+    return n*size
+
+"""
+Function align_fasta() runs selected aligner on a single fasta file and returns tuple 
+(success, error message); it doesn't print anything, so it can be run from many threads at once.
+Wall time, CPU time and peak RSS of the aligner are recorded by telemetry (task of cluster ID).
+"""
+
+def align_fasta(path,mode):
+    key=os.path.basename(path).replace('.fasta','')
+    with telemetry.task("MSA",key,aligner=aligners[mode],bytes=os.path.getsize(path)) as t:
+        with open(path,"r") as f:
+            t.add(sequences=sum(1 for line in f if line[:1]==">"))
+        ok,message=run_aligner(path,mode)
+        if not ok:
+            t.add(status="failed")
+        return ok,message
+
+def run_aligner(path,mode):
+    if mode==0:
+        # clustalw gets the file name relative to its directory, absolute paths are taken as options
+        directory=os.path.dirname(path) or None
+        name=os.path.basename(path)
+        result = telemetry.run(["clustalw", name, "-align"], cwd=directory,
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        if result.returncode==0:
+            dnd=path.replace('.fasta','.dnd')
+            if os.path.isfile(dnd):
+                os.remove(dnd)
+            return True,""
+        return False,result.stdout.decode("utf-8",errors="replace")
+    elif mode==1:
+        afa=path.replace('.fasta','.afa')
+        result = telemetry.run(["muscle", "-align", path, "-output", afa], 
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if result.returncode==0:
+            with open(afa,"r") as aln:
+                alignments = AlignIO.parse(aln, "fasta")
+                with open(path.replace('.fasta','.aln'),"w") as out:
+                    AlignIO.write(alignments, out, "clustal")
+            os.remove(afa)
+            return True,""
+        return False,result.stderr.decode("utf-8",errors="replace")
+    else:
+        aln=path.replace('.fasta','.aln')
+        with open(aln,"w") as out:
+            result = telemetry.run(["mafft", "--auto", "--anysymbol", "--clustalout", path], 
+                stdout=out, stderr=subprocess.PIPE)
+        if result.returncode==0:
+            return True,""
+        os.remove(aln) # fix empty aln
+        return False,result.stderr.decode("utf-8",errors="replace")
+
+"""
+Functions for direct handoff (-tree or -aln fasta): aligned_fasta() returns aligned FASTA text printed
+(Mafft) or written (ClustalW, Muscle) by the aligner, no alignment file is left; direct_outputs() encodes
+it once (identity_distance.fasta_alignment) and returns texts of outputs: "aln" - alignment in the
+selected format (if any), "nwk" - NJ tree (None, if it has negative branch length).
+tree: None or (gaps, engine, bootstrap, seed), as in run_NJ_on_alignment.py.
+"""
+
+def aligned_fasta(path,mode):
+    afa=path.replace('.fasta','.afa')
+    if mode==0:
+        directory=os.path.dirname(path) or None
+        result = telemetry.run(["clustalw", os.path.basename(path), "-align", "-output=fasta",
+            f"-outfile={os.path.basename(afa)}"], cwd=directory, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        dnd=path.replace('.fasta','.dnd')
+        if os.path.isfile(dnd):
+            os.remove(dnd)
+        message=result.stdout
+    elif mode==1:
+        result = telemetry.run(["muscle", "-align", path, "-output", afa], 
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        message=result.stderr
+    else:
+        result = telemetry.run(["mafft", "--auto", "--anysymbol", path], 
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if result.returncode==0:
+            return True,"",result.stdout.decode("utf-8")
+        return False,result.stderr.decode("utf-8",errors="replace"),None
+    if result.returncode!=0:
+        return False,message.decode("utf-8",errors="replace"),None
+    with open(afa,"r") as f:
+        text=f.read()
+    os.remove(afa)
+    return True,"",text
+
+def clustal_text(names,codes):
+    lines=["CLUSTAL W multiple sequence alignment\n\n\n"]
+    width=max(16,max(len(name) for name in names)+1)
+    seqs=[row.tobytes().decode("ascii") for row in codes]
+    for start in range(0,codes.shape[1],60):
+        for name,seq in zip(names,seqs):
+            lines.append(f"{name:<{width}}{seq[start:start+60]}\n")
+        lines.append(" "*(width+len(seqs[0][start:start+60]))+"\n\n")
+    return "".join(lines)
+
+def align_direct(path,mode,aln_format="none",tree=None):
+    key=os.path.basename(path).replace('.fasta','')
+    with telemetry.task("MSA",key,aligner=aligners[mode],bytes=os.path.getsize(path)) as t:
+        ok,message,text=aligned_fasta(path,mode)
+        if not ok:
+            t.add(status="failed")
+            return False,message,{}
+        return True,"",direct_outputs(key,text,aln_format,tree)
+
+def direct_outputs(key,text,aln_format="none",tree=None):
+    outputs={}
+    names,codes=fasta_alignment(text)
+    if aln_format=="clustal":
+        outputs["aln"]=clustal_text(names,codes)
+    elif aln_format=="fasta":
+        outputs["aln"]="".join(f">{name}\n{row.tobytes().decode('ascii')}\n" for name,row in zip(names,codes))
+    if tree is not None:
+        gaps,engine,bootstrap,seed=tree
+        NJTree=codes_tree(names,codes,gaps,engine,bootstrap,alignment_rng(seed,f"{key}.aln"))
+        outputs["nwk"]=newick_text(NJTree) if NJTree is not None else None
+    return outputs
+
+def save_outputs(store,item,outputs,aln_format):
+    # file mode: [name].aln/.afa and [name]_njtree.nwk next to the fasta; store: kinds 'aln' and 'nwk'
+    if store is not None:
+        for kind,text in outputs.items():
+            if text is not None:
+                store.put(kind,item,text)
+        return
+    if "aln" in outputs:
+        with open(item.replace('.fasta',aln_suffix[aln_format]),"w") as f:
+            f.write(outputs["aln"])
+    if "nwk" in outputs:
+        if outputs["nwk"] is not None:
+            with open(tree_path(item),"w") as f:
+                f.write(outputs["nwk"])
+        elif os.path.isfile(tree_path(item)):
+            # tree of the previous version of the cluster
+            os.remove(tree_path(item))
+
+def direct_job(store,item,mode,tmp_dir,aln_format,tree):
+    if store is None:
+        ok,message,outputs=align_direct(item,mode,aln_format,tree)
+    else:
+        path=os.path.join(tmp_dir,f"{item}.fasta")
+        with open(path,"w") as f:
+            f.write(store.get("np",item))
+        try:
+            ok,message,outputs=align_direct(path,mode,aln_format,tree)
+        finally:
+            os.remove(path)
+    if ok:
+        save_outputs(store,item,outputs,aln_format)
+    return ok,message
+
+"""
+Function align_stored() aligns cluster from cluster store: the cluster is written to a temporary 
+fasta file (in tmp_dir), aligned by align_fasta() and the alignment is appended to the store.
+"""
+
+def align_stored(store,key,mode,tmp_dir):
+    path=os.path.join(tmp_dir,f"{key}.fasta")
+    with open(path,"w") as f:
+        f.write(store.get("np",key))
+    try:
+        ok,message=align_fasta(path,mode)
+        if ok:
+            with open(path.replace('.fasta','.aln'),"r") as aln:
+                store.put("aln",key,aln.read())
+        return ok,message
+    finally:
+        for tmp in (path,path.replace('.fasta','.aln')):
+            if os.path.isfile(tmp):
+                os.remove(tmp)
+
+"""
+Function up_to_date() tells if cluster was already aligned with the same mode (by manifest record
+of the fasta and alignment files or texts from the store); record_alignment() makes the record.
+"""
+
+def cluster_files(store,item,aln_format="clustal",tree=None):
+    kinds=(["aln"] if aln_format!="none" else [])+(["nwk"] if tree is not None else [])
+    if store is None:
+        files=[item]
+        if aln_format!="none":
+            files.append(item.replace('.fasta',aln_suffix[aln_format]))
+        if tree is not None:
+            files.append(tree_path(item))
+        return files,None
+    texts={"np":store.get("np",item)}
+    for kind in kinds:
+        texts[kind]=store.get(kind,item) if (kind,item) in store else None
+    return [],texts
+
+def msa_params(mode,aln_format="clustal",tree=None):
+    params=f"mode={mode}"
+    if aln_format!="clustal" or tree is not None:
+        params+=f" aln={aln_format} tree={tree_params(*tree) if tree else None}"
+    return params
+
+def up_to_date(manifest,store,item,mode,aln_format="clustal",tree=None):
+    files,texts=cluster_files(store,item,aln_format,tree)
+    return manifest.current("msa",item,msa_params(mode,aln_format,tree),files,texts)
+
+def record_alignment(manifest,store,item,mode,aln_format="clustal",tree=None):
+    files,texts=cluster_files(store,item,aln_format,tree)
+    manifest.record("msa",item,msa_params(mode,aln_format,tree),files,texts)
+
+def process_fasta2MSA(input_file,is_fasta,mode,threads=1,manifest=None,aln_format="clustal",tree=None):
     fasta_list=[]
+    store=None
     if is_fasta:
         fasta_list.append(input_file)
+    elif is_store(input_file):
+        store=ClusterStore(input_file)
+        fasta_list=store.keys("np")
     else:
         with open(input_file,"r") as f:
             for line in f:
-                fasta_list.append(line.strip())
-    currentdir=os.getcwd()
-    for p,path in enumerate(fasta_list):
-        if mode==0:
-            os.system(f"cd {os.path.dirname(path)}")
-            x =os.path.commonpath([os.getcwd(),path])
-            path=path.replace(x,"")
-            if path[0]=="/":
-                path=path[1:]
-            result = subprocess.run([f"clustalw", f"{path}" , "-align" ],
-                stdout=subprocess.PIPE)
-            if result.returncode==0:
-                print(f"ClustalW progress:\t{p+1}/{len(fasta_list)}")
-                os.system(f"rm {path.replace('.fasta','.dnd')}")
-            else:
-                print(f"ClustalW error!!! {p+1}/{len(fasta_list)}")
-                print(result.stdout)
-        elif mode==1:
-            result = subprocess.run([f"muscle", "-align",f"{path}", "-output", f"{path.replace('.fasta','.afa')}" ], 
-                capture_output=True)
-            if result.returncode==0:
-                print(f"Muscle progress:\t{p+1}/{len(fasta_list)}")
-                with open(path.replace('.fasta','.afa'),"r") as aln:
-                    alignments = AlignIO.parse(aln, "fasta")
-                    out=open(path.replace('.fasta','.aln'),"w")
-                    AlignIO.write(alignments, out, "clustal")
-                    out.close()
-                os.system(f"rm {path.replace('.fasta','.afa')}")
-            else:
-                print(f"Muscle error!!! {p+1}/{len(fasta_list)}")
+                if line.strip():
+                    fasta_list.append(line.strip())
+    if manifest is not None:
+        manifest=Manifest(manifest)
+        total=len(fasta_list)
+        fasta_list=[item for item in fasta_list if not up_to_date(manifest,store,item,mode,aln_format,tree)]
+        print(f"Clusters up to date (skipped):\t{total-len(fasta_list)}/{total}",flush=True)
+    if threads>1:
+        if store is None:
+            fasta_list.sort(key=cluster_cost,reverse=True)
         else:
-            result = subprocess.run(f"mafft --auto --anysymbol --clustalout {path} > {path.replace('.fasta','.aln')}", 
-                shell=True,capture_output=True)
-            if result.returncode==0:
-                print(f"Mafft progress:\t{p+1}/{len(fasta_list)}")
+            fasta_list.sort(key=lambda key: int(key.split("_")[-1])*store.index("np")[key][1],reverse=True)
+    direct=aln_format!="clustal" or tree is not None
+    if store is not None and tree is not None:
+        # trees of clusters aligned again are replaced (the store can't remove single entries)
+        todo=set(fasta_list)
+        kept=[(key,store.get("nwk",key)) for key in store.keys("nwk") if key not in todo]
+        store.clear("nwk")
+        store.put_many("nwk",kept)
+    failed=[]
+    tmp_dir=tempfile.mkdtemp(prefix="ect_msa_") if store is not None else None
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        if direct:
+            jobs={executor.submit(direct_job,store,item,mode,tmp_dir,aln_format,tree):item for item in fasta_list}
+        elif store is None:
+            jobs={executor.submit(align_fasta,path,mode):path for path in fasta_list}
+        else:
+            jobs={executor.submit(align_stored,store,key,mode,tmp_dir):key for key in fasta_list}
+        for p,job in enumerate(as_completed(jobs)):
+            path=jobs[job]
+            try:
+                ok,message=job.result()
+            except (OSError,ValueError) as e:
+                ok,message=False,str(e)
+            if ok:
+                if manifest is not None:
+                    record_alignment(manifest,store,path,mode,aln_format,tree)
+                print(f"{aligners[mode]} progress:\t{p+1}/{len(fasta_list)}\t{os.path.basename(path)}",flush=True)
             else:
-                subprocess.run(f"rm {path.replace('.fasta','.aln')}", shell=True) # fix empty aln
-                print(f"Mafft error!!! {p+1}/{len(fasta_list)}") 
-    if mode==0:
-        os.system(f"cd {currentdir}")
+                failed.append(path)
+                print(f"{aligners[mode]} error!!! {p+1}/{len(fasta_list)}\t{path}\n{message.strip()}",flush=True)
+    if store is not None:
+        shutil.rmtree(tmp_dir,ignore_errors=True)
+        store.close()
+    if failed:
+        print(f"\n{len(failed)}/{len(fasta_list)} clusters failed to align:")
+        for path in failed:
+            print(path)
+    return failed
 
 def main():
     inputs=parse_args()
     if not inputs is None:
         print(f"{' '*17}> Make MSA < \n\n{'#'*20}START{'#'*20}")
-        print(f"\nInput file:\t\t{inputs[0]}\nis single fasta:\t{inputs[1]}\nmode:\t\t\t{inputs[2]}")
-        process_fasta2MSA(inputs[0],inputs[1],inputs[2])
+        print(f"\nInput file:\t\t{inputs[0]}\nis single fasta:\t{inputs[1]}\nmode:\t\t\t{inputs[2]}\nthreads:\t\t{inputs[3]}")
+        print(f"alignment format:\t{inputs[5]}\nNJ tree:\t\t{inputs[6] is not None}")
+        if inputs[4]:
+            print(f"manifest:\t\t{inputs[4]}")
+        process_fasta2MSA(inputs[0],inputs[1],inputs[2],inputs[3],inputs[4],inputs[5],inputs[6])
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
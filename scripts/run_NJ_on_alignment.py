@@ -2,35 +2,248 @@
 
 from Bio import Phylo
 from Bio import AlignIO
-from Bio.Phylo.TreeConstruction import DistanceCalculator
-from Bio.Phylo.TreeConstruction import DistanceTreeConstructor
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from identity_distance import encode_alignment, fasta_alignment, identity_distances, gap_modes
+from fast_nj import build_tree, engines
+from cluster_store import ClusterStore, is_store
+from bootstrap import bootstrap_support, alignment_rng
+from manifest import Manifest
+import telemetry
 import argparse
+import itertools
+import io
 import os
 
-def nj_tree(alignment_file):
-    directory, filename = os.path.split(alignment_file)
-    calculator = DistanceCalculator('identity')
-    align = AlignIO.read(alignment_file, "clustal")
-    distance_matrix = calculator.get_distance(align)
-    constructor = DistanceTreeConstructor()
-    NJTree = constructor.nj(distance_matrix)
+def alignment_tree(align, gaps="identity", engine="nj", bootstrap=0, rng=None):
+    names, codes = encode_alignment(align)
+    return codes_tree(names, codes, gaps, engine, bootstrap, rng)
+
+def codes_tree(names, codes, gaps="identity", engine="nj", bootstrap=0, rng=None):
+    # tree of encoded alignment (see identity_distance.py), None if it has negative branch length
+    telemetry.note(sequences=len(names), length=codes.shape[1])
+    NJTree = build_tree(names, identity_distances(codes, gaps), engine)
 
     # Remove internal node labels
     for internal in NJTree.get_nonterminals():
         internal.name = ""
 
     # Don't save if tree has negative branch length
-    if not any(edge.branch_length is not None and edge.branch_length < 0 for edge in NJTree.find_clades()):
+    if any(edge.branch_length is not None and edge.branch_length < 0 for edge in NJTree.find_clades()):
+        telemetry.note(tree=False)
+        return None
+
+    # Bootstrap support is written as internal node labels
+    if bootstrap > 0:
+        bootstrap_support(NJTree, names, codes, bootstrap, gaps, engine, rng)
+    return NJTree
+
+def read_alignment(text):
+    # clustal (.aln) or aligned FASTA (.afa) text -> names, encoded alignment
+    if text.lstrip().startswith(">"):
+        return fasta_alignment(text)
+    return encode_alignment(AlignIO.read(io.StringIO(text), "clustal"))
+
+def newick_text(NJTree):
+    out = io.StringIO()
+    Phylo.write(NJTree, out, "newick")
+    return out.getvalue()
+
+def tree_path(alignment_file):
+    directory, filename = os.path.split(alignment_file)
+    if directory:
+        directory+='/'
+    return f'{directory}{filename.split(".")[0]}_njtree.nwk'
+
+def nj_tree(alignment_file, gaps="identity", engine="nj", bootstrap=0, seed=1):
+    # bootstrap replicates depend on cluster ID, the same for .aln and .afa file
+    key = os.path.basename(alignment_file).split(".")[0]
+    with open(alignment_file, 'r') as f:
+        names, codes = read_alignment(f.read())
+    NJTree = codes_tree(names, codes, gaps, engine, bootstrap, alignment_rng(seed, f"{key}.aln"))
+    if NJTree is not None:
+        tree_file = tree_path(alignment_file)
+        Phylo.write(NJTree, tree_file, "newick")
+        return tree_file
+    return None
+
+"""
+Function alignment_list() returns paths to all alignments given by input:
+single .aln/.afa file, directory with .aln (clustal) or .afa (aligned FASTA) files or .txt file 
+with paths to clusters (np.txt from split_clusters.py - .fasta paths are mapped to corresponding 
+.aln files, or .afa files, if only they exist)
+"""
+
+def alignment_list(input_path):
+    if os.path.isdir(input_path):
+        return sorted(os.path.join(input_path, f) for f in os.listdir(input_path) if f.endswith('.aln') or f.endswith('.afa'))
+    elif input_path.endswith('.txt'):
+        aln_list = []
+        with open(input_path, 'r') as f:
+            for line in f:
+                if line.strip():
+                    name = os.path.splitext(line.strip())[0]
+                    if not os.path.isfile(name + '.aln') and os.path.isfile(name + '.afa'):
+                        aln_list.append(name + '.afa')
+                    else:
+                        aln_list.append(name + '.aln')
+        return aln_list
+    return [input_path]
+
+def _nj_tree_job(alignment_file, gaps="identity", engine="nj", bootstrap=0, seed=1):
+    key = os.path.basename(alignment_file).split(".")[0]
+    with telemetry.task("NJ", key, per_thread=False, engine=engine, bootstrap=bootstrap) as t:
+        try:
+            t.add(bytes=os.path.getsize(alignment_file))
+            return alignment_file, nj_tree(alignment_file, gaps, engine, bootstrap, seed), ""
+        except (OSError, ValueError) as e:
+            t.add(status=type(e).__name__)
+            return alignment_file, None, str(e)
+
+def _stored_tree_job(item, gaps="identity", engine="nj", bootstrap=0, seed=1):
+    # item: (cluster ID, clustal text) from cluster store; returns newick text instead of file
+    key, text = item
+    with telemetry.task("NJ", key, per_thread=False, engine=engine, bootstrap=bootstrap, bytes=len(text)) as t:
+        try:
+            names, codes = read_alignment(text)
+            NJTree = codes_tree(names, codes, gaps, engine, bootstrap, alignment_rng(seed, f"{key}.aln"))
+            if NJTree is None:
+                return key, None, ""
+            return key, newick_text(NJTree), ""
+        except ValueError as e:
+            t.add(status=type(e).__name__)
+            return key, None, str(e)
+
+def tree_params(gaps, engine, bootstrap, seed):
+    # parameters recorded in manifest
+    return f"gaps={gaps} engine={engine} bootstrap={bootstrap} seed={seed}"
+
+# at most store_chunk alignments per task of worker process
+store_chunk = 32
+
+def windowed_map(executor, job, items, window, chunksize):
+    # executor.map reads the whole input at once: alignments are read from the store window by window,
+    # the next window is submitted before results of the current one are taken (at most two in memory)
+    items = iter(items)
+    pending = None
+    while True:
+        batch = list(itertools.islice(items, window))
+        current = executor.map(job, batch, chunksize=chunksize) if batch else None
+        if pending is not None:
+            yield from pending
+        if current is None:
+            return
+        pending = current
+
+def process_store(store_dir, threads=1, gaps="identity", engine="nj", bootstrap=0, seed=1, manifest=None):
+    # trees of all alignments in cluster store are saved to the same store (kind 'nwk')
+    store = ClusterStore(store_dir)
+    keys = store.keys("aln")
+    kept = {}
+    if manifest is not None:
+        # trees up to date are written again after clearing, the rest is built
+        manifest = Manifest(manifest)
+        params = tree_params(gaps, engine, bootstrap, seed)
+        for key in keys:
+            newick = store.get("nwk", key) if ("nwk", key) in store else None
+            if manifest.current("nj", key, params, texts={"aln": store.get("aln", key), "nwk": newick}):
+                kept[key] = newick
+        print(f'Trees up to date (skipped): {len(kept)}/{len(keys)}', flush=True)
+    store.clear("nwk")
+    store.put_many("nwk", ((key, newick) for key, newick in kept.items() if newick))
+    total = len(keys)
+    keys = [key for key in keys if key not in kept]
+    built = 0
+    failed = []
+    job = partial(_stored_tree_job, gaps=gaps, engine=engine, bootstrap=bootstrap, seed=seed)
+    items = ((key, store.get("aln", key)) for key in keys)
+    if threads > 1:
+        executor = ProcessPoolExecutor(max_workers=threads)
+        chunksize = max(1, min(store_chunk, len(keys) // (threads * 16)))
+        results = windowed_map(executor, job, items, threads * chunksize, chunksize)
+    else:
+        executor = None
+        results = map(job, items)
+    for key, newick, error in results:
+        if newick:
+            store.put("nwk", key, newick)
+            built += 1
+        elif error:
+            failed.append(key)
+            print(f'Tree construction error: {key}\n{error}', flush=True)
+            continue
+        if manifest is not None:
+            manifest.record("nj", key, params, texts={"aln": store.get("aln", key), "nwk": newick})
+    if executor is not None:
+        executor.shutdown()
+    store.close()
+    built += sum(1 for newick in kept.values() if newick)
+    print(f'Trees saved: {built}/{total} (skipped with negative branch length: {total - built - len(failed)}, failed: {len(failed)})')
+    return failed
 
-        if directory:
-            directory+='/'
-        
-        print(f'{directory} and path {filename}')
-        Phylo.write(NJTree, f'{directory}{filename.split(".")[0]}_njtree.nwk', "newick")
+def process_alignments(aln_list, threads=1, gaps="identity", engine="nj", bootstrap=0, seed=1, manifest=None):
+    built = 0
+    failed = []
+    total = len(aln_list)
+    if manifest is not None:
+        # alignments with up to date tree (or without tree, when it had negative branch length) are skipped
+        manifest = Manifest(manifest)
+        params = tree_params(gaps, engine, bootstrap, seed)
+        todo = [alignment_file for alignment_file in aln_list
+                if not manifest.current("nj", alignment_file, params, [alignment_file, tree_path(alignment_file)])]
+        stale = set(todo)
+        built = sum(1 for alignment_file in aln_list if alignment_file not in stale and os.path.isfile(tree_path(alignment_file)))
+        print(f'Trees up to date (skipped): {total - len(todo)}/{total}', flush=True)
+        aln_list = todo
+    job = partial(_nj_tree_job, gaps=gaps, engine=engine, bootstrap=bootstrap, seed=seed)
+    if threads > 1:
+        executor = ProcessPoolExecutor(max_workers=threads)
+        results = executor.map(job, aln_list, chunksize=max(1, len(aln_list) // (threads * 16)))
+    else:
+        executor = None
+        results = map(job, aln_list)
+    for alignment_file, tree_file, error in results:
+        if tree_file:
+            built += 1
+        elif error:
+            failed.append(alignment_file)
+            print(f'Tree construction error: {alignment_file}\n{error}', flush=True)
+            continue
+        elif manifest is not None and os.path.isfile(tree_path(alignment_file)):
+            # tree of the previous version of alignment
+            os.remove(tree_path(alignment_file))
+        if manifest is not None:
+            manifest.record("nj", alignment_file, params, [alignment_file, tree_path(alignment_file)])
+    if executor is not None:
+        executor.shutdown()
+    print(f'Trees saved: {built}/{total} (skipped with negative branch length: {total - built - len(failed)}, failed: {len(failed)})')
+    return failed
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Construct Neighbour Joining tree from a given alignment file')
-    parser.add_argument('aln_file', type=str, help='Path to your alignment file')
+    parser.add_argument('aln_file', type=str, help='Path to your alignment file (clustal .aln or aligned FASTA .afa), directory with .aln/.afa files, .txt file with paths to clusters (np.txt) or cluster store directory')
+    parser.add_argument('-threads', metavar='INT', type=int, default=1, help='Number of worker processes used for a directory or .txt input (default: 1)')
+    parser.add_argument('-gaps', type=str, choices=gap_modes, default='identity', help="""Gap handling in distance computation:
+        identity - gaps are compared as any other symbol (default, the same as Biopython 'identity' model);
+        pairwise - skip columns with a gap in any of the two compared sequences;
+        complete - skip columns with a gap in any sequence""")
+    parser.add_argument('-engine', type=str, choices=engines, default='nj', help="""Tree construction engine:
+        nj - NumPy neighbor joining, gives the same trees as biopython (default);
+        bionj - NumPy BIONJ variant;
+        biopython - DistanceTreeConstructor().nj from Biopython""")
+    parser.add_argument('-bootstrap', metavar='INT', type=int, default=0, help="""Number of bootstrap replicates;
+        support of clades (0-1) is saved as internal node labels of the tree (default: 0 - no bootstrap)""")
+    parser.add_argument('-seed', metavar='INT', type=int, default=1, help='Seed of bootstrap resampling (default: 1)')
+    parser.add_argument('-manifest', metavar='PATH', type=str, default=None, help="""Manifest file (.jsonl, see manifest.py);
+        alignments with tree built before with the same parameters, whose alignment and tree didn't change,
+        are skipped (default: build all trees)""")
     args = parser.parse_args()
-    nj_tree(args.aln_file)
+    if is_store(args.aln_file):
+        process_store(args.aln_file, max(1, args.threads), args.gaps, args.engine, max(0, args.bootstrap), args.seed, args.manifest)
+    elif os.path.isdir(args.aln_file) or args.aln_file.endswith('.txt'):
+        process_alignments(alignment_list(args.aln_file), max(1, args.threads), args.gaps, args.engine, max(0, args.bootstrap), args.seed, args.manifest)
+    else:
+        tree_file = nj_tree(args.aln_file, args.gaps, args.engine, max(0, args.bootstrap), args.seed)
+        if tree_file:
+            print(f'Tree saved to {tree_file}')
@@ -3,6 +3,11 @@
 import os
 import dendropy
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+from cluster_store import ClusterStore, is_store
+from fast_consensus import SplitCounter, taxon_order
+
+engines = ['splits', 'dendropy']
 
 # Function to read taxa from list.txt
 def read_taxa_list(filename):
@@ -17,21 +22,64 @@ def replace_leaves(tree, taxa_list):
         leaf.taxon.label = taxa_list[int(leaf.taxon.label)]
     return tree
 
+# Trees in folder (.nwk/.newick files in os.listdir order) or in cluster store (kind 'nwk')
+def tree_items(folder):
+    if is_store(folder):
+        return ClusterStore(folder).keys('nwk')
+    return [filename for filename in os.listdir(folder) if filename.endswith('.nwk') or filename.endswith('.newick')]
+
+def tree_texts(folder, items):
+    store = ClusterStore(folder) if is_store(folder) else None
+    for item in items:
+        if store is not None:
+            yield store.get('nwk', item)
+        else:
+            with open(os.path.join(folder, item), 'r') as f:
+                yield f.read()
+    if store is not None:
+        store.close()
+
+# Consensus with DendroPy TreeList - all trees are kept in memory
+def dendropy_consensus(folder, taxa_list, min_freq):
+    tree_list = dendropy.TreeList()
+    for text in tree_texts(folder, tree_items(folder)):
+        tree = dendropy.Tree.get(data=text, schema='newick')
+        tree = replace_leaves(tree, taxa_list)
+        tree_list.append(tree)
+    return tree_list.consensus(min_freq=min_freq, is_bipartitions_updated=True)
+
+def count_splits(folder, items, taxa_list, order=None):
+    counter = SplitCounter(taxa_list, order)
+    for text in tree_texts(folder, items):
+        counter.add_newick(text)
+    return counter
+
+# Consensus from split counts (fast_consensus.py) - trees are read one by one; with threads > 1
+# chunks of trees are counted by worker processes, all with the same taxon namespace order
+def split_consensus(folder, taxa_list, min_freq, threads=1, chunk_size=1000):
+    items = tree_items(folder)
+    if threads > 1 and len(items) > chunk_size:
+        order = taxon_order(tree_texts(folder, items), taxa_list)
+        counter = SplitCounter(taxa_list, order)
+        chunks = [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+        with ProcessPoolExecutor(max_workers=threads) as executor:
+            for part in executor.map(count_splits, [folder] * len(chunks), chunks, [taxa_list] * len(chunks), [order] * len(chunks)):
+                counter.update(part)
+    else:
+        counter = count_splits(folder, items, taxa_list)
+    print(f'Trees counted: {counter.trees}, unique splits: {len(counter.counts)}')
+    return counter.consensus_tree(min_freq)
+
 # Main function
-def main(folder, taxa_filename, min_freq):
+def main(folder, taxa_filename, min_freq, engine='splits', threads=1):
     cons_tree = folder + '/CONSENSUS.tree'
-    tree_list = dendropy.TreeList()
     taxa_list = read_taxa_list(taxa_filename)
 
-    for filename in os.listdir(folder):
-        if filename.endswith('.nwk') or filename.endswith('.newick'):
-            tree_path = os.path.join(folder, filename)
-            tree = dendropy.Tree.get(path=tree_path, schema='newick')
-            tree = replace_leaves(tree, taxa_list)
-            tree_list.append(tree)
-
     # Generate consensus tree
-    consensus_tree = tree_list.consensus(min_freq=min_freq, is_bipartitions_updated=True)
+    if engine == 'dendropy':
+        consensus_tree = dendropy_consensus(folder, taxa_list, min_freq)
+    else:
+        consensus_tree = split_consensus(folder, taxa_list, min_freq, threads)
 
     # Save the consensus tree to the output file
     consensus_tree.write(path=cons_tree, schema='newick')
@@ -39,11 +87,14 @@ def main(folder, taxa_filename, min_freq):
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Consensus tree calculator')
-    parser.add_argument('folder', type=str, help='Folder containing tree files .nwk')
+    parser.add_argument('folder', type=str, help='Folder containing tree files .nwk or cluster store directory')
     parser.add_argument('taxa_list', type=str, help='Text file with a list of taxa to replace the numbers')
     parser.add_argument('min_freq', type=float, help='Minimum frequency of splits to be considered in the consensus tree')
+    parser.add_argument('-engine', type=str, choices=engines, default='splits', help="""Consensus engine:
+        splits - streaming split counting with bitmasks, trees are not kept in memory (default);
+        dendropy - DendroPy TreeList.consensus (the same result, all trees in memory)""")
+    parser.add_argument('-threads', metavar='INT', type=int, default=1, help='Number of worker processes counting splits (default: 1)')
 
     args = parser.parse_args()
-    
-    main(args.folder, args.taxa_list, args.min_freq)
 
+    main(args.folder, args.taxa_list, args.min_freq, args.engine, max(1, args.threads))
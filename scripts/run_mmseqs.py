@@ -1,14 +1,18 @@
 #!/usr/bin/env python3
 
 import os
+import sys
 import argparse
 import re
+import shutil
+import subprocess
+import tempfile
 
 def parse_args():
     parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter, 
     description="""Run mmseq2 with selected parameters on merged proteomes.""")
 
-    parser.add_argument('input',metavar= 'i',nargs=1, help="""Path to the input .fasta.gz file containing merged proteomes""")
+    parser.add_argument('input',metavar= 'i',nargs=1, help="""Path to the input .fasta.gz (or .fasta) file containing merged proteomes""")
     parser.add_argument('-msi',metavar= 'FLOAT',nargs=1,
         help="""List matches above this sequence identity (range 0.0-1.0); default 0.3""",default=0.3)
 
@@ -26,6 +30,15 @@ default 0""",default=0)
     parser.add_argument('-c',metavar='FLOAT',nargs=1,
         help="""List matches above this fraction of aligned (covered) residues; default: 0.800""",
         default=0.800)
+    parser.add_argument('-threads',metavar='INT',type=int,nargs=1,help=f"""Number of threads used by mmseqs;
+default: all available cores ({available_cores()})""",default=0)
+    parser.add_argument('-memory',metavar='SIZE',nargs=1,help=f"""mmseqs --split-memory-limit, e.g. 16G;
+default: 80%% of available memory ({default_memory_limit()})""",default="")
+    parser.add_argument('-tmp',metavar='DIR',nargs=1,help="""Directory in which mmseqs temporary directory is created
+(e.g. on tmpfs or local NVMe); default: working_dir""",default="working_dir")
+    parser.add_argument('-tsv_only',action='store_true',help="""Write only [name]_cluster.tsv (mmseqs createdb, cluster
+and createtsv instead of easy-cluster), without [name]_all_seqs.fasta;
+clusters are then read by split_clusters.py [name]_cluster.tsv""")
 #    parser.add_argument('-mmseq_params', metavar ='STRING', nargs="+", # type=str,
 #        help="""other parameters for mmseq2 easy-cluster, first type '-h'""",default="") # don't work
 
@@ -38,7 +51,7 @@ default 0""",default=0)
         print(f"Provide input file: {args.input[0]} doesn't exist")
     else:
         in_file=args.input[0]
-        if not re.search(".+[.]fasta[.]gz$",in_file):
+        if not re.search(".+[.]fasta([.]gz)?$",in_file):
             print(f"Input file {in_file} not recognized as correct .fasta.gz file.")
             in_file=""
     msi=0.3
@@ -57,35 +70,101 @@ default 0""",default=0)
         args.covMode=args.covMode[0]
     if isinstance(args.clusterMode,list):
         args.clusterMode=args.clusterMode[0]
+    threads=args.threads[0] if isinstance(args.threads,list) else args.threads
+    if threads<1:
+        threads=available_cores()
+    memory=args.memory[0] if isinstance(args.memory,list) else default_memory_limit()
+    tmp=args.tmp[0] if isinstance(args.tmp,list) else args.tmp
 #    mmseq_params=""
 #    if isinstance(args.mmseq_params,list):
 #        mmseq_params=args.mmseq_params[0]
 
     if in_file:    
-        return[in_file,msi,args.clusterMode,args.covMode,c] #,mmseq_params ]
+        return[in_file,msi,args.clusterMode,args.covMode,c,threads,memory,tmp,args.tsv_only] #,mmseq_params ]
     else:
         return None
 
 
+"""
+Resources for mmseqs are taken from the machine: cores available to this process (CPU affinity) and 
+available memory (MemAvailable from /proc/meminfo, limited by cgroup memory limit if it's lower).
+"""
+
+def available_cores():
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+def available_memory():
+    # bytes of memory which can be used without swapping, None if unknown
+    memory=None
+    try:
+        with open("/proc/meminfo","r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    memory=int(line.split()[1])*1024
+    except OSError:
+        pass
+    for limit_file in ["/sys/fs/cgroup/memory.max","/sys/fs/cgroup/memory/memory.limit_in_bytes"]:
+        try:
+            with open(limit_file,"r") as f:
+                limit=f.read().strip()
+            if limit.isdigit():
+                memory=int(limit) if memory is None else min(memory,int(limit))
+        except OSError:
+            pass
+    return memory
+
+def default_memory_limit():
+    memory=available_memory()
+    if memory is None:
+        return ""
+    return f"{max(1,int(memory*0.8/1024**2))}M"
+
 def main():
     inputs=parse_args()
     
     if not inputs is None:
         print(f"{' '*16}> Rum mmsq2 < \n\n{'#'*20}START{'#'*20}")
         print(f"\nInput file:\t\t\t{inputs[0]}\nMin seq identity:\t\t{inputs[1]}\nClustering mode:\t\t{inputs[2]}\nCoverage mode:\t\t\t{inputs[3]}\nCoverage:\t\t{inputs[4]}")
-        output=inputs[0].replace(".fasta.gz","")
+        print(f"Threads:\t\t\t{inputs[5]}\nMemory limit:\t\t\t{inputs[6] or 'mmseqs default'}\nTemporary files in:\t\t{inputs[7]}")
+        output=re.sub("[.]fasta([.]gz)?$","",inputs[0])
+        for suffix in ["_rep_seq.fasta","_cluster.tsv","_all_seqs.fasta"]:
+            if os.path.isfile(f"{output}{suffix}"):
+                os.remove(f"{output}{suffix}")
+        print(f"Output files:\t\t\t{output} [{'' if inputs[8] else '_all_seq.fasta, '}_cluster.tsv]")
+        os.makedirs(inputs[7],exist_ok=True)
+        tmp_dir=tempfile.mkdtemp(prefix="mmseqs_",dir=inputs[7])
+        options=["--min-seq-id",str(inputs[1]),"--cluster-mode",str(inputs[2]),"--cov-mode",str(inputs[3]),
+            "-c",str(inputs[4]),"--threads",str(inputs[5])]
+        if inputs[6]:
+            options+=["--split-memory-limit",inputs[6]]
+        if inputs[8]:
+            db=os.path.join(tmp_dir,"db")
+            clu=os.path.join(tmp_dir,"clu")
+            commands=[["mmseqs","createdb",inputs[0],db],
+                ["mmseqs","cluster",db,clu,os.path.join(tmp_dir,"tmp")]+options,
+                ["mmseqs","createtsv",db,db,clu,f"{output}_cluster.tsv","--threads",str(inputs[5])]]
+        else:
+            commands=[["mmseqs","easy-cluster",inputs[0],output,tmp_dir]+options]
+        returncode=0
+        try:
+            for command in commands:
+                result=subprocess.run(command)
+                returncode=result.returncode
+                if returncode!=0:
+                    break
+        except OSError as e:
+            print(f"Cannot run mmseqs: {e}")
+            returncode=127
+        finally:
+            shutil.rmtree(tmp_dir,ignore_errors=True)
+        if returncode!=0:
+            print(f"mmseqs {command[1]} failed with exit code {returncode}")
+            sys.exit(returncode)
         if os.path.isfile(f"{output}_rep_seq.fasta"):
-            os.system(f"rm {output}_rep_seq.fasta")
-        if os.path.isfile(f"{output}_cluster.tsv"):
-            os.system(f"rm {output}_cluster.tsv")
-        if os.path.isfile(f"{output}_all_seqs.fasta"):
-            os.system(f"rm {output}_all_seqs.fasta")
-        print(f"Output files:\t\t\t{output} [_all_seq.fasta, _cluster.tsv]")
-        os.system(f"mmseqs easy-cluster {inputs[0]} {output} working_dir/tmpDir --min-seq-id {inputs[1]} --cluster-mode {inputs[2]} --cov-mode {inputs[3]} -c {inputs[4]}")
-        os.system(f"rm {output}_rep_seq.fasta")
-        os.system("rm -r working_dir/tmpDir")
-        os.system(f"rm {output}_cluster.tsv")
+            os.remove(f"{output}_rep_seq.fasta")
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -4,6 +4,8 @@
 import argparse
 import os
 import re
+from concurrent.futures import ProcessPoolExecutor
+from cluster_store import ClusterStore, index_sequences
 
 
 def parse_args():
@@ -22,14 +24,29 @@ def parse_args():
      p.txt  (paralogous, if cluster doesn't contain paralogous, path is the same as in pa.txt)
     containing paths to corresponding fasta files, to aviod comuting the filogenetic trees twice.
 
+    With -store clusters are saved to indexed cluster store [name]/store (np.pack/np.idx,
+    pa.pack/pa.idx; see cluster_store.py) instead of [name]/nonpara and [name]/para;
+    np.txt and p.txt still contain paths of files made by export of the store.
+
+    Input can be also [name]_cluster.tsv from mmseq2: clusters are selected from the
+    tsv file only and sequences of the selected clusters are read from indexed copy
+    of merged proteomes ([name]/store/seq.pack, made from [name].fasta.gz when missing
+    or older than it), so [name]_all_seqs.fasta is not needed.
+
     """)
 
     parser.add_argument('input',metavar='i', nargs=1, help="""Path to the result 
-        [name]_all_seqs.fasta file from mmseq2""", default=None)
+        [name]_all_seqs.fasta or [name]_cluster.tsv file from mmseq2""", default=None)
     parser.add_argument('-c',metavar='FLOAT',nargs=1,
         help="""float value used to compute cutoff -> minimum number of sequences 
         in each cluster, should be 0 <= c < 1; default: 0.3""",
         default=0.3)
+    parser.add_argument('-threads',metavar='INT',type=int,nargs=1,help="""Number of worker processes 
+        writing cluster files (default: 1 - written by the main process)""",default=1)
+    parser.add_argument('-store',action='store_true',help="""Save clusters to indexed cluster store
+        [name]/store instead of separate fasta files""")
+    parser.add_argument('-merged',metavar='PATH',nargs=1,help="""Merged proteomes used for clustering,
+        read with [name]_cluster.tsv input; default: [name].fasta.gz (or [name].fasta)""",default=None)
     args = parser.parse_args()
     in_file=""
     if args.input is None:
@@ -38,8 +55,18 @@ def parse_args():
         print(f"Provide input file: {args.input[0]} doesn't exist")
     else:
         in_file=args.input[0]
-        if not re.search(".+_all_seqs[.]fasta$",in_file):
-            print(f"Input file {in_file} not recognized as correct [name]_all_seqs.fasta file.")
+        if not re.search(".+(_all_seqs[.]fasta|_cluster[.]tsv)$",in_file):
+            print(f"Input file {in_file} not recognized as correct [name]_all_seqs.fasta or [name]_cluster.tsv file.")
+            in_file=""
+    merged=""
+    if in_file.endswith("_cluster.tsv"):
+        if isinstance(args.merged,list):
+            merged=args.merged[0]
+        else:
+            name=in_file[:-len("_cluster.tsv")]
+            merged=f"{name}.fasta.gz" if os.path.isfile(f"{name}.fasta.gz") else f"{name}.fasta"
+        if not os.path.isfile(merged):
+            print(f"Provide merged proteomes file: {merged} doesn't exist")
             in_file=""
     c=0.1
     if isinstance(args.c,list):
@@ -47,82 +74,201 @@ def parse_args():
             c=float(args.c[0])
         else:
             print("parametr: msi = {args.c[0]} out of range, changing to 0.800")
+    if isinstance(args.threads,list):
+        args.threads=args.threads[0]
     if in_file:    
-        return[in_file,c]
+        return[in_file,c,max(1,args.threads),args.store,merged]
     else:
         return None
 
-def process_clusters(clusters,output_dir,cutoff):
-    np=open(f"{output_dir}/np.txt","w")
-    pa=open(f"{output_dir}/p.txt","w")
+"""
+Function process_clusters() reads [name]_all_seqs.fasta in one pass; the first sequence of each organism 
+in a cluster goes to nonparalogous (np_[p]_[n].fasta) file, next ones are paralogs (added with the 
+nonparalogous ones to pa_[p]_[n].fasta). Cluster files are formatted in memory (sequences wrapped 
+to 50 characters) and written at once; with threads > 1 batches of clusters are formatted 
+and written by worker processes, np.txt and p.txt are always written in cluster order.
+With store (ClusterStore) the texts are appended to the store by the main process.
+"""
 
-    p=1
-    list_npID=[]
-    list_pID=[]
-    list_npSEQ=[]
-    list_pSEQ=[]
-    with open(clusters,"r") as clust_file:
-        go=False
+species_id=re.compile("[0-9]+[gmr]")
+
+def fasta_text(ids,seqs,spaces):
+    lines=[]
+    for name,seq in zip(ids,seqs):
+        lines.append(f">{name}{spaces}\n")
+        lines.extend(f"{seq[i:i+50]}\n" for i in range(0,len(seq),50))
+    return "".join(lines)
+
+def cluster_texts(np_ids,np_seqs,p_ids,p_seqs):
+    np_text=fasta_text(np_ids,np_seqs," "*6)
+    pa_text=np_text+fasta_text(p_ids,p_seqs," "*5) if p_ids else ""
+    return np_text,pa_text
+
+def write_cluster(np_path,pa_path,np_ids,np_seqs,p_ids,p_seqs):
+    np_text,pa_text=cluster_texts(np_ids,np_seqs,p_ids,p_seqs)
+    with open(np_path,"w") as f:
+        f.write(np_text)
+    if pa_path:
+        with open(pa_path,"w") as g:
+            g.write(pa_text)
+
+def store_cluster(store,np_path,pa_path,np_ids,np_seqs,p_ids,p_seqs):
+    # cluster ID in the store is the file name without .fasta
+    np_text,pa_text=cluster_texts(np_ids,np_seqs,p_ids,p_seqs)
+    store.put("np",os.path.basename(np_path)[:-len(".fasta")],np_text)
+    if pa_path:
+        store.put("pa",os.path.basename(pa_path)[:-len(".fasta")],pa_text)
+
+def write_clusters(batch):
+    for cluster in batch:
+        write_cluster(*cluster)
+    return len(batch)
+
+def read_clusters(clusters):
+    # yields (np_ids, np_seqs, p_ids, p_seqs) of every cluster closed by the next cluster header,
+    # and of the last cluster at the end of file (as tsv_clusters() does)
+    np_ids=[]
+    np_set=set()
+    p_ids=[]
+    np_seqs=[]
+    p_seqs=[]
+    nr=0
+    go=False
+    with open(clusters,"r",buffering=1024*1024) as clust_file:
         for line in clust_file:
-            if line[0]==">" and len(line.strip().split())==1:
-                if len(list_npID)>=cutoff:
-                    
-                    f=open(f"{output_dir}/nonpara/np_{p}_{len(list_npID)}.fasta","w")
-                    if list_pID:
-                        g=open(f"{output_dir}/para/pa_{p}_{len(list_npID)}.fasta","w")
-                    for ids,seq in zip(list_npID,list_npSEQ):
-                        f.write(f">{ids}      \n")
-                        if list_pID:
-                            g.write(f">{ids}      \n")
-                        while len(seq)>50:
-                            f.write(f"{seq[:50]}\n")
-                            if list_pID:
-                                g.write(f"{seq[:50]}\n")
-                            seq=seq[50:]
-                        if seq:
-                            f.write(f"{seq}\n")
-                            if list_pID:
-                                g.write(f"{seq}\n")
-                    f.close()
-                    if list_pID:
-                        for ids,seq in zip(list_pID,list_pSEQ):
-                            g.write(f">{ids}     \n")
-                            while len(seq)>50:
-                                g.write(f"{seq[:50]}\n")
-                                seq=seq[50:]
-                            if seq:
-                                g.write(f"{seq}\n")
-                        g.close()
-
-                    np.write(f"{output_dir}/nonpara/np_{p}_{len(list_npID)}.fasta\n")
-                    if list_pID:
-                        pa.write(f"{output_dir}/para/pa_{p}_{len(list_npID)}.fasta\n")
-                    else:
-                        pa.write(f"{output_dir}/nonpara/np_{p}_{len(list_npID)}.fasta\n")
-                    p+=1
-                    
-                list_npID=[]
-                list_pID=[]
-                list_npSEQ=[]
-                list_pSEQ=[]
-                nr=0
-            elif line[0]==">":
-                line=line.strip().split()
-                line=re.findall("^[0-9]+[gmr]",line[0][1:])[0]
-                line=line[:len(line)-1]
-                if line in list_npID:
+            if line[0]==">":
+                fields=line.split()
+                if len(fields)==1:
+                    yield np_ids,np_seqs,p_ids,p_seqs
+                    np_ids=[]
+                    np_set=set()
+                    p_ids=[]
+                    np_seqs=[]
+                    p_seqs=[]
+                    nr=0
+                    continue
+                found=species_id.match(fields[0],1)
+                if found is None:
+                    raise ValueError(f"Sequence id not recognized as unified id (see merge_proteomes.py): {fields[0]}")
+                name=found.group()[:-1]
+                if name in np_set:
                     go=False
-                    list_pID.append(f"{line}_{nr}")
+                    p_ids.append(f"{name}_{nr}")
                     nr+=1
                 else:
-                    list_npID.append(line)
+                    np_ids.append(name)
+                    np_set.add(name)
                     go=True
+            elif go:
+                np_seqs.append(line.strip())
             else:
-                
-                if go:
-                    list_npSEQ.append(line.strip())
-                else:
-                    list_pSEQ.append(line.strip())
+                p_seqs.append(line.strip())
+    if np_ids or p_ids:
+        yield np_ids,np_seqs,p_ids,p_seqs
+
+"""
+Functions for [name]_cluster.tsv input: select_clusters() reads the tsv (lines: representative \t member,
+grouped by clusters) and keeps members of clusters with at least cutoff organisms; tsv_clusters() 
+yields the selected clusters in the same form as read_clusters(), with sequences read from kind 'seq' 
+of the store - only offsets of the selected sequences are looked up in the index.
+"""
+
+def split_members(members):
+    np_members=[]
+    np_ids=[]
+    p_members=[]
+    p_ids=[]
+    np_set=set()
+    nr=0
+    for member in members:
+        found=species_id.match(member)
+        if found is None:
+            raise ValueError(f"Sequence id not recognized as unified id (see merge_proteomes.py): {member}")
+        name=found.group()[:-1]
+        if name in np_set:
+            p_members.append(member)
+            p_ids.append(f"{name}_{nr}")
+            nr+=1
+        else:
+            np_members.append(member)
+            np_ids.append(name)
+            np_set.add(name)
+    return np_members,np_ids,p_members,p_ids
+
+def select_clusters(tsv,cutoff):
+    selected=[]
+    representative=None
+    members=[]
+    with open(tsv,"r",buffering=1024*1024) as f:
+        for line in f:
+            fields=line.rstrip("\n").split("\t")
+            if len(fields)<2:
+                continue
+            if fields[0]!=representative:
+                if members:
+                    cluster=split_members(members)
+                    if len(cluster[1])>=cutoff:
+                        selected.append(cluster)
+                representative=fields[0]
+                members=[]
+            members.append(fields[1])
+    if members:
+        cluster=split_members(members)
+        if len(cluster[1])>=cutoff:
+            selected.append(cluster)
+    return selected
+
+def tsv_clusters(tsv,cutoff,store):
+    selected=select_clusters(tsv,cutoff)
+    needed=set()
+    for np_members,np_ids,p_members,p_ids in selected:
+        needed.update(np_members)
+        needed.update(p_members)
+    offsets=store.lookup("seq",needed)
+    missing=needed.difference(offsets)
+    if missing:
+        raise ValueError(f"{len(missing)} sequences not found in merged proteomes, e.g.: {sorted(missing)[0]}")
+    for np_members,np_ids,p_members,p_ids in selected:
+        np_seqs=[store.read("seq",*offsets[member]) for member in np_members]
+        p_seqs=[store.read("seq",*offsets[member]) for member in p_members]
+        yield np_ids,np_seqs,p_ids,p_seqs
+
+def process_clusters(clusters,output_dir,cutoff,threads=1,batch_size=256,store=None):
+    # clusters: path of [name]_all_seqs.fasta or iterable of clusters (e.g. from tsv_clusters())
+    if isinstance(clusters,str):
+        clusters=read_clusters(clusters)
+    np=open(f"{output_dir}/np.txt","w")
+    pa=open(f"{output_dir}/p.txt","w")
+    executor=ProcessPoolExecutor(max_workers=threads) if threads>1 and store is None else None
+    pending=[]
+    batch=[]
+    p=1
+    for np_ids,np_seqs,p_ids,p_seqs in clusters:
+        if len(np_ids)>=cutoff:
+            np_path=f"{output_dir}/nonpara/np_{p}_{len(np_ids)}.fasta"
+            pa_path=f"{output_dir}/para/pa_{p}_{len(np_ids)}.fasta" if p_ids else ""
+            cluster=(np_path,pa_path,np_ids,np_seqs,p_ids,p_seqs)
+            if store is not None:
+                store_cluster(store,*cluster)
+            elif executor is None:
+                write_cluster(*cluster)
+            else:
+                batch.append(cluster)
+                if len(batch)>=batch_size:
+                    pending.append(executor.submit(write_clusters,batch))
+                    batch=[]
+                    # limit number of batches waiting in memory
+                    if len(pending)>=threads*4:
+                        pending.pop(0).result()
+            np.write(f"{np_path}\n")
+            pa.write(f"{pa_path or np_path}\n")
+            p+=1
+    if executor is not None:
+        if batch:
+            pending.append(executor.submit(write_clusters,batch))
+        for job in pending:
+            job.result()
+        executor.shutdown()
     np.close()
     pa.close()
 
@@ -132,12 +278,29 @@ def main():
     if not inputs is None:
         print(f"{' '*12}> Split clusters file < \n\n{'#'*20}START{'#'*20}")
         print(f"\nInput file:\t\t\t{inputs[0]}")
-        output=inputs[0].replace("_all_seqs.fasta","")
+        output=re.sub("(_all_seqs[.]fasta|_cluster[.]tsv)$","",inputs[0])
         cutoff=max(3,int(inputs[1]*int(re.findall("[0-9]+$",output)[0])))
         print(f"cutoff\t\t\t\t{cutoff}")
         if not os.path.exists(output):
             print(f"Preparing output directory:\t{output}")
             os.mkdir(output)
+        clusters=inputs[0]
+        store=None
+        if inputs[4]:
+            print(f"Merged proteomes:\t\t{inputs[4]}")
+            store=ClusterStore(f"{output}/store")
+            if index_sequences(inputs[4],store):
+                print(f"Sequences indexed in:\t\t{output}/store/seq.pack")
+            clusters=tsv_clusters(inputs[0],cutoff,store)
+        if inputs[3]:
+            store=store or ClusterStore(f"{output}/store")
+            # clusters are numbered from 1 again, so old entries (also alignments and trees) are outdated
+            for kind in ("np","pa","aln","nwk"):
+                store.clear(kind)
+            print(f"Output cluster store:\t\t{output}/store")
+            process_clusters(clusters,output,cutoff,store=store)
+            store.close()
+            return
         if not os.path.exists(f"{output}/nonpara"):
             print(f"Preparing nonpara directory:\t{output}/nonpara")
             os.mkdir(f"{output}/nonpara") 
@@ -146,7 +309,9 @@ def main():
             os.mkdir(f"{output}/para")
         print(f"Output directory:\t\t{output}")
 
-        process_clusters(inputs[0],output,cutoff)
+        process_clusters(clusters,output,cutoff,inputs[2])
+        if store is not None:
+            store.close()
         
 
 
@@ -0,0 +1,395 @@
+#!/usr/bin/env python3
+
+"""
+Script Name: stream_pipeline.py
+
+Description:
+Streaming execution of MSA, NJ trees and consensus steps. Every cluster flows through
+align -> distance matrix -> NJ tree -> split counting as soon as its previous stage is done,
+so cores are not idle at step boundaries and the largest clusters don't hold back trees and
+consensus of the rest:
+> align  - -threads aligner jobs (threads running the aligner, run_MSA.aligned_fasta),
+> tree   - -threads worker processes: aligned FASTA is encoded once and distance matrix and
+           NJ tree are computed as by run_MSA.py -tree (run_MSA.direct_outputs),
+> count  - the main process saves the tree (next to the cluster or in cluster store), records
+           the cluster in manifest and adds splits of the tree to the counter (fast_consensus.py).
+
+Stages are bounded: at most -threads + -queue clusters are between start of the alignment and
+counting, so aligned texts don't pile up in memory when tree building is slower than aligners
+(aligners wait instead).
+
+Provisional consensus of trees counted so far is written to [folder]/CONSENSUS.partial.tree
+every -every seconds and at any moment on request: kill -USR1 [pid]. At the end the consensus
+is computed again from all saved trees, in the same order as by run_consensus.py (taxon order
+depends on order of the trees), so [folder]/CONSENSUS.tree is the same as of the separate steps.
+Folder is the cluster store directory or the directory of the clusters ([name]/nonpara).
+
+Clusters up to date in manifest (the same records as of run_MSA.py -tree) are not aligned
+again, their saved trees are counted at start.
+
+Early stopping (-converge MARGIN): clusters are processed in random order (-seed) and split
+frequencies are checked while trees are counted; when topology of the consensus didn't change and
+frequency of every non-trivial split of the consensus tree stayed at least MARGIN above min_freq
+over the last -window trees, no more clusters are aligned (those already started are finished)
+and the consensus is made of trees built so far. Splits outside the consensus (also rare splits
+of single gene trees) don't hold back the stop. Number of trees and confidence of the weakest
+split of the consensus (normal approximation of binomial test of frequency = min_freq) are reported.
+Clusters not aligned are not recorded in manifest, so the next run without -converge continues
+with them.
+
+Usage:
+    python stream_pipeline.py [name]/np.txt species.txt 0.5 [-mode 0] [-threads 4] [-manifest manifest.jsonl]
+"""
+
+import os
+import time
+import queue
+import signal
+import shutil
+import tempfile
+import argparse
+import random
+import math
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from cluster_store import ClusterStore, is_store
+from manifest import Manifest
+from fast_consensus import SplitCounter
+from identity_distance import gap_modes
+from fast_nj import engines
+from run_MSA import aligners, aln_formats, aligned_fasta, direct_outputs, save_outputs, cluster_cost, up_to_date, record_alignment
+from run_NJ_on_alignment import tree_path
+from run_consensus import read_taxa_list, split_consensus, tree_items, count_splits
+import telemetry
+
+
+def cluster_key(item):
+    # cluster ID of fasta path or of cluster store key
+    return os.path.basename(item).replace('.fasta', '')
+
+
+def align_job(store, item, mode, tmp_dir):
+    """Align stage: (ok, error message, aligned FASTA text) of the cluster."""
+    path = item
+    if store is not None:
+        path = os.path.join(tmp_dir, f"{item}.fasta")
+        with open(path, "w") as f:
+            f.write(store.get("np", item))
+    try:
+        with telemetry.task("MSA", cluster_key(item), aligner=aligners[mode], bytes=os.path.getsize(path)) as t:
+            ok, message, text = aligned_fasta(path, mode)
+            if not ok:
+                t.add(status="failed")
+            return ok, message, text
+    finally:
+        if store is not None:
+            os.remove(path)
+
+
+def tree_job(key, text, aln_format, tree):
+    # tree stage, run in worker process
+    with telemetry.task("NJ", key, per_thread=False, engine=tree[1], bootstrap=tree[2], bytes=len(text)):
+        return direct_outputs(key, text, aln_format, tree)
+
+
+def write_consensus(counter, min_freq, path):
+    # written to temporary file and renamed, so the tree is never read half-written
+    tmp = f"{path}.tmp"
+    counter.consensus_tree(min_freq).write(path=tmp, schema="newick")
+    os.replace(tmp, path)
+
+
+def tree_name(store, item):
+    # name of the tree in run_consensus.tree_items()
+    return item if store is not None else os.path.basename(tree_path(item))
+
+
+def saved_trees(store, items):
+    # trees of clusters up to date (clusters with negative branch length have none)
+    for item in items:
+        if store is not None:
+            if ("nwk", item) in store:
+                yield item, store.get("nwk", item)
+        elif os.path.isfile(tree_path(item)):
+            with open(tree_path(item), "r") as f:
+                yield item, f.read()
+
+
+def trivial_split(split, all_taxa):
+    # leaf branch or split of all taxa (also their complements: splits of unrooted trees)
+    for side in (split, ~split & all_taxa):
+        if side & (side - 1) == 0:
+            return True
+    return False
+
+
+class Convergence:
+    """Consensus is stable, when its topology didn't change and frequency of every non-trivial split
+    of the consensus tree was at least margin above min_freq in all checks over the last window trees;
+    splits are checked every window/20 trees."""
+
+    def __init__(self, min_freq, margin, window=1000):
+        self.min_freq = min_freq
+        self.margin = margin
+        self.window = window
+        self.step = max(1, window // 20)
+        self.checked = 0
+        self.stable_since = 0
+        self.closest = None
+        self.topology = None
+
+    def update(self, counter):
+        trees = counter.trees
+        if trees - self.checked < self.step:
+            return False
+        self.checked = trees
+        topology = self.topology
+        if self.measure(counter) < self.margin or self.topology != topology:
+            self.stable_since = trees
+        return trees - self.stable_since >= self.window
+
+    def measure(self, counter):
+        # distance of the weakest split of the consensus tree from min_freq: splits taken to the
+        # consensus (frequency >= min_freq), without leaf branches and the root branch of all taxa
+        trees = max(1, counter.trees)
+        all_taxa = (1 << len(counter.labels)) - 1
+        splits = {split: count / trees for split, count in counter.counts.items()
+                  if count >= self.min_freq * trees and not trivial_split(split, all_taxa)}
+        self.topology = frozenset(splits)
+        # star tree: as if the weakest split was in every tree
+        self.closest = min(splits.values(), default=1.0) - self.min_freq
+        return self.closest
+
+    def confidence(self, trees):
+        # one-sided normal approximation: the weakest split of the consensus is above min_freq
+        if self.closest is None or not trees:
+            return 0.0
+        error = math.sqrt(self.min_freq * (1 - self.min_freq) / trees) or 1.0
+        return 0.5 * (1 + math.erf(self.closest / error / math.sqrt(2)))
+
+
+def process_stream(input_file, taxa_filename, min_freq, mode=0, threads=1, tree=("identity", "nj", 0, 1),
+                   aln_format="none", manifest=None, queue_size=None, every=60.0, margin=None, window=1000):
+    store = None
+    if is_store(input_file):
+        store = ClusterStore(input_file)
+        items = store.keys("np")
+        folder = input_file
+    else:
+        with open(input_file, "r") as f:
+            items = [line.strip() for line in f if line.strip()]
+        folder = os.path.dirname(items[0]) if items else os.path.dirname(input_file)
+    taxa_list = read_taxa_list(taxa_filename)
+    counter = SplitCounter(taxa_list)
+    total = len(items)
+    current = []
+    if manifest is not None:
+        manifest = Manifest(manifest)
+        todo = [item for item in items if not up_to_date(manifest, store, item, mode, aln_format, tree)]
+        stale = set(todo)
+        current = [item for item in items if item not in stale]
+        items = todo
+        print(f"Clusters up to date (skipped):\t{total - len(items)}/{total}", flush=True)
+    if store is not None:
+        # trees of clusters aligned again are replaced (the store can't remove single entries)
+        stale = set(items)
+        kept = [(key, store.get("nwk", key)) for key in store.keys("nwk") if key not in stale]
+        store.clear("nwk")
+        store.put_many("nwk", kept)
+    counted = []
+    for item, text in saved_trees(store, current):
+        counter.add_newick(text)
+        counted.append(item)
+    convergence = None
+    if margin is not None:
+        # trees counted so far have to be a random sample of all clusters
+        convergence = Convergence(min_freq, margin, window)
+        random.Random(tree[3]).shuffle(items)
+    elif threads > 1:
+        if store is None:
+            items.sort(key=cluster_cost, reverse=True)
+        else:
+            items.sort(key=lambda key: int(key.split("_")[-1]) * store.index("np")[key][1], reverse=True)
+
+    partial = os.path.join(folder, "CONSENSUS.partial.tree")
+    requested = threading.Event()
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGUSR1, lambda signum, frame: requested.set())
+    results = queue.Queue()
+    slots = threading.BoundedSemaphore(threads + (8 * threads if queue_size is None else max(1, queue_size)))
+    tmp_dir = tempfile.mkdtemp(prefix="ect_stream_") if store is not None else None
+    align_pool = ThreadPoolExecutor(max_workers=threads)
+    # worker processes are started by fork server, not forked from this process with running aligner threads
+    tree_pool = ProcessPoolExecutor(max_workers=threads, mp_context=multiprocessing.get_context("forkserver"))
+
+    def aligned(item):
+        # every cluster has to reach the count stage, which waits for it
+        try:
+            ok, message, text = align_job(store, item, mode, tmp_dir)
+            if ok:
+                job = tree_pool.submit(tree_job, cluster_key(item), text, aln_format, tree)
+                job.add_done_callback(lambda job: results.put((item, job, "")))
+                return
+        except Exception as e:
+            message = f"{type(e).__name__}: {e}"
+        results.put((item, None, message))
+
+    stop = threading.Event()
+    fed_all = threading.Event()
+    fed = 0
+
+    def feed():
+        nonlocal fed
+        for item in items:
+            slots.acquire()
+            if stop.is_set():
+                break
+            fed += 1
+            align_pool.submit(aligned, item)
+        fed_all.set()
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+    written = 0
+    last = time.monotonic()
+
+    def provisional():
+        nonlocal written, last
+        due = requested.is_set() or (time.monotonic() - last >= every and counter.trees > written)
+        if due and counter.trees:
+            requested.clear()
+            write_consensus(counter, min_freq, partial)
+            written, last = counter.trees, time.monotonic()
+            print(f"Provisional consensus of {counter.trees} trees saved to {partial}", flush=True)
+
+    failed = []
+    received = 0
+    while not (fed_all.is_set() and received == fed):
+        try:
+            item, job, message = results.get(timeout=1.0)
+        except queue.Empty:
+            provisional()
+            continue
+        received += 1
+        outputs = None
+        try:
+            # any error of one cluster (tree worker, saving, counting) fails only this cluster
+            if job is not None:
+                outputs = job.result()
+            if outputs is not None:
+                save_outputs(store, item, outputs, aln_format)
+                if manifest is not None:
+                    record_alignment(manifest, store, item, mode, aln_format, tree)
+                if outputs["nwk"] is not None:
+                    counter.add_newick(outputs["nwk"])
+                    counted.append(item)
+        except Exception as e:
+            outputs = None
+            message = f"{type(e).__name__}: {e}"
+        finally:
+            slots.release()
+        if outputs is None:
+            failed.append(item)
+            print(f"{aligners[mode]} error!!! {received}/{len(items)}\t{item}\n{message.strip()}", flush=True)
+            continue
+        print(f"Stream progress:\t{received}/{len(items)}\t{os.path.basename(item)}\ttrees counted: {counter.trees}", flush=True)
+        if convergence is not None and not stop.is_set() and convergence.update(counter):
+            stop.set()
+            print(f"Consensus converged after {counter.trees} trees, no more clusters are aligned", flush=True)
+        provisional()
+    feeder.join()
+    align_pool.shutdown()
+    tree_pool.shutdown()
+    if store is not None:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        store.close()
+    if failed:
+        print(f"\n{len(failed)}/{len(items)} clusters failed:")
+        for item in failed:
+            print(item)
+
+    print(f"Trees counted while streaming: {counter.trees}, unique splits: {len(counter.counts)}")
+    if convergence is not None:
+        convergence.measure(counter)
+        print(f"Convergence:\t{'reached' if stop.is_set() else 'not reached'} (margin: {margin}, window: {window} trees)\n"
+              f"Clusters aligned:\t{fed}/{len(items)} (not aligned: {len(items) - fed})\n"
+              f"Trees used:\t{counter.trees}\nWeakest split:\t{convergence.closest:.4f} above min_freq\n"
+              f"Confidence:\t{convergence.confidence(counter.trees):.4f}")
+    if stop.is_set():
+        # only trees counted before the stop (not the older trees of clusters not aligned now)
+        names = {tree_name(store, item) for item in counted}
+        consensus_tree = count_splits(folder, [name for name in tree_items(folder) if name in names], taxa_list).consensus_tree(min_freq)
+    else:
+        consensus_tree = split_consensus(folder, taxa_list, min_freq, threads)
+    consensus_tree.write(path=os.path.join(folder, "CONSENSUS.tree"), schema="newick")
+    if os.path.isfile(partial):
+        os.remove(partial)
+    print(f"Consensus tree saved to {os.path.join(folder, 'CONSENSUS.tree')}")
+    return failed
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+    description="""Align clusters, build NJ trees and count their splits for consensus tree as one streaming
+    pipeline (see the description in the script); trees are saved as by run_MSA.py -tree, the consensus tree
+    as by run_consensus.py, provisional consensus is written during the run (kill -USR1 [pid] to write it now)""")
+    parser.add_argument('input', type=str, nargs=1, help=""".txt file with paths to fasta files of clusters (np.txt)
+        or cluster store directory""")
+    parser.add_argument('taxa_list', type=str, nargs=1, help="Text file with a list of taxa to replace the numbers")
+    parser.add_argument('min_freq', type=float, nargs=1, help="Minimum frequency of splits to be considered in the consensus tree")
+    parser.add_argument('-mode', metavar='INT', type=int, nargs=1, choices=[0, 1, 2], help="""Algorithm used to MSA:
+        0 - ClustalW (default); 1 - Muscle; 2 - Mafft;""", default=[0])
+    parser.add_argument('-threads', metavar='INT', type=int, nargs=1, help="""Number of aligner jobs and of tree
+        worker processes (default: 1)""", default=[1])
+    parser.add_argument('-queue', metavar='INT', type=int, nargs=1, help="""Number of aligned clusters, which can
+        wait for tree building and counting (default: 8 per thread)""", default=[None])
+    parser.add_argument('-every', metavar='SECONDS', type=float, nargs=1, help="""Interval of writing provisional
+        consensus tree (default: 60)""", default=[60.0])
+    parser.add_argument('-aln', type=str, nargs=1, choices=aln_formats, help="""Format of saved alignment:
+        clustal (.aln), fasta (.afa) or none (default: none)""", default=["none"])
+    parser.add_argument('-gaps', type=str, nargs=1, choices=gap_modes, help="""Gap handling in distance computation,
+        see run_NJ_on_alignment.py (default: identity)""", default=["identity"])
+    parser.add_argument('-engine', type=str, nargs=1, choices=engines, help="""Tree construction engine,
+        see run_NJ_on_alignment.py (default: nj)""", default=["nj"])
+    parser.add_argument('-bootstrap', metavar='INT', type=int, nargs=1, help="""Number of bootstrap replicates
+        (default: 0 - no bootstrap)""", default=[0])
+    parser.add_argument('-seed', metavar='INT', type=int, nargs=1, help="""Seed of bootstrap resampling and of order
+        of clusters with -converge (default: 1)""", default=[1])
+    parser.add_argument('-converge', metavar='MARGIN', type=float, nargs=1, help="""Stop aligning, when the consensus
+        topology didn't change and its every split stayed at least MARGIN above min_freq over -window trees; clusters are processed
+        in random order (default: align all clusters)""", default=[None])
+    parser.add_argument('-window', metavar='INT', type=int, nargs=1, help="""Number of trees, over which
+        the consensus has to be stable with -converge (default: 1000)""", default=[1000])
+    parser.add_argument('-manifest', metavar='PATH', type=str, nargs=1, help="""Manifest file (.jsonl, see manifest.py);
+        clusters aligned before with the same parameters, whose files didn't change, are skipped
+        (default: align all clusters)""", default=None)
+    args = parser.parse_args()
+    if not is_store(args.input[0]) and not (os.path.isfile(args.input[0]) and args.input[0].endswith(".txt")):
+        parser.error(f"{args.input[0]} is not .txt file with paths to clusters or cluster store directory")
+    if not os.path.isfile(args.taxa_list[0]):
+        parser.error(f"Provide taxa list: {args.taxa_list[0]} doesn't exist")
+    if args.threads[0] < 1:
+        print(f"parametr: threads = {args.threads[0]} out of range, changing to 1")
+        args.threads[0] = 1
+    tree = (args.gaps[0], args.engine[0], max(0, args.bootstrap[0]), args.seed[0])
+    return [args.input[0], args.taxa_list[0], args.min_freq[0], args.mode[0], args.threads[0], tree, args.aln[0],
+            args.manifest[0] if args.manifest else None, args.queue[0], max(0.0, args.every[0]), args.converge[0],
+            max(1, args.window[0])]
+
+
+def main():
+    inputs = parse_args()
+    print(f"{' '*12}> Streaming MSA, NJ trees and consensus < \n\n{'#'*20}START{'#'*20}")
+    print(f"\nInput file:\t\t{inputs[0]}\ntaxa list:\t\t{inputs[1]}\nmin_freq:\t\t{inputs[2]}\n"
+          f"aligner:\t\t{aligners[inputs[3]]}\nthreads:\t\t{inputs[4]}\nbootstrap:\t\t{inputs[5][2]}")
+    if inputs[7]:
+        print(f"manifest:\t\t{inputs[7]}")
+    if inputs[10] is not None:
+        print(f"converge:\t\tmargin {inputs[10]}, window {inputs[11]} trees")
+    print(f"pid:\t\t\t{os.getpid()} (kill -USR1 {os.getpid()} writes provisional consensus)", flush=True)
+    process_stream(*inputs)
+
+
+if __name__ == "__main__":
+    main()
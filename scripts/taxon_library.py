@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+
+"""
+In-memory index of taxon_library.csv.
+
+The library file keeps its TSV format (one line per name of a proteome):
+
+scientificName/commonName/synonymName \t taxonID \t [Uniprot/NCBI]_proteome_ID \t fasta.gz path
+Homo sapiens                          \t 9606   \t UP000005640                \t ./proteome_datasets/UP000005640_9606.fasta.gz
+
+It is read once and indexed by normalized name (lower case, single spaces; also without
+the "(...)" suffix), taxon ID and proteome ID. New entries are appended both to the file
+and to the index, so the library doesn't have to be scanned again in the same run; lines
+appended by other runs are indexed by refresh() (only the new part of the file is read).
+
+Proteomes are removed in one rewrite of the file (remove() with all paths to remove): the
+other lines are kept in their order, the new file is written to a temporary file and renamed.
+Appends and rewrites of separate runs are serialized by lock of [library].lock file, reads
+take shared lock of it, so they never see a half-written line.
+"""
+
+import os
+import fcntl
+import threading
+import contextlib
+
+
+def normalize_name(name):
+    return " ".join(str(name).lower().split())
+
+
+class TaxonLibrary:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        with self.lock, self.file_lock(fcntl.LOCK_SH):
+            self._reset()
+            self._read()
+
+    def refresh(self):
+        # index lines added by other runs since the last read
+        with self.lock, self.file_lock(fcntl.LOCK_SH):
+            self._read()
+
+    def _reset(self):
+        self.entries = []
+        self.names = {}
+        self.taxa = {}
+        self.proteomes = {}
+        self.inode = None
+        self.offset = 0
+        self.newline = True
+
+    def _read(self):
+        # read from the last offset; the whole file is read again, when it was replaced by another run
+        try:
+            f = open(self.path, "rb")
+        except FileNotFoundError:
+            self._reset()
+            return
+        with f:
+            stat = os.fstat(f.fileno())
+            if stat.st_ino != self.inode or stat.st_size < self.offset:
+                self._reset()
+                self.inode = stat.st_ino
+            f.seek(self.offset)
+            data = f.read()
+        if data:
+            self.offset += len(data)
+            self.newline = data.endswith(b"\n")
+            for line in data.decode("utf-8").splitlines():
+                line = line.strip().split("\t")
+                if len(line) >= 4:
+                    self._index(line[:4])
+
+    def _index(self, entry):
+        nr = len(self.entries)
+        self.entries.append(entry)
+        name = normalize_name(entry[0])
+        self.names.setdefault(name, nr)
+        self.names.setdefault(name.split("(")[0].strip(), nr)
+        self.taxa.setdefault(entry[1], nr)
+        self.proteomes.setdefault(entry[2], nr)
+
+    def find_entry(self, name):
+        # the first line of the library matching name, taxon ID or proteome ID
+        # (the same priority as the linear scan of the file)
+        found = [index.get(key) for index, key in ((self.names, normalize_name(name)),
+            (self.taxa, str(name).strip()), (self.proteomes, str(name).strip()))]
+        found = [nr for nr in found if nr is not None]
+        if found:
+            return self.entries[min(found)]
+        return None
+
+    def find(self, name):
+        entry = self.find_entry(name)
+        if entry is None:
+            return None
+        return entry[3]
+
+    @contextlib.contextmanager
+    def file_lock(self, operation=fcntl.LOCK_EX):
+        # separate lock file: the library file itself is replaced by remove()
+        try:
+            f = open(f"{self.path}.lock", "a")
+        except OSError:
+            if operation == fcntl.LOCK_EX:
+                raise
+            # read-only (or not created yet) database: nobody writes to it
+            yield
+            return
+        with f:
+            fcntl.flock(f, operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def add(self, name, taxon, proteome_id, path):
+        entry = [str(name), str(taxon), str(proteome_id), str(path)]
+        with self.lock, self.file_lock():
+            # lines of other runs are indexed first, so the index keeps order of the file
+            self._read()
+            with open(self.path, "a") as f:
+                f.write(("" if self.newline else "\n") + "\t".join(entry) + "\n")
+            self._read()
+
+    def _replace(self, lines):
+        # write to temporary file and rename, the library is never left half-written
+        tmp = f"{self.path}.tmp{os.getpid()}"
+        with open(tmp, "w") as f:
+            f.writelines(lines)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    def remove(self, paths):
+        """Remove all lines of proteomes with the given fasta.gz paths; returns removed entries."""
+        paths = {str(path) for path in paths}
+        with self.lock, self.file_lock():
+            # the file is read again: other runs could append to it
+            lines = []
+            if os.path.isfile(self.path):
+                with open(self.path, "r") as f:
+                    lines = f.readlines()
+            kept = []
+            removed = []
+            for line in lines:
+                entry = line.strip().split("\t")
+                if len(entry) >= 4 and entry[3] in paths:
+                    removed.append(entry[:4])
+                else:
+                    kept.append(line if line.endswith("\n") else line + "\n")
+            if removed:
+                self._replace(kept)
+            self._reset()
+            self._read()
+        return removed
+
+    def save(self, path=None):
+        # export library to TSV (by default overwrite library file)
+        lines = ["\t".join(entry) + "\n" for entry in self.entries]
+        if path is None or os.path.abspath(path) == os.path.abspath(self.path):
+            with self.lock, self.file_lock():
+                self._replace(lines)
+                self._reset()
+                self._read()
+        else:
+            with open(path, "w") as f:
+                f.writelines(lines)
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+
+"""
+Script Name: telemetry.py
+
+Description:
+Performance records of pipeline steps and of single tasks (alignment of a cluster, NJ tree,
+download of a proteome). Records are appended as JSON lines to the file given by environment
+variable ECT_TELEMETRY (nothing is written when it's not set); ect.sh sets it to telemetry.jsonl.
+
+Fields of a record:
+> run       - ID of the pipeline run (environment variable ECT_RUN, set by ect.sh)
+> kind      - stage (whole step run by ect.sh) or task
+> stage     - name of the step, e.g. MSA, nj, download
+> name      - command of the step or ID of the task (cluster ID, file name)
+> wall      - wall time [s]
+> cpu       - CPU time (user + system) [s], also of subprocesses (e.g. aligner)
+> peak_rss  - peak resident memory [bytes] (of task subprocess, or of the worker process so far)
+> status    - exit code of the step, "ok" or reason of failure of the task
+> sequences, length, bytes - size of the input: number of sequences, alignment length, bytes
+
+Usage:
+    python telemetry.py -stage MSA python3 run_MSA.py ...   (run command and record it as a step)
+    python telemetry.py -summary telemetry.jsonl            (hot spots and the slowest tasks)
+"""
+
+import os
+import sys
+import json
+import time
+import fcntl
+import argparse
+import resource
+import threading
+import subprocess
+
+# ID of the run is inherited by subprocesses and worker processes
+os.environ.setdefault("ECT_RUN", time.strftime("%Y%m%d-%H%M%S"))
+
+current = threading.local()
+
+
+def telemetry_file():
+    return os.environ.get("ECT_TELEMETRY")
+
+
+def peak_rss():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def write(record):
+    path = telemetry_file()
+    if not path:
+        return
+    record = {"run": os.environ["ECT_RUN"], **record}
+    with open(path, "a") as f:
+        # appends of worker processes don't mix lines
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.write(json.dumps(record) + "\n")
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class task:
+    """Context manager measuring a task: with task("MSA", key, bytes=size) as t: ...
+    CPU time is counted for the current thread (per_thread=True) or for the whole process,
+    CPU time and peak RSS of subprocesses started by run() are added."""
+
+    def __init__(self, stage, name, per_thread=True, **fields):
+        self.stage = stage
+        self.name = name
+        self.clock = time.thread_time if per_thread else time.process_time
+        self.fields = fields
+        self.child_cpu = 0.0
+        self.child_rss = 0
+
+    def add(self, **fields):
+        self.fields.update(fields)
+
+    def __enter__(self):
+        self.parent = getattr(current, "task", None)
+        current.task = self
+        self.start = time.perf_counter()
+        self.start_cpu = self.clock()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        current.task = self.parent
+        if not telemetry_file():
+            return False
+        record = {"kind": "task", "stage": self.stage, "name": self.name,
+                  "wall": round(time.perf_counter() - self.start, 6),
+                  "cpu": round(self.clock() - self.start_cpu + self.child_cpu, 6),
+                  "peak_rss": self.child_rss or peak_rss(), "status": "ok"}
+        record.update(self.fields)
+        if exc_type:
+            record["status"] = exc_type.__name__
+        write(record)
+        return False
+
+
+def note(**fields):
+    # add fields (e.g. size of the input) to the task measured in this thread, if any
+    if getattr(current, "task", None) is not None:
+        current.task.add(**fields)
+
+
+def run(args, **kwargs):
+    """subprocess.run() (without input and timeout), which also takes resource usage of the finished
+    process with os.wait4(); CPU time and peak RSS are added to the current task."""
+    proc = subprocess.Popen(args, **kwargs)
+    outputs = {}
+    readers = [threading.Thread(target=lambda name, pipe: outputs.__setitem__(name, pipe.read()), args=(name, pipe))
+               for name, pipe in (("stdout", proc.stdout), ("stderr", proc.stderr)) if pipe is not None]
+    for reader in readers:
+        reader.start()
+    for reader in readers:
+        reader.join()
+    _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    for pipe in (proc.stdout, proc.stderr):
+        if pipe is not None:
+            pipe.close()
+    result = subprocess.CompletedProcess(args, proc.returncode, outputs.get("stdout"), outputs.get("stderr"))
+    result.cpu = usage.ru_utime + usage.ru_stime
+    result.peak_rss = usage.ru_maxrss * 1024
+    if getattr(current, "task", None) is not None:
+        current.task.child_cpu += result.cpu
+        current.task.child_rss = max(current.task.child_rss, result.peak_rss)
+    return result
+
+
+def run_stage(stage, command):
+    # command is run with the same stdout and stderr, input size: files given as arguments
+    start = time.perf_counter()
+    try:
+        result = run(command)
+        status, cpu, rss = result.returncode, result.cpu, result.peak_rss
+    except OSError as e:
+        print(f"{command[0]}: {e}", file=sys.stderr)
+        status, cpu, rss = 127, 0.0, 0
+    write({"kind": "stage", "stage": stage, "name": " ".join(command),
+           "wall": round(time.perf_counter() - start, 6), "cpu": round(cpu, 6), "peak_rss": rss,
+           "status": status, "bytes": sum(os.path.getsize(arg) for arg in command[1:] if os.path.isfile(arg))})
+    return status
+
+
+def read_records(path, run_id=None):
+    """Records of the given run (default: the last run in the file)."""
+    records = []
+    with open(path, "r") as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+    if run_id is None and records:
+        run_id = records[-1]["run"]
+    return run_id, [record for record in records if record["run"] == run_id]
+
+
+def megabytes(size):
+    return f"{size / 1024 ** 2:.1f}"
+
+
+def summary(path, run_id=None, top=20):
+    run_id, records = read_records(path, run_id)
+    print(f"Run:\t\t{run_id}\nRecords:\t{len(records)}")
+    stages = [record for record in records if record["kind"] == "stage"]
+    tasks = [record for record in records if record["kind"] == "task"]
+    if stages:
+        total = sum(record["wall"] for record in stages) or 1.0
+        print(f"\nSteps (sorted by wall time):\n{'wall[s]':>10} {'%':>6} {'cpu[s]':>10} {'rss[MB]':>9} {'in[MB]':>9} {'status':>6}  step")
+        for record in sorted(stages, key=lambda record: -record["wall"]):
+            print(f"{record['wall']:>10.2f} {100 * record['wall'] / total:>6.1f} {record['cpu']:>10.2f} "
+                  f"{megabytes(record['peak_rss']):>9} {megabytes(record['bytes']):>9} {record['status']:>6}  {record['stage']}")
+    if tasks:
+        groups = {}
+        for record in tasks:
+            groups.setdefault(record["stage"], []).append(record)
+        print(f"\nTasks (hot spots):\n{'tasks':>7} {'failed':>7} {'wall[s]':>10} {'cpu[s]':>10} {'mean[s]':>9} {'max[s]':>9} {'rss[MB]':>9}  stage")
+        for stage, group in sorted(groups.items(), key=lambda item: -sum(record["wall"] for record in item[1])):
+            wall = sum(record["wall"] for record in group)
+            print(f"{len(group):>7} {sum(1 for record in group if record['status'] != 'ok'):>7} {wall:>10.2f} "
+                  f"{sum(record['cpu'] for record in group):>10.2f} {wall / len(group):>9.3f} "
+                  f"{max(record['wall'] for record in group):>9.3f} {megabytes(max(record['peak_rss'] for record in group)):>9}  {stage}")
+        print(f"\nThe slowest tasks:\n{'wall[s]':>10} {'cpu[s]':>10} {'rss[MB]':>9} {'seqs':>6} {'length':>7} {'bytes':>11}  stage  name  status")
+        for record in sorted(tasks, key=lambda record: -record["wall"])[:top]:
+            print(f"{record['wall']:>10.3f} {record['cpu']:>10.3f} {megabytes(record['peak_rss']):>9} "
+                  f"{record.get('sequences', ''):>6} {record.get('length', ''):>7} {record.get('bytes', ''):>11}  "
+                  f"{record['stage']}  {record['name']}  {record['status']}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+    description="""Run a command of pipeline step and record its wall time, CPU time, peak RSS and exit code
+    in file from ECT_TELEMETRY variable, or show summary of records (hot spots and the slowest tasks)""")
+    parser.add_argument('-stage', metavar='NAME', type=str, nargs=1, help="""Name of the step run by the command
+        (exit code of the command is returned)""", default=None)
+    parser.add_argument('-summary', metavar='PATH', type=str, nargs=1, help="Telemetry file (.jsonl) to summarize", default=None)
+    parser.add_argument('-run', metavar='ID', type=str, nargs=1, help="Run to summarize (default: the last one)", default=[None])
+    parser.add_argument('-top', metavar='INT', type=int, nargs=1, help="Number of the slowest tasks shown (default: 20)", default=[20])
+    parser.add_argument('command', nargs=argparse.REMAINDER, help="Command of the step")
+    args = parser.parse_args()
+    if args.summary is None and (args.stage is None or not args.command):
+        parser.error("provide -summary file or -stage name and command")
+    return args
+
+
+def main():
+    args = parse_args()
+    if args.summary is not None:
+        if not os.path.isfile(args.summary[0]):
+            print(f"Provide telemetry file: {args.summary[0]} doesn't exist")
+            return 1
+        summary(args.summary[0], args.run[0], args.top[0])
+        return 0
+    return run_stage(args.stage[0], args.command)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,6 +1,6 @@
 import os
 import argparse
-import subprocess
+from taxon_library import TaxonLibrary
 
 taxon_library = "taxon_library.csv"
 
@@ -27,29 +27,29 @@ def parse_args():
         print(f"Error: The specified library file '{library}' does not exist.")
         return None
 
-def delete_path_lib(paths, library):
-    result = subprocess.run(['grep', f'{paths}', library], stdout=subprocess.PIPE)
-    if result.returncode == 0:
-        result = result.stdout.decode("utf-8").strip()
-        os.system(f"echo '{result}' >> {library}")
-        os.system(f"sort {library} | uniq -u > {library}.tmp")
-        os.system(f"cat {library}.tmp > {library}")
-        os.system(f"rm {library}.tmp")
-        result = result.split()[-1].strip()
-        print(f">>> removing file {result} from library\nDONE!")
-        return False
-    return True
+def missing_files(paths):
+    # every directory is listed once, instead of checking every file separately
+    directories = {}
+    for path in paths:
+        directories.setdefault(os.path.dirname(path) or ".", []).append(path)
+    missing = []
+    for directory, group in directories.items():
+        try:
+            files = {entry.name for entry in os.scandir(directory) if entry.is_file()}
+        except OSError:
+            files = set()
+        missing.extend(path for path in group if os.path.basename(path) not in files)
+    return missing
 
 def find_ids(library):
-    names_list = []
-    with open(library, 'r') as txtfile:
-        for line in txtfile:
-            linet = line.strip().split("\t")[-1]
-            if not os.path.isfile(linet) and linet not in names_list:
-                print(f"Cannot find file: {linet} : corresponding paths in library will be removed")
-                res = delete_path_lib(linet, library)
-                if res:
-                    print(f"FAILED: cannot find path in {library}\n-> path has probably already been removed")
+    # lines of all missing files are removed from library in one rewrite
+    lib = TaxonLibrary(library)
+    missing = missing_files(dict.fromkeys(entry[3] for entry in lib.entries))
+    for path in missing:
+        print(f"Cannot find file: {path} : corresponding paths in library will be removed")
+    removed = lib.remove(missing)
+    if missing:
+        print(f">>> removed {len(removed)} lines of {len(missing)} missing files from library\nDONE!")
 
 def main():
     inputs = parse_args()
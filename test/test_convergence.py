@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+"""
+Early stopping of stream_pipeline.py (-converge): trees of stable topology stop the stream,
+trees whose consensus keeps changing don't.
+
+Usage:
+    python -m pytest test/test_convergence.py
+"""
+
+import os
+import sys
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+
+from fast_consensus import SplitCounter
+from stream_pipeline import Convergence
+
+taxa_list = [f"taxon_{i}" for i in range(6)]
+topology_a = "((0,1),(2,3),(4,5));"
+topology_b = "((0,2),(1,3),(4,5));"
+
+
+def stopped_after(trees, min_freq=0.5, margin=0.1, window=200):
+    # number of trees after which the stream would stop (None - it doesn't stop)
+    counter = SplitCounter(taxa_list)
+    convergence = Convergence(min_freq, margin, window)
+    for text in trees:
+        counter.add_newick(text)
+        if convergence.update(counter):
+            return counter.trees
+    return None
+
+
+def test_stable_topology_stops_early():
+    # window is counted from the first check (window/20 trees), when the consensus appeared
+    assert stopped_after([topology_a] * 5000) == 210
+
+
+def test_stable_topology_with_noise_stops_early():
+    # rare splits of single gene trees stay close below min_freq, but they are not in the consensus
+    rng = random.Random(1)
+    trees = []
+    for _ in range(5000):
+        if rng.random() < 0.9:
+            trees.append(topology_a)
+        else:
+            leaves = [str(i) for i in range(6)]
+            rng.shuffle(leaves)
+            trees.append(f"(({leaves[0]},{leaves[1]}),({leaves[2]},{leaves[3]}),({leaves[4]},{leaves[5]}));")
+    stop = stopped_after(trees, min_freq=0.05, margin=0.04)
+    assert stop is not None and stop <= 300
+
+
+def test_changing_topology_does_not_stop():
+    # two topologies in turns: their splits stay around min_freq
+    rng = random.Random(2)
+    trees = [topology_a if rng.random() < 0.5 else topology_b for _ in range(5000)]
+    assert stopped_after(trees) is None
+
+
+def test_topology_change_resets_window():
+    # consensus changes from A to B after 200 trees, before the window of A was over
+    trees = [topology_a] * 100 + [topology_b] * 5000
+    stop = stopped_after(trees, margin=0.01)
+    assert stop is not None and stop >= 200 + 200